@@ -1,4 +1,3 @@
-from confluent_kafka import Producer
 from kbase_workspace_client.exceptions import WorkspaceResponseError
 import argparse
 import json
@@ -7,6 +6,8 @@ import requests
 import sys
 
 from src.utils.config import config
+from src.index_runner.bulk_mode import end_bulk_mode, start_bulk_mode, type_indexes
+import src.utils.kafka as kafka
 
 _ES_URL = config()['elasticsearch_url']
 _ERR_IDX_NAME = config()['elasticsearch_index_prefix'] + '.' + config()['error_index_name']
@@ -109,10 +110,22 @@ def _reindex(args):
     _produce(ev)
 
 
+def _bulk_mode(args):
+    """Start or end bulk mode on the indexes directly."""
+    if args.action == 'start':
+        start_bulk_mode(args.index)
+        print('Bulk mode started. Run "indexer_admin bulk_mode end" once the reindex has finished.')
+    else:
+        end_bulk_mode(args.index)
+        print('Bulk mode ended.')
+
+
 def _reindex_ws_range(args):
     evtype = 'INDEX_NONEXISTENT_WS'
     if args.overwrite:
         evtype = 'REINDEX_WS'
+    if args.bulk_mode:
+        start_bulk_mode()
     count = 0
     for wsid in range(args.min, args.max + 1):
         _produce({'evtype': evtype, 'wsid': int(wsid)})
@@ -133,6 +146,12 @@ def _reindex_ws_type(args):
     evtype = 'INDEX_NONEXISTENT'
     if args.overwrite:
         evtype = 'REINDEX'
+    if args.bulk_mode:
+        index_names = type_indexes(args.type)
+        if not index_names:
+            sys.stderr.write(f'No indexes are configured for {args.type}')
+            sys.exit(1)
+        start_bulk_mode(index_names)
     objids = []
     for wsid in range(args.start, args.stop + 1):
         wsid = int(wsid)
@@ -151,9 +170,8 @@ def _reindex_ws_type(args):
 
 
 def _produce(data, topic=config()['topics']['admin_events']):
-    producer = Producer({'bootstrap.servers': config()['kafka_server']})
-    producer.produce(topic, json.dumps(data), callback=_delivery_report)
-    producer.flush()
+    # Delivered in the background; flushed once the command is done
+    kafka.produce(data, topic=topic, callback=_delivery_report)
 
 
 def _delivery_report(err, msg):
@@ -234,6 +252,13 @@ if __name__ == '__main__':
         default=_STOP_ID,
         action='store'
     )
+    reindex_type.add_argument(
+        '--bulk-mode',
+        help='Disable refreshes and replicas on the indexes for the type first (see bulk_mode).',
+        required=False,
+        default=False,
+        action='store_true'
+    )
     reindex_type.set_defaults(func=_reindex_ws_type)
     # -- reindex range command
     reindex_range = subparsers.add_parser(
@@ -262,9 +287,32 @@ if __name__ == '__main__':
         default=False,
         action='store_true'
     )
+    reindex_range.add_argument(
+        '--bulk-mode',
+        help='Disable refreshes and replicas on all indexes, except the error and message logs, first '
+             '(see bulk_mode).',
+        required=False,
+        default=False,
+        action='store_true'
+    )
     reindex_range.set_defaults(func=_reindex_ws_range)
+    # -- bulk mode command
+    bulk_mode = subparsers.add_parser(
+        'bulk_mode',
+        help='Disable refreshes and replicas on indexes for a mass reindex, or restore them.'
+    )
+    bulk_mode.add_argument('action', choices=['start', 'end'])
+    bulk_mode.add_argument(
+        '--index',
+        help='Index name, without the prefix (eg. "genome_2"). Can be repeated. Defaults to all indexes, '
+             'except the error and message logs.',
+        required=False,
+        action='append'
+    )
+    bulk_mode.set_defaults(func=_bulk_mode)
     args = parser.parse_args()
     if len(sys.argv) == 1:
         parser.print_help()
     else:
         args.func(args)
+        kafka.flush_producer()
@@ -0,0 +1,137 @@
+"""
+Bulk mode for mass reindexing.
+
+Refreshes and replicas are disabled on indexes while they are being
+reindexed, and restored afterwards. The error and message log indexes are
+never put in bulk mode, so that they stay searchable. Kept apart from es_indexer so that the
+admin CLI can use it without loading the indexers.
+"""
+import json
+
+from src.utils.config import config
+from src.utils.http_session import get_session
+from src.utils.logger import logger
+
+_PREFIX = config()['elasticsearch_index_prefix']
+_ES_URL = config()['elasticsearch_url']
+_IDX = _PREFIX + ".*"
+_HEADERS = {"Content-Type": "application/json"}
+# Key in an index's mapping metadata holding its settings from before bulk mode
+_BULK_MODE_META = 'bulk_mode_saved'
+# Index settings changed by bulk mode
+_BULK_MODE_SETTINGS = {'index.refresh_interval': '-1', 'index.number_of_replicas': 0}
+
+
+def start_bulk_mode(index_names=None):
+    """
+    Speed up a mass reindex by disabling refreshes and replicas on indexes.
+    The current settings of each index are saved in its mapping metadata, so
+    that end_bulk_mode can restore them from any process. Indexes already in
+    bulk mode, and the log indexes, are left alone.
+    Args:
+        index_names - names of indexes without the prefix. Defaults to all indexes.
+    """
+    pattern = _index_pattern(index_names)
+    session = get_session('elasticsearch')
+    resp = session.get(f"{_ES_URL}/{pattern}/_mapping")
+    if not resp.ok:
+        raise RuntimeError(f"Error fetching mappings:\n{resp.text}")
+    log_indexes = _log_indexes()
+    meta_by_index = {
+        name: (idx['mappings'].get('_meta') or {})
+        for (name, idx) in resp.json().items()
+        if name not in log_indexes
+    }
+    resp = session.get(f"{_ES_URL}/{pattern}/_settings", params={'flat_settings': 'true'})
+    if not resp.ok:
+        raise RuntimeError(f"Error fetching index settings:\n{resp.text}")
+    settings_by_index = resp.json()
+    for (index_name, meta) in meta_by_index.items():
+        if _BULK_MODE_META in meta:
+            logger.info(f"Index {index_name} is already in bulk mode")
+            continue
+        settings = settings_by_index[index_name]['settings']
+        # A missing setting is saved as None, which resets it to the default
+        saved = {key: settings.get(key) for key in _BULK_MODE_SETTINGS}
+        _put_meta(index_name, {**meta, _BULK_MODE_META: saved})
+        _put_settings(index_name, _BULK_MODE_SETTINGS)
+        logger.info(f"Index {index_name} is in bulk mode")
+
+
+def end_bulk_mode(index_names=None):
+    """
+    Restore the settings saved by start_bulk_mode and refresh the indexes, so
+    that everything written in bulk mode becomes searchable.
+    Args:
+        index_names - names of indexes without the prefix. Defaults to all indexes.
+    """
+    pattern = _index_pattern(index_names)
+    resp = get_session('elasticsearch').get(f"{_ES_URL}/{pattern}/_mapping")
+    if not resp.ok:
+        raise RuntimeError(f"Error fetching mappings:\n{resp.text}")
+    restored = []
+    for (index_name, idx) in resp.json().items():
+        meta = idx['mappings'].get('_meta') or {}
+        if _BULK_MODE_META not in meta:
+            continue
+        _put_settings(index_name, meta[_BULK_MODE_META])
+        _put_meta(index_name, {key: val for (key, val) in meta.items() if key != _BULK_MODE_META})
+        restored.append(index_name)
+    if not restored:
+        logger.info("No indexes are in bulk mode")
+        return
+    resp = get_session('elasticsearch').post(f"{_ES_URL}/{','.join(restored)}/_refresh")
+    if not resp.ok:
+        raise RuntimeError(f"Error refreshing indexes:\n{resp.text}")
+    logger.info(f"Ended bulk mode for {len(restored)} indexes")
+
+
+def type_indexes(ws_type):
+    """
+    Names, without the prefix, of the indexes holding documents for a workspace
+    type (eg. "KBaseGenomes.Genome-17.0"), including its sub-object indexes.
+    Empty if the type is not indexed.
+    """
+    type_name = ws_type.split('-')[0]
+    base = config()['global']['ws_type_to_indexes'].get(type_name)
+    if base is None:
+        return []
+    latest = config()['global']['latest_versions']
+    # Eg. "genome" and "genome_features"
+    names = {index for (key, index) in latest.items() if key == base or key.startswith(base + '_')}
+    sub_obj_index = (config()['global']['sdk_indexer_apps'].get(type_name) or {}).get('sub_obj_index')
+    if sub_obj_index:
+        names.add(latest.get(sub_obj_index, sub_obj_index))
+    return sorted(names)
+
+
+def _log_indexes():
+    """Prefixed names of the error and message log indexes."""
+    latest = config()['global']['latest_versions']
+    names = set()
+    for name in (config()['error_index_name'], config()['msg_log_index_name']):
+        names.add(f"{_PREFIX}.{name}")
+        names.add(f"{_PREFIX}.{latest.get(name, name)}")
+    return names
+
+
+def _index_pattern(index_names):
+    """Comma-separated list of prefixed index names, or all indexes with the prefix."""
+    if not index_names:
+        return _IDX
+    return ','.join(f"{_PREFIX}.{name}" for name in index_names)
+
+
+def _put_settings(index_name, settings):
+    url = f"{_ES_URL}/{index_name}/_settings"
+    resp = get_session('elasticsearch').put(url, data=json.dumps(settings), headers=_HEADERS)
+    if not resp.ok:
+        raise RuntimeError(f"Error updating settings for index {index_name}:\n{resp.text}")
+
+
+def _put_meta(index_name, meta):
+    """Replace the `_meta` object of an index mapping."""
+    url = f"{_ES_URL}/{index_name}/_mapping"
+    resp = get_session('elasticsearch').put(url, data=json.dumps({'_meta': meta}), headers=_HEADERS)
+    if not resp.ok:
+        raise RuntimeError(f"Error updating mapping metadata for index {index_name}:\n{resp.text}")
@@ -0,0 +1,72 @@
+"""
+Collapse redundant workspace events found in a single batch of Kafka messages.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+Message = Dict[str, Any]
+
+# Events that (re)index a single object and are made redundant by a later one
+_OBJECT_INDEX_EVENTS = {'REINDEX', 'NEW_VERSION', 'COPY_OBJECT', 'RENAME_OBJECT', 'INDEX_NONEXISTENT'}
+
+
+def coalesce_events(events: List[Message]) -> List[Message]:
+    """
+    Merge object indexing events for the same `wsid/objid` into one event that
+    indexes the latest version of the object.
+
+    Any other event for a workspace (such as a deletion or permission change)
+    acts as a barrier: indexing events are never merged across it, so the
+    relative order of events within a workspace is kept.
+
+    Merged events have a `coalesced` field with the number of original events.
+    """
+    return [event for (event, _) in coalesce_groups(events)]
+
+
+def coalesce_groups(events: List[Message]) -> List[Tuple[Message, List[Message]]]:
+    """
+    Like coalesce_events, but pair each resulting event with the list of
+    original events it replaces, in order.
+    """
+    ret = []  # type: List[Tuple[Message, List[Message]]]
+    # Index into `ret` of the mergeable event for each (wsid, objid)
+    pending = {}  # type: Dict[Tuple[Any, Any], int]
+    for event in events:
+        key = _object_key(event)
+        if key is None:
+            # Barrier for the event's workspace, or for everything if it has none
+            wsid = event.get('wsid') if isinstance(event, dict) else None
+            pending = {k: v for (k, v) in pending.items() if wsid is not None and k[0] != wsid}
+            ret.append((event, [event]))
+        elif key in pending:
+            idx = pending[key]
+            (prev, originals) = ret[idx]
+            ret[idx] = (_merge(prev, event), originals + [event])
+        else:
+            pending[key] = len(ret)
+            ret.append((event, [event]))
+    return ret
+
+
+def _object_key(event: Message) -> Optional[Tuple[Any, Any]]:
+    """Get the (wsid, objid) pair for a mergeable event, or None."""
+    if not isinstance(event, dict) or event.get('evtype') not in _OBJECT_INDEX_EVENTS:
+        return None
+    if event.get('wsid') is None or event.get('objid') is None:
+        return None
+    return (event['wsid'], event['objid'])
+
+
+def _merge(prev: Message, event: Message) -> Message:
+    """Merge two indexing events for the same object."""
+    merged = dict(event)
+    merged['coalesced'] = prev.get('coalesced', 1) + 1
+    if prev['evtype'] != 'INDEX_NONEXISTENT' and event['evtype'] == 'INDEX_NONEXISTENT':
+        # Overwriting wins over only indexing missing docs
+        merged['evtype'] = prev['evtype']
+    if prev.get('ver') is None or event.get('ver') is None:
+        # Fetch whatever the latest version is
+        merged.pop('ver', None)
+    else:
+        merged['ver'] = max(prev['ver'], event['ver'])
+    return merged
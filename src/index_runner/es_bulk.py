@@ -0,0 +1,598 @@
+"""
+Building and sending Elasticsearch bulk requests.
+
+Documents are encoded to NDJSON as they are added to a BulkBuffer, which
+sends a `_bulk` request whenever it reaches a document count or a byte size,
+so memory use is bounded no matter how many documents an object produces.
+Up to `es_bulk_in_flight` requests are sent on background threads while more
+documents are generated; adding a document blocks when that many are pending.
+
+Documents from many consecutive messages can be collected in a process-wide
+BulkSink (see get_sink), which the event loop flushes before it commits the
+offsets of those messages.
+
+A buffer can write documents with `create` actions instead of `index`
+actions, so that existing documents are left alone; Elasticsearch answers those
+with a version conflict, which is not treated as an error. The same goes for
+documents given an external version that is older than the stored one.
+
+External versions are scaled by EXTERNAL_VERSION_SCALE (see external_version),
+because every update by query, such as a permission update, adds one to the
+stored version. A rewrite whose version is below the stored one in the same
+range is sent again with the stored version, so it is not lost.
+
+A buffer can also store a hash of each document's content in its `doc_hash`
+field. Before a batch with hashes is sent, the stored hashes are fetched with
+one `_mget` request and unchanged documents are dropped from the batch.
+
+A `_bulk` request can succeed while individual documents fail. Documents that
+Elasticsearch rejected because it is overloaded are retried on their own with
+exponential backoff, as is a whole request rejected for the same reason; any
+other failed document is logged to the error index.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Hashable, List, NamedTuple, Optional, Set, Tuple
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+
+from src.utils.config import config
+from src.utils.http_session import get_session
+from src.utils.logger import logger
+
+_PREFIX = config()['elasticsearch_index_prefix']
+_ES_URL = config()['elasticsearch_url']
+_HEADERS = {"Content-Type": "application/x-ndjson"}
+# Per-item statuses that mean "try again later"
+_RETRY_STATUSES = (429,)
+# Statuses of the whole request that mean "try again later"
+_REQUEST_RETRY_STATUSES = (429, 503)
+# Per-item error meaning the document was not written because a newer or
+# identical one is already there (eg. for `create` actions)
+_CONFLICT_ERROR = 'version_conflict_engine_exception'
+_RETRY_BACKOFF = 0.5  # seconds, doubled for each retry
+# Versions available between the external versions of consecutive object saves,
+# for the version increments of updates by query
+EXTERNAL_VERSION_SCALE = 1000
+
+_SINK = None  # type: Optional[BulkSink]
+_SINK_LOCK = threading.Lock()
+
+
+class _Overloaded(RuntimeError):
+    """Elasticsearch rejected a whole bulk request because it is overloaded."""
+
+
+class _Entry(NamedTuple):
+    """A buffered document: its encoded bulk action plus what we need to report a failure."""
+    index_name: str
+    id: str
+    wsid: Optional[int]
+    objid: Optional[int]
+    action: bytes
+    # Content hash, if unchanged documents should be skipped
+    doc_hash: Optional[str] = None
+    # External version of an index action
+    version: Optional[int] = None
+
+
+class BulkBuffer:
+    """
+    Accumulate encoded bulk actions and send them in batches. Documents within
+    a batch keep their order, but batches may be applied out of order when
+    more than one is in flight.
+
+    Each entry added has {doc, id, index}
+        doc - document data
+        id - document id
+        index - index name, without the prefix
+    """
+
+    def __init__(
+            self,
+            max_docs: Optional[int] = None,
+            max_bytes: Optional[int] = None,
+            send: Optional[Callable[[bytes], dict]] = None,
+            max_retries: Optional[int] = None,
+            max_in_flight: Optional[int] = None,
+            skip_unchanged: bool = False,
+            op_type: str = 'index'):
+        """
+        max_docs and max_bytes default to the `es_batch_writes` and
+        `es_batch_bytes` configuration. `send` receives each request body,
+        returns the parsed response, and defaults to send_bulk. max_retries is
+        how many times rejected documents are retried, defaulting to the
+        `es_bulk_retries` configuration. max_in_flight is how many batches may
+        be sent in the background, defaulting to the `es_bulk_in_flight`
+        configuration; 1 or less sends every batch in the calling thread.
+        If skip_unchanged is set, documents whose stored hash matches are not
+        sent. op_type is the bulk action, 'index' or 'create'; with 'create',
+        documents that already exist are not overwritten.
+        """
+        self.max_docs = max_docs or config()['es_batch_writes']
+        self.max_bytes = max_bytes or config()['es_batch_bytes']
+        self.max_retries = config()['es_bulk_retries'] if max_retries is None else max_retries
+        self.max_in_flight = config()['es_bulk_in_flight'] if max_in_flight is None else max_in_flight
+        self._send = send or send_bulk
+        self.skip_unchanged = skip_unchanged
+        self.op_type = op_type
+        self._entries = []  # type: List[_Entry]
+        self._size = 0
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._in_flight = collections.deque()  # type: Deque[Future]
+
+    def add(self, datum: dict) -> None:
+        """Encode and buffer a document, sending a batch if a limit is reached."""
+        entry = _encode_entry(datum, self.skip_unchanged, self.op_type)
+        if self._entries and self._size + len(entry.action) > self.max_bytes:
+            # Keep the batch under the byte budget
+            self._send_batch(background=True)
+        self._entries.append(entry)
+        self._size += len(entry.action)
+        if len(self._entries) >= self.max_docs or self._size >= self.max_bytes:
+            self._send_batch(background=True)
+
+    def flush(self, sink: Optional['BulkSink'] = None) -> None:
+        """
+        Send any buffered documents and wait for every request in flight.
+        Raises the first error from any of them. If a sink is given, buffered
+        documents are passed to it, to be sent along with those of other
+        messages, instead of being sent now.
+        """
+        if self._entries and sink is not None:
+            sink.add_entries(self._entries)
+            self._entries = []
+            self._size = 0
+        if self._entries:
+            # Nothing else to do while the last batch is sent
+            self._send_batch(background=False)
+        self._join()
+
+    def discard(self) -> None:
+        """
+        Drop the buffered documents and stop the background requests, for when
+        generating the documents failed. Requests that already started are
+        waited for, and their errors are logged instead of raised.
+        """
+        self._entries = []
+        self._size = 0
+        self._in_flight = collections.deque(future for future in self._in_flight if not future.cancel())
+        try:
+            self._join()
+        except Exception as err:
+            logger.error(f'Error from a bulk request sent before indexing failed: {err}')
+
+    def _send_batch(self, background: bool) -> None:
+        """Send the buffered documents, in the background when allowed."""
+        entries = self._entries
+        size = self._size
+        self._entries = []
+        self._size = 0
+        if not background or self.max_in_flight <= 1:
+            self._send_logged(entries, size)
+            return
+        while len(self._in_flight) >= self.max_in_flight:
+            # Back-pressure: wait for the oldest request before sending another
+            try:
+                self._in_flight.popleft().result()
+            except Exception:
+                self._join()
+                raise
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self._in_flight.append(self._executor.submit(self._send_logged, entries, size))
+
+    def _send_logged(self, entries: List[_Entry], size: int) -> None:
+        start = time.time()
+        _send_entries(entries, self._send, self.max_retries)
+        logger.info(f'Indexing of {len(entries)} docs ({size} bytes) on ES took {time.time() - start}s')
+
+    def _join(self) -> None:
+        """Wait for all requests in flight and stop the thread pool, raising the first error."""
+        error = None
+        while self._in_flight:
+            try:
+                self._in_flight.popleft().result()
+            except Exception as err:
+                error = error or err
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if error is not None:
+            raise error
+
+
+class BulkSink:
+    """
+    Thread-safe buffer of documents from many messages. Adding documents never
+    sends them; flush() sends everything buffered, in batches of at most
+    `max_docs` documents or `max_bytes` bytes, and keeps the documents if that
+    fails so that a later flush can try again. due() says when to flush: when
+    a limit is reached or the oldest document is `max_wait` seconds old.
+
+    Other writes that must follow the buffered documents, such as updates by
+    query, can be deferred to the next flush; repeated calls deferred under
+    the same key within that window run only once.
+    """
+
+    def __init__(
+            self,
+            max_wait: float,
+            max_docs: Optional[int] = None,
+            max_bytes: Optional[int] = None,
+            send: Optional[Callable[[bytes], dict]] = None,
+            max_retries: Optional[int] = None):
+        self.max_wait = max_wait
+        self.max_docs = max_docs or config()['es_batch_writes']
+        self.max_bytes = max_bytes or config()['es_batch_bytes']
+        self.max_retries = config()['es_bulk_retries'] if max_retries is None else max_retries
+        self._send = send or send_bulk
+        self._entries = []  # type: List[_Entry]
+        self._size = 0
+        # Calls to make after the documents are sent, by key, in order
+        self._deferred = collections.OrderedDict()  # type: collections.OrderedDict
+        # When the oldest buffered document or call was added
+        self._since = 0.0
+        self._lock = threading.Lock()
+        # Held while sending, so that a flush returns only once every document
+        # added before it was called has been sent
+        self._flush_lock = threading.Lock()
+
+    def add(self, datum: dict) -> None:
+        """Encode and buffer a document."""
+        self.add_entries([_encode_entry(datum)])
+
+    def add_entries(self, entries: List[_Entry]) -> None:
+        with self._lock:
+            if not self._entries and not self._deferred:
+                self._since = time.monotonic()
+            self._entries.extend(entries)
+            self._size += sum(len(e.action) for e in entries)
+
+    def defer(self, key: Hashable, fn: Callable[[], None]) -> None:
+        """
+        Call fn at the next flush, after the buffered documents are sent. Replaces
+        any call not yet made under the same key.
+        """
+        with self._lock:
+            if not self._entries and not self._deferred:
+                self._since = time.monotonic()
+            self._deferred.pop(key, None)
+            self._deferred[key] = fn
+
+    def due(self) -> bool:
+        """Whether the buffered documents should be sent now. True when there are none."""
+        with self._lock:
+            if not self._entries and not self._deferred:
+                return True
+            return (len(self._entries) >= self.max_docs or self._size >= self.max_bytes
+                    or time.monotonic() - self._since >= self.max_wait)
+
+    def flush(self) -> None:
+        """Send every buffered document and make the deferred calls, raising if any fail."""
+        with self._flush_lock:
+            with self._lock:
+                entries = self._entries
+                deferred = self._deferred
+                since = self._since
+                self._entries = []
+                self._size = 0
+                self._deferred = collections.OrderedDict()
+            if not entries and not deferred:
+                return
+            start = time.time()
+            sent = 0
+            try:
+                for batch in _batches(entries, self.max_docs, self.max_bytes):
+                    _send_entries(batch, self._send, self.max_retries)
+                    sent += len(batch)
+                while deferred:
+                    (key, fn) = next(iter(deferred.items()))
+                    fn()
+                    del deferred[key]
+            except Exception:
+                # Keep what was not done, ahead of anything added since
+                with self._lock:
+                    unsent = entries[sent:]
+                    if self._entries or self._deferred:
+                        since = min(since, self._since)
+                    self._entries = unsent + self._entries
+                    self._size = sum(len(e.action) for e in self._entries)
+                    for (key, fn) in self._deferred.items():
+                        # Newer calls replace older ones
+                        deferred.pop(key, None)
+                        deferred[key] = fn
+                    self._deferred = deferred
+                    self._since = since
+                raise
+            if entries:
+                logger.info(f'Indexing of {len(entries)} buffered docs on ES took {time.time() - start}s')
+
+    def discard(self, error: Exception) -> None:
+        """
+        Drop everything buffered after a flush kept failing with `error`. The
+        documents are saved to the error index and the deferred calls logged.
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries = self._entries
+                deferred = self._deferred
+                self._entries = []
+                self._size = 0
+                self._deferred = collections.OrderedDict()
+        if deferred:
+            logger.error(f"Dropping {len(deferred)} deferred writes: {list(deferred)}")
+        if entries:
+            _log_failures([(entry, f"Not sent after repeated errors: {error}") for entry in entries])
+
+
+def get_sink() -> Optional[BulkSink]:
+    """
+    Get the process-wide sink for documents from consecutive messages, or None
+    if the `es_flush_interval` configuration disables it.
+    """
+    global _SINK
+    if config()['es_flush_interval'] <= 0:
+        return None
+    with _SINK_LOCK:
+        if _SINK is None:
+            _SINK = BulkSink(config()['es_flush_interval'])
+        return _SINK
+
+
+def sink_due() -> bool:
+    """Whether offsets can be committed without waiting for more documents."""
+    sink = get_sink()
+    return sink is None or sink.due()
+
+
+def flush_sink() -> None:
+    """Send any documents waiting in the sink and make its deferred calls."""
+    sink = get_sink()
+    if sink is not None:
+        sink.flush()
+
+
+def discard_sink(error: Exception) -> None:
+    """Drop what is waiting in the sink after flush_sink kept failing, saving the documents to the error index."""
+    sink = get_sink()
+    if sink is not None:
+        sink.discard(error)
+
+
+def after_flush(key: Hashable, fn: Callable[[], None]) -> None:
+    """
+    Call fn once the documents waiting in the sink are sent, replacing any call
+    not yet made under the same key, or call it now if there is no sink.
+    """
+    sink = get_sink()
+    if sink is None:
+        fn()
+    else:
+        sink.defer(key, fn)
+
+
+def encode_action(datum: dict, op_type: str = 'index') -> bytes:
+    """
+    Encode a document as the two NDJSON lines of a bulk index (or create)
+    action. If the datum has a `version`, an index action uses it as an
+    external version, and Elasticsearch keeps any stored document with a
+    higher version instead.
+    """
+    meta = {
+        '_index': f"{_PREFIX}.{datum['index']}",
+        '_id': datum['id']
+    }
+    # Elasticsearch only allows internal versioning with create actions
+    if datum.get('version') is not None and op_type == 'index':
+        meta['version'] = datum['version']
+        meta['version_type'] = 'external_gte'
+    action = {op_type: meta}
+    doc = _global_doc_defaults(datum['doc'])
+    return (json.dumps(action) + '\n' + json.dumps(doc) + '\n').encode('utf-8')
+
+
+def external_version(epoch: int) -> int:
+    """
+    External document version for an object version saved at `epoch`
+    (milliseconds), leaving room for EXTERNAL_VERSION_SCALE - 1 updates by
+    query before the next save time.
+    """
+    return int(epoch) * EXTERNAL_VERSION_SCALE
+
+
+def doc_hash(doc: dict) -> str:
+    """
+    Hash the content of a document, ignoring the fields in the `es_hash_exclude`
+    configuration (such as index_runner_ver) and any previous hash.
+    """
+    exclude = config()['es_hash_exclude']
+    content = {key: val for (key, val) in doc.items() if key not in exclude and key != 'doc_hash'}
+    return hashlib.blake2b(json.dumps(content, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def send_bulk(body: bytes) -> dict:
+    """Save the documents using the elasticsearch http api, returning the parsed response."""
+    resp = get_session('elasticsearch').post(f"{_ES_URL}/_bulk", data=body, headers=_HEADERS)
+    if resp.status_code in _REQUEST_RETRY_STATUSES:
+        raise _Overloaded(f"Elasticsearch is overloaded ({resp.status_code}):\n{resp.text}")
+    if not resp.ok:
+        # Unsuccessful save to elasticsearch.
+        raise RuntimeError(f"Error saving to elasticsearch:\n{resp.text}")
+    return resp.json()
+
+
+def _send_entries(entries: List[_Entry], send: Callable[[bytes], dict], max_retries: int) -> None:
+    """
+    Send entries in one bulk request, then retry any that were rejected, or
+    the whole request if it was rejected, with exponential backoff. Other
+    per-document failures go to the error index.
+    """
+    if any(e.doc_hash for e in entries):
+        entries = _drop_unchanged(entries)
+    attempt = 0
+    # Rewrites sent again with the stored version, which are not retried twice
+    rebased = set()  # type: Set[Tuple[str, str]]
+    while entries:
+        try:
+            resp = send(b''.join(e.action for e in entries))
+        except _Overloaded:
+            if attempt >= max_retries:
+                raise
+            _backoff(attempt, f"Elasticsearch rejected a request of {len(entries)} documents")
+            attempt += 1
+            continue
+        if not resp.get('errors'):
+            return
+        retries = []
+        failures = []
+        conflicts = []
+        for (entry, item) in zip(entries, resp['items']):
+            # Each item is keyed by its action type, eg. {"index": {...}}
+            result = next(iter(item.values()))
+            status = result.get('status', 200)
+            if status in _RETRY_STATUSES:
+                retries.append(entry)
+            elif status == 409 and (result.get('error') or {}).get('type') == _CONFLICT_ERROR:
+                conflicts.append(entry)
+            elif status >= 300:
+                failures.append((entry, result.get('error')))
+        rewrites = _rebase_conflicts([e for e in conflicts if (e.index_name, e.id) not in rebased])
+        rebased.update((e.index_name, e.id) for e in rewrites)
+        existing = sum(1 for e in conflicts if e.version is None)
+        if existing:
+            logger.info(f"{existing} documents were already present")
+        if len(conflicts) - existing > len(rewrites):
+            logger.warning(f"{len(conflicts) - existing - len(rewrites)} documents were not written, "
+                           "as a newer object version is stored")
+        if failures:
+            _log_failures(failures)
+        if retries and attempt >= max_retries:
+            raise RuntimeError(f"Elasticsearch rejected {len(retries)} documents after {attempt} retries")
+        if retries:
+            _backoff(attempt, f"Elasticsearch rejected {len(retries)} documents")
+            attempt += 1
+        entries = retries + rewrites
+
+
+def _backoff(attempt: int, reason: str) -> None:
+    """Sleep before a retry, for about twice as long as the previous one."""
+    delay = _RETRY_BACKOFF * (2 ** attempt)
+    logger.warning(f"{reason}, retrying in about {delay}s")
+    time.sleep(random.uniform(delay / 2, delay))  # nosec
+
+
+def _encode_entry(datum: dict, with_hash: bool = False, op_type: str = 'index') -> _Entry:
+    doc = datum['doc']
+    _hash = None
+    if with_hash:
+        _hash = doc_hash(_global_doc_defaults(doc))
+        doc['doc_hash'] = _hash
+    version = datum.get('version') if op_type == 'index' else None
+    return _Entry(datum['index'], datum['id'], doc.get('access_group'), doc.get('obj_id'),
+                  encode_action(datum, op_type), _hash, version)
+
+
+def _rebase_conflicts(entries: List[_Entry]) -> List[_Entry]:
+    """
+    Of the entries rejected for their external version, get the ones that are
+    rewrites of the stored object version, whose stored version was increased
+    by updates by query, with their version set to the stored one.
+    """
+    versioned = [e for e in entries if e.version is not None]
+    if not versioned:
+        return []
+    body = {'docs': [{'_index': f"{_PREFIX}.{e.index_name}", '_id': e.id, '_source': False} for e in versioned]}
+    resp = get_session('elasticsearch').post(
+        f"{_ES_URL}/_mget", data=json.dumps(body), headers={"Content-Type": "application/json"})
+    if not resp.ok:
+        logger.warning(f"Unable to fetch document versions from elasticsearch:\n{resp.text}")
+        return []
+    rebased = []
+    for (entry, found) in zip(versioned, resp.json()['docs']):
+        stored = found.get('_version') if found.get('found') else None
+        if stored is None or entry.version is None:
+            continue
+        if stored // EXTERNAL_VERSION_SCALE != entry.version // EXTERNAL_VERSION_SCALE:
+            # A newer object version
+            continue
+        (meta_line, doc_lines) = entry.action.split(b'\n', 1)
+        meta = json.loads(meta_line)
+        meta['index']['version'] = stored
+        rebased.append(entry._replace(action=json.dumps(meta).encode('utf-8') + b'\n' + doc_lines, version=stored))
+    return rebased
+
+
+def _drop_unchanged(entries: List[_Entry]) -> List[_Entry]:
+    """Remove entries whose hash matches the one stored in Elasticsearch."""
+    body = {
+        'docs': [
+            {'_index': f"{_PREFIX}.{e.index_name}", '_id': e.id, '_source': ['doc_hash']}
+            for e in entries
+        ]
+    }
+    resp = get_session('elasticsearch').post(
+        f"{_ES_URL}/_mget", data=json.dumps(body), headers={"Content-Type": "application/json"})
+    if not resp.ok:
+        # Not worth failing over; write everything
+        logger.warning(f"Unable to fetch document hashes from elasticsearch:\n{resp.text}")
+        return entries
+    changed = []
+    for (entry, found) in zip(entries, resp.json()['docs']):
+        stored = found.get('_source', {}).get('doc_hash') if found.get('found') else None
+        if entry.doc_hash is None or stored != entry.doc_hash:
+            changed.append(entry)
+    if len(changed) < len(entries):
+        logger.info(f"Skipping {len(entries) - len(changed)} unchanged documents")
+    return changed
+
+
+def _batches(entries: List[_Entry], max_docs: int, max_bytes: int):
+    """Split entries into consecutive batches within the doc count and byte limits."""
+    batch = []  # type: List[_Entry]
+    size = 0
+    for entry in entries:
+        if batch and (len(batch) >= max_docs or size + len(entry.action) > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(entry)
+        size += len(entry.action)
+    if batch:
+        yield batch
+
+
+def _log_failures(failures: list) -> None:
+    """Save documents that Elasticsearch could not index to the error index."""
+    logger.error(f"Elasticsearch failed to index {len(failures)} documents")
+    parts = []
+    for (entry, error) in failures:
+        logger.error(f"Failed to index {entry.index_name}/{entry.id}: {error}")
+        _id = hashlib.blake2b(f"{entry.index_name}/{entry.id}".encode('utf-8')).hexdigest()
+        parts.append(encode_action({
+            'index': config()['error_index_name'],
+            'id': _id,
+            'doc': {
+                'error': f"Failed to index {entry.index_name}/{entry.id}: {json.dumps(error)}",
+                'evtype': 'BULK_ITEM_ERROR',
+                'wsid': entry.wsid,
+                'objid': entry.objid,
+            }
+        }))
+    resp = send_bulk(b''.join(parts))
+    if resp.get('errors'):
+        logger.error(f"Unable to save indexing errors to elasticsearch: {resp['items']}")
+
+
+def _global_doc_defaults(doc: dict):
+    """
+    Set defaults in any doc we save to elasticsearch
+    Args:
+        doc - data we are saving to elastic
+    Mutates doc
+    """
+    doc['index_runner_ver'] = config()['app_version']
+    return doc
@@ -2,18 +2,26 @@
 Takes workspace kafka event data and generates new Elasticsearch index upates
 (creations, updates, deletes, etc)
 """
+from kbase_workspace_client.exceptions import WorkspaceResponseError
+from typing import Optional, Set
+import functools
+import hashlib
 import json
-import requests
-import time
+import threading
 from enum import Enum
 
 from src.utils.logger import logger
 from src.utils.config import config
+from src.utils.http_session import get_session
+from src.utils.request_context import RequestContext, invalidate_workspace
 from src.utils.ws_utils import get_type_pieces
+from src.index_runner.es_bulk import BulkBuffer, after_flush, external_version, get_sink
+import src.index_runner.es_tasks as es_tasks
 from src.index_runner.es_indexers.main import index_obj
 from src.index_runner.es_indexers.indexer_utils import (
     check_object_deleted,
     check_workspace_deleted,
+    get_shared_users,
     is_workspace_public
 )
 
@@ -24,71 +32,148 @@ _GLOBAL_MAPPINGS = config()['global']['global_mappings']
 _HEADERS = {"Content-Type": "application/json"}
 _MAPPINGS = config()['global']['mappings']
 _DEFAULT_SEARCH_ALIAS = 'default_search'
+# Stored script setting the permission fields of a workspace's documents
+_PERMS_SCRIPT_ID = f"{_PREFIX}_set_ws_perms"
+_PERMS_SCRIPT = "ctx._source.is_public = params.is_public; ctx._source.shared_users = params.shared_users"
+_PERMS_SCRIPT_STORED = False
+# Key in an index's mapping metadata holding the hash of the configured properties
+_MAPPING_HASH_META = 'mapping_hash'
+# Generic indexes that are fully initialized (created, mapped, and in the default
+# search alias), seeded from Elasticsearch on first use
+_GENERIC_INDEXES = None  # type: Optional[Set[str]]
+_GENERIC_INDEXES_LOCK = threading.RLock()
 
 
 def init_indexes():
     """
     Initialize Elasticsearch indexes using the global configuration file.
+    A hash of each index's configured properties is kept in its mapping
+    metadata, so indexes whose configuration has not changed are skipped.
     """
+    resp = get_session('elasticsearch').get(f"{_ES_URL}/{_IDX}/_mapping")
+    if not resp.ok:
+        raise RuntimeError(f"Error fetching mappings:\n{resp.text}")
+    existing = resp.json()
+    skipped = 0
     for index, mapping in _MAPPINGS.items():
         global_mappings = {}  # type: dict
         if mapping.get('global_mappings'):
             for g_map in mapping['global_mappings']:
                 global_mappings.update(_GLOBAL_MAPPINGS[g_map])
         global_mappings.update(_GLOBAL_MAPPINGS.get('all', {}))
-        _init_index(index, {**mapping['properties'], **global_mappings})
+        props = {**mapping['properties'], **global_mappings}
+        index_name = f"{_PREFIX}.{index}"
+        props_hash = hashlib.blake2b(json.dumps(props, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+        if index_name not in existing:
+            status = _create_index(index_name, {'properties': props, '_meta': {_MAPPING_HASH_META: props_hash}})
+            if status == Status.EXISTS:
+                # Created by another process since we looked
+                _put_mapping(index_name, props, {_MAPPING_HASH_META: props_hash})
+            logger.info(f"index {index_name} created.")
+            continue
+        meta = existing[index_name]['mappings'].get('_meta') or {}
+        if meta.get(_MAPPING_HASH_META) == props_hash:
+            skipped += 1
+            continue
+        # Keep any other metadata, such as the bulk mode settings
+        _put_mapping(index_name, props, {**meta, _MAPPING_HASH_META: props_hash})
+        logger.info(f"index {index_name} mapping updated.")
+    logger.info(f"{skipped} indexes are up to date")
 
 
 def reload_aliases():
     """
-    Create aliases on elasticsearch from the global configuration file.
-    """
-    # FIXME Currently, this function only adds new indexes to aliases.
-    # In the future, we want to remove aliases that exist on elastic
-    # but not in the config.
-    if config()['global'].get('aliases'):
-        group_aliases = config()['global']['aliases']
-        for alias_name in group_aliases:
-            try:
-                _create_alias(
-                    f"{_PREFIX}.{alias_name}",
-                    [f"{_PREFIX }.{name}" for name in group_aliases[alias_name]]
-                )
-            except RuntimeError as err:
-                names = group_aliases[alias_name]
-                raise RuntimeError(f"Failed creating alias name: {alias_name}, "
-                                   f"for indices: {names}..\nerror: {err}")
-        logger.info("Reloaded elasticsearch aliases")
-
-
-def run_indexer(obj, ws_info, msg):
-    start = time.time()
-    batch_writes = []
-    for data in index_obj(obj, ws_info, msg):
-        action = data['_action']
-        if action == 'index':
-            batch_writes.append(data)
-            if len(batch_writes) >= config()['es_batch_writes']:
-                count = len(batch_writes)
-                _write_to_elastic(batch_writes)
-                logger.info(f'Indexing of {count} docs on ES took {time.time() - start}s')
-                start = time.time()
-                batch_writes = []
-        elif action == 'init_generic_index':
-            _init_generic_index(data)
-    if batch_writes:
-        count = len(batch_writes)
-        _write_to_elastic(batch_writes)
-        logger.info(f'Indexing of {count} docs on ES took {time.time() - start}s')
+    Make the aliases on elasticsearch match the global configuration file, by
+    adding missing indexes to them and removing indexes that are no longer
+    configured, in a single atomic request. Generic indexes are kept in the
+    default search alias.
+    """
+    group_aliases = config()['global'].get('aliases')
+    if not group_aliases:
+        return
+    resp = get_session('elasticsearch').get(f"{_ES_URL}/{_IDX}/_alias")
+    if not resp.ok:
+        raise RuntimeError(f"Error fetching aliases:\n{resp.text}")
+    current = {}  # type: dict
+    for (index_name, idx) in resp.json().items():
+        for alias in idx.get('aliases', {}):
+            current.setdefault(alias, set()).add(index_name)
+    default_search = f"{_PREFIX}.{_DEFAULT_SEARCH_ALIAS}"
+    actions = []
+    for (alias_name, names) in group_aliases.items():
+        alias = f"{_PREFIX}.{alias_name}"
+        desired = {f"{_PREFIX}.{name}" for name in names}
+        members = current.get(alias, set())
+        if alias == default_search:
+            # Added by _init_generic_index
+            desired.update(name for name in members if name.endswith('_0'))
+        for index_name in sorted(desired - members):
+            actions.append({'add': {'index': index_name, 'alias': alias}})
+        for index_name in sorted(members - desired):
+            actions.append({'remove': {'index': index_name, 'alias': alias}})
+    if not actions:
+        logger.info("Elasticsearch aliases are up to date")
+        return
+    resp = get_session('elasticsearch').post(
+        f"{_ES_URL}/_aliases", data=json.dumps({'actions': actions}), headers=_HEADERS)
+    if not resp.ok:
+        raise RuntimeError(f"Error updating aliases with actions {actions}:\n{resp.text}")
+    logger.info(f"Reloaded elasticsearch aliases with {len(actions)} changes")
+
+
+def run_indexer(obj, ws_info, msg, ctx=None, create_only=False):
+    """
+    Generate and save the documents for a workspace object. With create_only,
+    documents that already exist are left unchanged.
+    """
+    # Sends a bulk request whenever the configured doc count or byte size is reached,
+    # in the background while documents are still being generated
+    if create_only:
+        bulk = BulkBuffer(op_type='create')
+    else:
+        bulk = BulkBuffer(skip_unchanged=bool(config()['es_skip_unchanged']))
+    # The save time of the object version orders documents for the same object
+    version = external_version(obj['epoch']) if config()['es_external_versions'] else None
+    try:
+        for data in index_obj(obj, ws_info, msg, ctx):
+            action = data['_action']
+            if action == 'index':
+                data['version'] = version
+                bulk.add(data)
+            elif action == 'init_generic_index':
+                _init_generic_index(data)
+    except BaseException:
+        # Batches sent so far must not keep writing after the message is reported as failed
+        bulk.discard()
+        raise
+    # The last batch is sent along with the documents of the next messages
+    bulk.flush(get_sink())
 
 
 def delete_obj(msg):
     """
-    Checks that the received object is deleted, since the workspace object
-    delete event can refer to either delete or undelete state changes.
+    Delete the documents of an object once the buffered documents are written,
+    so that none of them are written after the delete.
     """
     wsid = msg['wsid']
     objid = msg['objid']
+    after_flush(('delete_obj', wsid, objid), functools.partial(_delete_obj, wsid, objid))
+
+
+def delete_ws(msg):
+    """
+    Delete everything under a workspace once the buffered documents are
+    written, so that none of them are written after the delete.
+    """
+    wsid = msg['wsid']
+    after_flush(('delete_ws', wsid), functools.partial(_delete_ws, wsid))
+
+
+def _delete_obj(wsid, objid):
+    """
+    Checks that the object is deleted, since the workspace object delete event
+    can refer to either delete or undelete state changes.
+    """
     if not check_object_deleted(wsid, objid):
         # Object is not deleted
         logger.info(f'Object {objid} in workspace {wsid} is not deleted')
@@ -102,44 +187,21 @@ def delete_obj(msg):
             ]
         }
     }
-    json_body = json.dumps({'query': query})
-    # Perform the delete_by_query using the elasticsearch http api.
-    resp = requests.post(
-        f"{_ES_URL}/{_IDX}/_delete_by_query",
-        params={'conflicts': 'proceed'},
-        data=json_body,
-        headers={"Content-Type": "application/json"}
-    )
-    if not resp.ok:
-        # Unsuccesful request to elasticsearch.
-        raise RuntimeError(f"Error deleting object on elasticsearch:\n{resp.text}")
-    logger.info(f"Deleted elasticsearch documents associated with obj {wsid}/{objid}")
+    # Runs in the background; see es_tasks
+    es_tasks.delete_by_query(_ws_indexes(), query, f"delete object {wsid}/{objid}", wsid, objid)
 
 
-def delete_ws(msg):
+def _delete_ws(wsid):
     """
-    Delete everything under a workspace.
-    First checks that the received workspace is deleted because the
-    delete event can refer to both delete or undelete state changes.
+    First checks that the workspace is deleted because the delete event can
+    refer to both delete or undelete state changes.
     """
-    # Verify that this workspace is actually deleted
-    wsid = msg['wsid']
     if not check_workspace_deleted(wsid):
         logger.info(f'Workspace {wsid} not deleted')
         return
     # Delete everything with the given workspace ID
     query = {'term': {'access_group': wsid}}
-    json_body = json.dumps({'query': query})
-    # Perform the delete_by_query using the elasticsearch http api.
-    resp = requests.post(
-        f"{_ES_URL}/{_IDX}/_delete_by_query",
-        params={'conflicts': 'proceed'},
-        data=json_body,
-        headers={"Content-Type": "application/json"}
-    )
-    if not resp.ok:
-        # Unsuccesful request to elasticsearch.
-        raise RuntimeError(f"Error deleting workspace on elasticsearch:\n{resp.text}")
+    es_tasks.delete_by_query(_ws_indexes(), query, f"delete workspace {wsid}", wsid)
 
 
 def set_perms(msg):
@@ -147,34 +209,65 @@ def set_perms(msg):
     Set the `is_public` field for a workspace. Handles the SET_GLOBAL_PERMISSION event.
     eg. this happens when making a narrative public.
     """
-    # Fetch the permission for the workspace
-    wsid = msg['wsid']
-    is_public = is_workspace_public(wsid)
-    is_public_str = 'true' if is_public else 'false'
-    _update_by_query(
-        {'term': {'access_group': wsid}},
-        f"ctx._source.is_public={is_public_str}",
-        config()
-    )
+    _queue_perms_update(int(msg['wsid']))
 
 
 def set_user_perms(msg):
     """
     Set user permissions for a workspace. Handles the SET_PERMISSION event.
-    This only updates the `shared_users` field for the workspace/narrative.
-    """
-    wsid = int(msg['wsid'])
-    perms = config()['ws_client'].admin_req('getPermissionsMass', {
-        'workspaces': [{"id": wsid}]
-    })
-    shared_users = perms['perms'][0].keys()
-    update = f"ctx._source.shared_users={list(shared_users)}"
-    resp = _update_by_query({'term': {'access_group': wsid}}, update, config())
+    """
+    _queue_perms_update(int(msg['wsid']))
+
+
+def update_perms(wsid):
+    """
+    Set both the `is_public` and `shared_users` fields of every document in a
+    workspace to its current permissions, with a single update by query.
+    """
+    # Permissions fetched earlier in the window may be out of date
+    invalidate_workspace(wsid)
+    ctx = RequestContext()
+    try:
+        params = {
+            'is_public': is_workspace_public(wsid, ctx),
+            'shared_users': get_shared_users(wsid, ctx),
+        }
+    except WorkspaceResponseError as err:
+        # Eg. the workspace has since been deleted; retrying would not help
+        logger.error(f"Unable to update permissions for workspace {wsid}: {err.resp_data}")
+        return None
+    _store_perms_script()
+    resp = _update_by_query({'term': {'access_group': wsid}}, {'id': _PERMS_SCRIPT_ID, 'params': params})
+    logger.info(f"Updated permissions for workspace {wsid}")
     return resp
 
 
 # -- Utils
 
+def _queue_perms_update(wsid):
+    """
+    Update a workspace's permissions after the buffered documents are written.
+    Every permission event for the workspace within the sink's flush interval
+    results in one update.
+    """
+    after_flush(('update_perms', wsid), functools.partial(update_perms, wsid))
+
+
+def _store_perms_script():
+    """Save the permissions script on Elasticsearch, once per process, so it is compiled once."""
+    global _PERMS_SCRIPT_STORED
+    if _PERMS_SCRIPT_STORED:
+        return
+    resp = get_session('elasticsearch').put(
+        f"{_ES_URL}/_scripts/{_PERMS_SCRIPT_ID}",
+        data=json.dumps({'script': {'lang': 'painless', 'source': _PERMS_SCRIPT}}),
+        headers=_HEADERS
+    )
+    if not resp.ok:
+        raise RuntimeError(f"Error storing script {_PERMS_SCRIPT_ID}:\n{resp.text}")
+    _PERMS_SCRIPT_STORED = True
+
+
 def _init_generic_index(msg):
     """
     Initialize an index from a workspace object indexed by the generic indexer.
@@ -185,66 +278,89 @@ def _init_generic_index(msg):
     """
     (_, type_name, type_ver) = get_type_pieces(msg['full_type_name'])
     index_name = type_name.lower() + '_0'
-    mappings = {**_GLOBAL_MAPPINGS['ws_auth'], **_GLOBAL_MAPPINGS['ws_object']}
-    _init_index(index_name, mappings)
-    # Update the 'default_search' alias to include this index
-    _create_alias(f"{_PREFIX}.{_DEFAULT_SEARCH_ALIAS}", f"{_PREFIX}.{index_name}")
+    known = _GENERIC_INDEXES
+    if known is not None and index_name in known:
+        return
+    # Only one thread initializes an index; the others wait and then skip it
+    with _GENERIC_INDEXES_LOCK:
+        known = load_generic_indexes()
+        if index_name in known:
+            return
+        mappings = {
+            **_GLOBAL_MAPPINGS['ws_auth'],
+            **_GLOBAL_MAPPINGS['ws_object'],
+            **_GLOBAL_MAPPINGS.get('all', {}),
+        }
+        _init_index(index_name, mappings)
+        # Update the 'default_search' alias to include this index
+        _create_alias(f"{_PREFIX}.{_DEFAULT_SEARCH_ALIAS}", f"{_PREFIX}.{index_name}")
+        known.add(index_name)
 
 
-def _write_to_elastic(data):
+def load_generic_indexes():
     """
-    Bulk save a list of documents to an index.
+    Get the set of initialized generic index names (without the prefix),
+    fetching it on first use from the members of the default search alias.
+    """
+    global _GENERIC_INDEXES
+    with _GENERIC_INDEXES_LOCK:
+        if _GENERIC_INDEXES is not None:
+            return _GENERIC_INDEXES
+        alias = f"{_PREFIX}.{_DEFAULT_SEARCH_ALIAS}"
+        resp = get_session('elasticsearch').get(
+            f"{_ES_URL}/_cat/aliases/{alias}", params={'format': 'json', 'h': 'index'})
+        if not resp.ok:
+            raise RuntimeError(f"Error listing indexes of alias {alias}:\n{resp.text}")
+        names = {row['index'][len(_PREFIX) + 1:] for row in resp.json()}
+        _GENERIC_INDEXES = {name for name in names if name.endswith('_0')}
+        logger.info(f"Found {len(_GENERIC_INDEXES)} generic indexes")
+        return _GENERIC_INDEXES
+
+
+def _write_to_elastic(data, defer=False, create_only=False):
+    """
+    Bulk save a list of documents to an index, in order.
     Each entry in the list has {doc, id, index}
         doc - document data (for indexing events)
         id - document id
         index - index name
-        delete - bool (for delete events)
-    """
-    # Construct the post body for the bulk index
-    json_body = ''
-    while data:
-        datum = data.pop()
-        idx = f"{_PREFIX}.{datum['index']}"
-        json_body += json.dumps({
-            'index': {
-                '_index': idx,
-                '_id': datum['id']
-            }
-        })
-        json_body += '\n'
-        doc = _global_doc_defaults(datum['doc'])
-        json_body += json.dumps(doc)
-        json_body += '\n'
-    # Save the documents using the elasticsearch http api
-    resp = requests.post(f"{_ES_URL}/_bulk", data=json_body, headers={"Content-Type": "application/json"})
-    if not resp.ok:
-        # Unsuccessful save to elasticsearch.
-        raise RuntimeError(f"Error saving to elasticsearch:\n{resp.text}")
+        version - optional external version; see es_bulk.encode_action
+    If defer is set, the documents may be buffered and sent along with those
+    of later messages (see es_bulk.get_sink). With create_only, documents that
+    already exist are left unchanged.
+    """
+    bulk = BulkBuffer(op_type='create' if create_only else 'index')
+    for datum in data:
+        bulk.add(datum)
+    bulk.flush(get_sink() if defer else None)
 
 
-def _global_doc_defaults(doc: dict):
+def _ws_indexes():
     """
-    Set defaults in any doc we save to elasticsearch
-    Args:
-        doc - data we are saving to elastic
-    Mutates doc
+    Prefixed names of the indexes that can hold workspace documents: the latest
+    version of every configured index and sub-object index, plus the generic
+    indexes. The message log and error indexes are left out.
     """
-    doc['index_runner_ver'] = config()['app_version']
-    return doc
+    logs = {config()['error_index_name'], config()['msg_log_index_name']}
+    latest = config()['global']['latest_versions']
+    names = {name for (alias, name) in latest.items() if alias not in logs and name not in logs}
+    names.update(config()['global']['ws_subobjects'])
+    return [f"{_PREFIX}.{name}" for name in sorted(names)] + [f"{_PREFIX}.*_0"]
 
 
-def _update_by_query(query, script, config):
-    url = f"{_ES_URL}/{_IDX}/_update_by_query"
-    resp = requests.post(
+def _update_by_query(query, script):
+    url = f"{_ES_URL}/{','.join(_ws_indexes())}/_update_by_query"
+    resp = get_session('elasticsearch').post(
         url,
         params={
             'conflicts': 'proceed',
             'wait_for_completion': 'true',
-            'refresh': 'true',
+            'ignore_unavailable': 'true',
+            'allow_no_indices': 'true',
         },
         data=json.dumps({
             'query': query,
-            'script': {'inline': script, 'lang': 'painless'}
+            'script': script
         }),
         headers={'Content-Type': 'application/json'}
     )
@@ -260,15 +376,15 @@ def _create_alias(alias_name, index_names):
     """
     body = {'actions': [{'add': {'indices': index_names, 'alias': alias_name}}]}
     url = _ES_URL + '/_aliases'
-    resp = requests.post(url, data=json.dumps(body), headers=_HEADERS)
+    resp = get_session('elasticsearch').post(url, data=json.dumps(body), headers=_HEADERS)
     if not resp.ok:
         raise RuntimeError(f"Error creating alias '{alias_name}':\n{resp.text}")
     return Status.CREATED
 
 
-def _create_index(index_name):
+def _create_index(index_name, mappings=None):
     """
-    Create an index on Elasticsearch with a given name.
+    Create an index on Elasticsearch with a given name, and optionally its mappings.
     """
     request_body = {
         "settings": {
@@ -277,9 +393,11 @@ def _create_index(index_name):
                 "number_of_replicas": config()['generic_replica_count'],
             }
         }
-    }
+    }  # type: dict
+    if mappings is not None:
+        request_body['mappings'] = mappings
     url = _ES_URL + '/' + index_name
-    resp = requests.put(url, data=json.dumps(request_body), headers=_HEADERS)
+    resp = get_session('elasticsearch').put(url, data=json.dumps(request_body), headers=_HEADERS)
     if not resp.ok:
         err_type = resp.json()['error']['type']
         if err_type == 'resource_already_exists_exception':
@@ -290,14 +408,18 @@ def _create_index(index_name):
         return Status.CREATED  # created
 
 
-def _put_mapping(index_name, mapping):
+def _put_mapping(index_name, mapping, meta=None):
     """
-    Create or update the type mapping for a given index.
+    Create or update the type mapping for a given index, and optionally
+    replace its metadata.
     """
     url = f"{_ES_URL}/{index_name}/_mapping"
-    resp = requests.put(
+    body = {'properties': mapping}  # type: dict
+    if meta is not None:
+        body['_meta'] = meta
+    resp = get_session('elasticsearch').put(
         url,
-        data=json.dumps({'properties': mapping}),
+        data=json.dumps(body),
         headers=_HEADERS
     )
     if not resp.ok:
@@ -1,16 +1,13 @@
 # KBaseMetagenomes.AnnotatedMetagenomeAssembly indexer
-from src.index_runner.es_indexers.indexer_utils import mean, handle_id_to_file
+from src.index_runner.es_indexers.indexer_utils import mean, iter_json_array
 from src.utils.config import config
+from src.utils.shock import open_handle_stream
 
-import tempfile
-import json
 import gzip
-import shutil
-import os
 
 
-def _index_ama(features_file_gz_path, data, ama_id, ver_ama_id, tmp_dir, conf):
-    """"""
+def _index_ama(features_file_gz, data, ama_id, ver_ama_id, conf):
+    """features_file_gz is the path or binary file object of the gzipped features JSON."""
     publication_titles = [pub[2] for pub in data.get('publications', [])]
     publication_authors = [pub[5] for pub in data.get('publications', [])]
     ama_index = {
@@ -50,60 +47,56 @@ def _index_ama(features_file_gz_path, data, ama_id, ver_ama_id, tmp_dir, conf):
         # Indexing of AMA features is turned off in the env
         return
 
-    # unzip gzip file.
-    features_file_path = os.path.join(tmp_dir, ver_ama_id.replace(':', "_") + ".json")
-    with gzip.open(features_file_gz_path, "rb") as f_in:
-        with open(features_file_path, "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    # Features are parsed one at a time as the file is decompressed, as there can be millions
+    with gzip.open(features_file_gz, "rt", encoding="utf-8") as fd:
+        for feat in iter_json_array(fd):
+            yield _feature_doc(feat, data, ver_ama_id, conf)
 
-    with open(features_file_path) as f:
-        features = json.load(f)
 
-    for feat in features:
-        id_ = feat.get('id')
-        ver_feat_id = ver_ama_id + f"::ama_ft::{id_}"
-        # calculate gc content for each feature.
-        # if feat.get('dna_sequence'):
-        #     dna_seq = feat.get('dna_sequence')
-        #     feat_gc_content = ((float(dna_seq.lower().count('c')) + float(dna_seq.lower().count('g'))) / len(dna_seq))
+def _feature_doc(feat, data, ver_ama_id, conf):
+    """Document for a single feature of an AnnotatedMetagenomeAssembly."""
+    id_ = feat.get('id')
+    ver_feat_id = ver_ama_id + f"::ama_ft::{id_}"
+    # calculate gc content for each feature.
+    # if feat.get('dna_sequence'):
+    #     dna_seq = feat.get('dna_sequence')
+    #     feat_gc_content = ((float(dna_seq.lower().count('c')) + float(dna_seq.lower().count('g'))) / len(dna_seq))
 
-        if feat.get('location'):
-            contig_ids, starts, strands, stops = zip(*feat.get('location'))
-            contig_ids, starts, strands, stops = list(contig_ids), list(starts), list(strands), list(stops)
-        else:
-            contig_ids, starts, strands, stops = None, None, None, None
+    if feat.get('location'):
+        contig_ids, starts, strands, stops = zip(*feat.get('location'))
+        contig_ids, starts, strands, stops = list(contig_ids), list(starts), list(strands), list(stops)
+    else:
+        contig_ids, starts, strands, stops = None, None, None, None
 
-        ver_feat_index = {
-            '_action': 'index',
-            'doc': {
-                'id': id_,
-                'type': feat.get('type'),
-                'size': feat.get('dna_sequence_length'),
-                'starts': starts,
-                'strands': strands,
-                'stops': stops,
-                'contig_ids': contig_ids,
-                'functions': feat.get('functions'),
-                'functional_descriptions': feat.get('functional_descriptions'),
-                'warnings': feat.get('warnings'),
-                'parent_gene': feat.get('parent_gene'),
-                'inference_data': feat.get('inference_data'),
-                'dna_sequence': feat.get('dna_sequence'),
-                # 'aliases': feat.get('aliases'),
-                # 'gc_content': feat_gc_content,
-                # Parent ids below
-                'parent_id': ver_ama_id,
-                'annotated_metagenome_assembly_size': data.get('dna_size'),
-                'annotated_metagenome_assembly_num_features': data.get('num_features'),
-                'annotated_metagenome_assembly_num_contigs': data.get('num_contigs'),
-                'annotated_metagenome_assembly_gc_content': data.get('gc_content')
-            },
-            'index': conf['ver_features_index_name'],
-            'id': ver_feat_id,
-        }
-        yield ver_feat_index
-    # remove unzipped file
-    os.remove(features_file_path)
+    ver_feat_index = {
+        '_action': 'index',
+        'doc': {
+            'id': id_,
+            'type': feat.get('type'),
+            'size': feat.get('dna_sequence_length'),
+            'starts': starts,
+            'strands': strands,
+            'stops': stops,
+            'contig_ids': contig_ids,
+            'functions': feat.get('functions'),
+            'functional_descriptions': feat.get('functional_descriptions'),
+            'warnings': feat.get('warnings'),
+            'parent_gene': feat.get('parent_gene'),
+            'inference_data': feat.get('inference_data'),
+            'dna_sequence': feat.get('dna_sequence'),
+            # 'aliases': feat.get('aliases'),
+            # 'gc_content': feat_gc_content,
+            # Parent ids below
+            'parent_id': ver_ama_id,
+            'annotated_metagenome_assembly_size': data.get('dna_size'),
+            'annotated_metagenome_assembly_num_features': data.get('num_features'),
+            'annotated_metagenome_assembly_num_contigs': data.get('num_contigs'),
+            'annotated_metagenome_assembly_gc_content': data.get('gc_content')
+        },
+        'index': conf['ver_features_index_name'],
+        'id': ver_feat_id,
+    }
+    return ver_feat_index
 
 
 def main(obj_data, ws_info, obj_data_v1, conf):
@@ -127,13 +120,7 @@ def main(obj_data, ws_info, obj_data_v1, conf):
                         " field. Can not index features to ElasticSearch.")
 
     features_handle_ref = data.get('features_handle_ref')
-    try:
-        # Download features file
-        tmp_dir = tempfile.mkdtemp()
-        features_file_gz_path = os.path.join(tmp_dir, ver_ama_id.replace(':', "_") + ".json.gz")
-        handle_id_to_file(features_handle_ref, features_file_gz_path)
-
-        for doc in _index_ama(features_file_gz_path, data, ama_id, ver_ama_id, tmp_dir, conf):
+    # The features are indexed while the file is still downloading
+    with open_handle_stream(features_handle_ref) as features_file_gz:
+        for doc in _index_ama(features_file_gz, data, ama_id, ver_ama_id, conf):
             yield doc
-    finally:
-        shutil.rmtree(tmp_dir)
@@ -2,12 +2,12 @@ from configparser import ConfigParser
 import docker
 import json
 import os
-import requests
 import shutil
 import uuid
 
 from src.utils import ws_utils
 from src.utils.config import config
+from src.utils.http_session import get_session
 from src.utils.logger import logger
 
 _DOCKER = docker.from_env()
@@ -32,7 +32,7 @@ def _get_docker_image_name(sdk_app, module_version=None):
     }
     if module_version is not None:
         params['params'][0]['version'] = module_version  # type: ignore
-    resp = requests.post(url=catalog_service_url, data=json.dumps(params))
+    resp = get_session('catalog').post(url=catalog_service_url, data=json.dumps(params))
     try:
         json_resp = resp.json()
     except Exception:
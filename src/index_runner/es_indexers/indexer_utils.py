@@ -1,11 +1,17 @@
 from kbase_workspace_client.exceptions import WorkspaceResponseError
+import json
 import logging
 
 from src.utils.config import config
 from src.utils.logger import logger
+from src.utils.request_context import RequestContext
 from src.utils.ws_utils import get_type_pieces, log_error
 
 _REF_DATA_WORKSPACES = []  # type: list
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = ' \t\n\r'
+# Characters that continue a number after a prefix that is already a valid number
+_JSON_NUMBER_TAIL = '.eE+-'
 
 
 def check_object_deleted(ws_id, obj_id):
@@ -26,11 +32,12 @@ def check_object_deleted(ws_id, obj_id):
     return obj_id not in obj_ids
 
 
-def is_workspace_public(ws_id):
+def is_workspace_public(ws_id, ctx=None):
     """
     Check if a workspace is public, returning bool.
     """
-    ws_info = config()['ws_client'].admin_req('getWorkspaceInfo', {'id': ws_id})
+    ctx = ctx or RequestContext()
+    ws_info = ctx.get_ws_info(ws_id)
     global_read = ws_info[6]
     return global_read != 'n'
 
@@ -51,16 +58,16 @@ def check_workspace_deleted(ws_id):
     return False
 
 
-def get_shared_users(ws_id):
+def get_shared_users(ws_id, ctx=None):
     """
     Get the list of users that have read, write, or author access to a workspace object.
     Args:
         ws_id - workspace id of requested workspace object
+        ctx - RequestContext for the current event, if any
     """
+    ctx = ctx or RequestContext()
     try:
-        obj_perm = config()['ws_client'].admin_req("getPermissionsMass", {
-            'workspaces': [{'id': ws_id}]
-        })['perms'][0]
+        obj_perm = ctx.get_permissions(ws_id)
     except WorkspaceResponseError as err:
         logger.error("Workspace response error: ", err.resp_data)
         raise err
@@ -115,6 +122,33 @@ def merge_default_fields(indexer_ret, defaults):
     return indexer_ret
 
 
+def prune_fields(doc, rules):
+    """
+    Remove and shorten fields of an index document in place, following the
+    `field_pruning` rules for its index in the global config:
+        include - only keep these fields
+        exclude - remove these fields
+        max_string_length - truncate longer strings, including those in lists
+    Returns the approximate number of bytes removed from the encoded document.
+    """
+    saved = 0
+    include = rules.get('include')
+    exclude = set(rules.get('exclude') or [])
+    for key in list(doc):
+        if (include is not None and key not in include) or key in exclude:
+            saved += len(key) + len(json.dumps(doc.pop(key))) + 4
+    max_len = rules.get('max_string_length')
+    if max_len is not None:
+        for (key, val) in doc.items():
+            if isinstance(val, str) and len(val) > max_len:
+                saved += len(val) - max_len
+                doc[key] = val[:max_len]
+            elif isinstance(val, list) and any(isinstance(v, str) and len(v) > max_len for v in val):
+                saved += sum(len(v) - max_len for v in val if isinstance(v, str) and len(v) > max_len)
+                doc[key] = [v[:max_len] if isinstance(v, str) else v for v in val]
+    return saved
+
+
 def _remove_dupes(ls: list) -> list:
     """Remove duplicate values from a list."""
     try:
@@ -129,7 +163,7 @@ def _remove_dupes(ls: list) -> list:
         return ret
 
 
-def default_fields(obj_data, ws_info, obj_data_v1):
+def default_fields(obj_data, ws_info, obj_data_v1, ctx=None):
     """
     Produce data for fields that are present in any workspace object document on elasticsearch.
     """
@@ -138,7 +172,7 @@ def default_fields(obj_data, ws_info, obj_data_v1):
     version = obj_data['info'][4]
     v1_info = obj_data_v1['info']
     is_public = ws_info[6] == 'r'
-    shared_users = get_shared_users(ws_id)
+    shared_users = get_shared_users(ws_id, ctx)
     copy_ref = obj_data.get('copied')
     obj_type = obj_data['info'][2]
     (type_module, type_name, type_version) = get_type_pieces(obj_type)
@@ -161,12 +195,6 @@ def default_fields(obj_data, ws_info, obj_data_v1):
     }
 
 
-def handle_id_to_file(handle_id, dest_path):
-    """given handle id, download associated file from shock."""
-    shock_id = config()['ws_client'].handle_to_shock(handle_id)
-    config()['ws_client'].download_shock_file(shock_id, dest_path)
-
-
 def mean(array):
     """
     get mean of list, returns None if length is less than 1
@@ -174,3 +202,60 @@ def mean(array):
     if not array:
         return None
     return float(sum(array))/float(len(array))
+
+
+def iter_json_array(fd, chunk_size=1024 * 1024):
+    """
+    Parse the elements of a top-level JSON array from a text file object one at
+    a time, reading `chunk_size` characters at a time. Only the current element
+    and the unparsed part of the last chunk are held in memory.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        # Drop the parsed text and read more; reads grow with the element being parsed
+        nonlocal buf, pos, eof
+        chunk = fd.read(max(chunk_size, len(buf) - pos))
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+
+    def next_char():
+        # Skip whitespace and return the next character, or '' at the end of the file
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _JSON_WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            fill()
+
+    if next_char() != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    if next_char() == ']':
+        return
+    while True:
+        next_char()
+        try:
+            (item, end) = _JSON_DECODER.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The element continues in the next chunk
+            fill()
+            continue
+        if not eof and isinstance(item, (int, float)) and (end == len(buf) or buf[end] in _JSON_NUMBER_TAIL):
+            # A number at the end of the chunk may have more digits, a fraction or an exponent
+            fill()
+            continue
+        pos = end
+        yield item
+        sep = next_char()
+        if sep == ']':
+            return
+        if sep != ',':
+            raise ValueError(f"Expected ',' or ']' in JSON array, found {sep!r}")
+        pos += 1
@@ -10,6 +10,7 @@ from src.utils import ws_utils
 from src.utils.config import config
 from src.utils.get_upa_from_msg import get_upa_from_msg_data
 from src.utils.logger import logger
+from src.utils.request_context import RequestContext
 from src.utils.get_es_module import get_es_module, ModuleNotFound
 
 # Load the configuration mapping workspace types to indexer modules
@@ -17,7 +18,7 @@ with open('spec/elasticsearch_modules.yaml') as fd:
     es_modules = yaml.safe_load(fd)
 
 
-def index_obj(obj_data, ws_info, msg_data):
+def index_obj(obj_data, ws_info, msg_data, ctx=None):
     """
     For a newly created object, generate the index document for it and push to
     the elasticsearch topic on Kafka.
@@ -25,7 +26,9 @@ def index_obj(obj_data, ws_info, msg_data):
         obj_data - in-memory parsed data from the workspace object
         msg_data - json event data received from the kafka workspace events
             stream. Must have keys for `wsid` and `objid`
+        ctx - RequestContext for the current event, if any
     """
+    ctx = ctx or RequestContext()
     obj_type = obj_data['info'][2]
     (type_module, type_name, type_version) = ws_utils.get_type_pieces(obj_type)
     if (type_module + '.' + type_name) in config()['global']['ws_type_blacklist']:
@@ -39,19 +42,21 @@ def index_obj(obj_data, ws_info, msg_data):
             return
     # Get the info of the first object to get the creation date of the object.
     upa = get_upa_from_msg_data(msg_data)
-    try:
-        obj_data_v1 = config()['ws_client'].admin_req('getObjects', {
-            'objects': [{'ref': upa + '/1'}],
-            'no_data': 1
-        })
-    except WorkspaceResponseError as err:
-        ws_utils.log_error(err)
-        raise err
-    obj_data_v1 = obj_data_v1['data'][0]
+    if obj_data['info'][4] == 1:
+        # We already have the first version
+        obj_data_v1 = {'info': obj_data['info']}
+    else:
+        try:
+            obj_data_v1 = ctx.get_obj_v1(upa)
+        except WorkspaceResponseError as err:
+            ws_utils.log_error(err)
+            raise err
     # Dispatch to a specific type handler to produce the search document
     (indexer, conf) = _find_indexer(type_module, type_name, type_version)
     # All indexers are generators that yield document data for ES.
-    defaults = indexer_utils.default_fields(obj_data, ws_info, obj_data_v1)
+    defaults = indexer_utils.default_fields(obj_data, ws_info, obj_data_v1, ctx)
+    pruning = config()['global'].get('field_pruning') or {}
+    pruned_bytes = 0
     for indexer_ret in indexer(obj_data, ws_info, obj_data_v1, conf):
         if indexer_ret['_action'] == 'index':
             allow_indices = config()['allow_indices']
@@ -64,10 +69,15 @@ def index_obj(obj_data, ws_info, msg_data):
                 # This index name is in the indexing blacklist in the config, so we skip
                 logger.debug(f"Index '{indexer_ret['index']}' is in SKIP_INDICES, skipping")
                 continue
+            if indexer_ret.get('index') in pruning:
+                # Pruned before the default fields are merged in, so those are always kept
+                pruned_bytes += indexer_utils.prune_fields(indexer_ret['doc'], pruning[indexer_ret['index']])
             if '_no_defaults' not in indexer_ret:
                 # Inject all default fields into the index document.
                 indexer_ret = indexer_utils.merge_default_fields(indexer_ret, defaults)
         yield indexer_ret
+    if pruned_bytes:
+        logger.info(f"Field pruning removed about {pruned_bytes} bytes from the documents for {upa}")
 
 
 def _find_indexer(type_module, type_name, type_version):
@@ -103,10 +113,10 @@ def generic_indexer():
         obj_type_name = ws_utils.get_type_pieces(obj_type)[1]
         yield {
             '_action': 'index',
-            'doc': indexer_utils.default_fields(obj_data, ws_info, obj_data_v1),
+            # The document is only the default fields, which index_obj merges in
+            'doc': {},
             'index': obj_type_name.lower() + "_0",
             'id': f"WS::{workspace_id}:{object_id}",
-            'no_defaults': True,
             # 'namespace': "WS"
         }
     return fn
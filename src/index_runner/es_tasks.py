@@ -0,0 +1,204 @@
+"""
+Asynchronous Elasticsearch delete_by_query requests, tracked until they finish.
+
+A delete can take minutes for a big workspace, so it is submitted with
+`wait_for_completion=false` and the returned task ID is saved, along with the
+request, in a local SQLite registry. A background poller (see start_poller)
+checks each task; finished tasks are removed from the registry, and tasks that
+failed or were lost (eg. the Elasticsearch node restarted) are submitted
+again, up to `es_task_max_attempts` times, as long as the object or workspace
+is still deleted. Saved tasks survive restarts of the indexer.
+"""
+from typing import List, Optional
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from src.index_runner.es_bulk import encode_action, send_bulk
+from src.index_runner.es_indexers.indexer_utils import check_object_deleted, check_workspace_deleted
+from src.utils.config import config
+from src.utils.http_session import get_session
+from src.utils.logger import logger
+
+_ES_URL = config()['elasticsearch_url']
+_HEADERS = {"Content-Type": "application/json"}
+# Request parameters for every delete
+_DELETE_PARAMS = {
+    'conflicts': 'proceed',
+    'wait_for_completion': 'false',
+    'ignore_unavailable': 'true',
+    'allow_no_indices': 'true',
+}
+
+_LOCK = threading.Lock()
+_CONN = None  # type: Optional[sqlite3.Connection]
+_POLLER = None  # type: Optional[threading.Thread]
+
+
+def delete_by_query(indexes: List[str], query: dict, description: str,
+                    wsid: int, objid: Optional[int] = None) -> str:
+    """
+    Submit a delete_by_query request on the given (prefixed) index names and
+    save it in the registry. Returns the task ID once Elasticsearch has
+    accepted the request. The workspace ID, and object ID for an object
+    delete, are used to check that the delete still applies before it is
+    submitted again.
+    """
+    path = ','.join(indexes)
+    body = json.dumps({'query': query})
+    task_id = _submit(path, body)
+    _insert(task_id, path, body, description, 1, wsid, objid)
+    logger.info(f"Submitted delete task {task_id}: {description}")
+    return task_id
+
+
+def pending_tasks() -> list:
+    """Rows of (task_id, path, body, description, attempts, wsid, objid) for every unfinished task."""
+    return _execute('SELECT task_id, path, body, description, attempts, wsid, objid FROM tasks ORDER BY submitted')
+
+
+def poll() -> None:
+    """Check every saved task once, removing finished ones and resubmitting failed ones."""
+    for (task_id, path, body, description, attempts, wsid, objid) in pending_tasks():
+        resp = get_session('elasticsearch').get(f"{_ES_URL}/_tasks/{task_id}")
+        if resp.status_code == 404:
+            error = 'task not found'
+        elif not resp.ok:
+            logger.warning(f"Unable to check delete task {task_id}:\n{resp.text}")
+            continue
+        else:
+            result = resp.json()
+            if not result.get('completed'):
+                continue
+            error = result.get('error') or (result.get('response') or {}).get('failures')
+            if not error:
+                _execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+                logger.info(f"Finished delete task {task_id}: {description}")
+                continue
+        logger.error(f"Delete task {task_id} failed after {attempts} attempts ({description}): {error}")
+        _resubmit(task_id, path, body, description, attempts, wsid, objid, error)
+
+
+def start_poller(interval: float) -> None:
+    """Poll the saved tasks every `interval` seconds in a daemon thread."""
+    global _POLLER
+    if _POLLER is not None and _POLLER.is_alive():
+        return
+
+    def run():
+        while True:
+            try:
+                poll()
+            except Exception as err:
+                logger.error(f'Unable to poll delete tasks: {err}')
+            time.sleep(interval)
+    _POLLER = threading.Thread(target=run, name='es-task-poller', daemon=True)
+    _POLLER.start()
+
+
+def _resubmit(task_id: str, path: str, body: str, description: str, attempts: int,
+              wsid: Optional[int], objid: Optional[int], error) -> None:
+    # Another process sharing the registry may have got to this task first
+    with _LOCK:
+        conn = _get_conn()
+        claimed = conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,)).rowcount
+        conn.commit()
+    if not claimed:
+        return
+    if attempts >= config()['es_task_max_attempts']:
+        _log_exhausted(description, attempts, wsid, objid, error)
+        return
+    try:
+        # An undelete since the first attempt means the documents may have been indexed again
+        if not _still_deleted(wsid, objid):
+            logger.info(f"Not resubmitting delete task {task_id}, as it was undeleted: {description}")
+            return
+        new_id = _submit(path, body)
+    except Exception:
+        # Keep the task so that the next poll tries again
+        _insert(task_id, path, body, description, attempts, wsid, objid)
+        raise
+    _insert(new_id, path, body, description, attempts + 1, wsid, objid)
+    logger.info(f"Resubmitted delete task {task_id} as {new_id}")
+
+
+def _still_deleted(wsid: Optional[int], objid: Optional[int]) -> bool:
+    if wsid is None:
+        # Saved before workspace IDs were recorded
+        return True
+    if objid is None:
+        return check_workspace_deleted(wsid)
+    return check_object_deleted(wsid, objid)
+
+
+def _log_exhausted(description: str, attempts: int, wsid: Optional[int], objid: Optional[int], error) -> None:
+    """Save a delete that kept failing to the error index."""
+    logger.error(f"Giving up on delete after {attempts} attempts ({description}): {error}")
+    msg = f"Delete failed after {attempts} attempts ({description}): {json.dumps(error)}"
+    resp = send_bulk(encode_action({
+        'index': config()['error_index_name'],
+        'id': hashlib.blake2b(description.encode('utf-8')).hexdigest(),
+        'doc': {'error': msg, 'evtype': 'DELETE_TASK_ERROR', 'wsid': wsid, 'objid': objid},
+    }))
+    if resp.get('errors'):
+        logger.error(f"Unable to save delete error to elasticsearch: {resp['items']}")
+
+
+def _insert(task_id: str, path: str, body: str, description: str, attempts: int,
+            wsid: Optional[int], objid: Optional[int]) -> None:
+    _execute(
+        'INSERT INTO tasks (task_id, path, body, description, attempts, submitted, wsid, objid) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (task_id, path, body, description, attempts, time.time(), wsid, objid)
+    )
+
+
+def _submit(path: str, body: str) -> str:
+    resp = get_session('elasticsearch').post(
+        f"{_ES_URL}/{path}/_delete_by_query",
+        params=_DELETE_PARAMS,
+        data=body,
+        headers=_HEADERS
+    )
+    if not resp.ok:
+        # Unsuccesful request to elasticsearch.
+        raise RuntimeError(f"Error submitting delete_by_query on elasticsearch:\n{resp.text}")
+    return resp.json()['task']
+
+
+def _execute(sql: str, params: tuple = ()) -> list:
+    with _LOCK:
+        conn = _get_conn()
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+    return rows
+
+
+def _get_conn() -> sqlite3.Connection:
+    """Open the registry on first use. Call with _LOCK held."""
+    global _CONN
+    if _CONN is None:
+        path = config()['es_task_registry_path']
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        logger.info(f'Using delete task registry at {path}')
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'task_id TEXT PRIMARY KEY, path TEXT NOT NULL, body TEXT NOT NULL, description TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL, submitted REAL NOT NULL, wsid INTEGER, objid INTEGER)'
+        )
+        # Registries created before wsid and objid were recorded
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(tasks)')}
+        for column in ('wsid', 'objid'):
+            if column not in columns:
+                # Another process may be adding it at the same time
+                with contextlib.suppress(sqlite3.OperationalError):
+                    conn.execute(f'ALTER TABLE tasks ADD COLUMN {column} INTEGER')
+        conn.commit()
+        _CONN = conn
+    return _CONN
@@ -1,17 +1,27 @@
 '''
 The event loop for the index runner.
 '''
-from confluent_kafka import Consumer, KafkaError
-from typing import Callable, Dict, Any
+from confluent_kafka import Consumer, KafkaError, TopicPartition
+from typing import Callable, Dict, Any, Hashable, List, Optional, Tuple
+import functools
 import json
 import time
 import traceback
 
+from src.index_runner.coalesce import coalesce_groups
+from src.index_runner.worker_pool import KeyedWorkerPool, OffsetTracker, TopicPart
 from src.utils.config import config
 from src.utils.logger import logger
+import src.index_runner.es_bulk as es_bulk
+import src.utils.kafka as kafka
 
 Message = Dict[str, Any]
 
+# How many messages may be in flight per worker thread before we stop polling
+_IN_FLIGHT_PER_WORKER = 4
+# Seconds to wait before trying to send buffered documents again, doubled for each failure
+_FLUSH_RETRY_DELAY = 1.0
+
 # TODO TEST unit tests
 
 
@@ -22,69 +32,339 @@ def start_loop(
         on_failure: Callable[[Message, Exception], None] = lambda msg, e: None,
         on_config_update: Callable[[], None] = lambda: None,
         return_on_empty: bool = False,
-        timeout: float = 0.5):
+        timeout: float = 0.5,
+        worker_count: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        topics: Optional[List[str]] = None):
     """
     Run the indexer event loop.
 
     Args:
         consumer: A Kafka consumer which will be polled for messages.
         message_handler: a processor for messages from Kafka.
-        on_success: called after message_handler has returned sucessfully and the message
-            offset has been committed to Kafka. A noop by default.
+        on_success: called after message_handler has returned sucessfully, before the
+            message offset is committed to Kafka. A noop by default.
         on_failure: called if the message_handler, the Kafka commit, or on_success throws an
             exception. A noop by default.
         on_config_update: called when the configuration has been updated.
         logger: a logger to use for logging events. By default a standard logger for 'IR'.
         return_on_empty: stop the loop when we receive an empty message. Helps with testing.
         timeout: how long to wait polling for the next message
+        worker_count: number of messages to handle concurrently. Defaults to the
+            `worker_count` configuration (WORKER_COUNT env var). When greater than 1,
+            see _start_concurrent_loop.
+        batch_size: maximum number of messages to consume and coalesce at once. Defaults
+            to the `batch_size` configuration (BATCH_SIZE env var). When greater than 1,
+            see _start_batch_loop.
+        topics: the topics the consumer is subscribed to. The concurrent loop
+            subscribes to them again, to be told when partitions are revoked.
+
+    Offsets are committed once the documents buffered for the handled messages
+    have been sent to Elasticsearch (see es_bulk.get_sink), which is whenever
+    the buffer is full or old enough.
     """
-    # Used for re-fetching the configuration with a throttle
-    last_updated_minute = int(time.time() / 60)
+    if worker_count is None:
+        worker_count = config()['worker_count']
+    if batch_size is None:
+        batch_size = config()['batch_size']
+    if batch_size > 1:
+        _start_batch_loop(consumer, message_handler, on_success, on_failure,
+                          return_on_empty, timeout, worker_count, batch_size)
+        return
+    if worker_count > 1:
+        _start_concurrent_loop(consumer, message_handler, on_success, on_failure,
+                               return_on_empty, timeout, worker_count, topics)
+        return
     # Failure count for the current offset
     fail_count = 0
+    # The last handled message, if its offset has not been committed
+    pending = None
     while True:
         msg = consumer.poll(timeout=timeout)
         if msg is None:
+            if pending is not None and (return_on_empty or es_bulk.sink_due()):
+                _commit(consumer, pending)
+                pending = None
             if return_on_empty:
                 return
             continue
-        curr_min = int(time.time() / 60)
-        if curr_min > last_updated_minute:
-            # Reload the configuration
-            config(force_reload=True)
-            last_updated_minute = curr_min
         if msg.error():
-            if msg.error().code() == KafkaError._PARTITION_EOF:
-                logger.info('End of stream.')
-            else:
-                logger.error(f"Kafka message error: {msg.error()}")
+            _log_msg_error(msg)
             continue
-        val = msg.value().decode('utf-8')
-        try:
-            val_json = json.loads(val)
-        except ValueError as err:
-            logger.error(f'JSON parsing error: {err}')
-            logger.error(f'Message content: {val}')
-            consumer.commit(msg)
+        val_json = _decode(msg)
+        if val_json is None:
+            _commit(consumer, msg)
+            pending = None
             continue
-        logger.info(f'Received event: {val_json}')
+        start = time.time()
+        # Every lookup while handling this message sees the same configuration
+        with config().snapshot():
+            try:
+                message_handler(val_json)
+            except Exception as err:
+                logger.error(f'Error processing message: {err.__class__.__name__} {err}')
+                logger.error(traceback.format_exc())
+                # Save this error and message to a topic in Elasticsearch
+                on_failure(val_json, err)
+                fail_count += 1
+                logger.info(f"We've had {fail_count} failures so far")
+                if fail_count >= config()['max_handler_failures']:
+                    logger.info(f"Reached max failure count of {fail_count}. Moving on.")
+                    _commit(consumer, msg)
+                    pending = None
+                    fail_count = 0
+                continue
+            on_success(val_json)
+            # Move the offset for our partition, possibly along with later messages
+            pending = msg
+            if es_bulk.sink_due():
+                _commit(consumer, msg)
+                pending = None
+        fail_count = 0
+        logger.info(f"Handled {val_json['evtype']} message in {time.time() - start}s")
+
+
+def _start_concurrent_loop(
+        consumer: Consumer,
+        message_handler: Callable[[Message], None],
+        on_success: Callable[[Message], None],
+        on_failure: Callable[[Message, Exception], None],
+        return_on_empty: bool,
+        timeout: float,
+        worker_count: int,
+        topics: Optional[List[str]] = None):
+    """
+    Run the event loop with `worker_count` handler threads.
+
+    Messages for the same workspace (or, lacking a workspace ID, the same
+    partition) are handled in order, one at a time. Each partition's offset is
+    committed up to the highest offset below which every message has finished,
+    whenever buffered documents are due to be sent.
+    A failing message is retried in its worker up to `max_handler_failures`
+    times before we move on, and on_success is called before the commit.
+    When partitions are revoked, their finished offsets are committed and the
+    rest forgotten, as their messages will be delivered to another consumer.
+    """
+    tracker = OffsetTracker()
+    pool = KeyedWorkerPool(worker_count)
+    max_in_flight = worker_count * _IN_FLIGHT_PER_WORKER
+
+    def on_revoke(consumer, partitions):
+        tps = [(p.topic, p.partition) for p in partitions]
+        try:
+            _commit_finished(consumer, tracker, force=True, tps=tps)
+        except Exception as err:
+            logger.error(f'Unable to commit revoked partitions {tps}: {err}')
+        tracker.reset(tps)
+    if topics:
+        # Called from poll, in this thread
+        consumer.subscribe(topics, on_revoke=on_revoke)
+    try:
+        while True:
+            _commit_finished(consumer, tracker)
+            if tracker.in_flight() >= max_in_flight:
+                # Let the workers catch up before fetching anything else
+                time.sleep(0.01)
+                continue
+            msg = consumer.poll(timeout=timeout)
+            if msg is None:
+                if return_on_empty and tracker.in_flight() == 0:
+                    return
+                continue
+            if msg.error():
+                _log_msg_error(msg)
+                continue
+            tp = (msg.topic(), msg.partition())
+            offset = msg.offset()
+            generation = tracker.start(tp, offset)
+            val_json = _decode(msg)
+            if val_json is None:
+                tracker.finish(tp, offset, generation)
+                continue
+
+            def job(val_json=val_json, tp=tp, offset=offset, generation=generation):
+                try:
+                    _run_handler(val_json, message_handler, on_success, on_failure)
+                finally:
+                    tracker.finish(tp, offset, generation)
+            pool.submit(_msg_key(val_json, tp), job)
+    finally:
+        pool.shutdown()
+        _commit_finished(consumer, tracker, force=True)
+
+
+def _start_batch_loop(
+        consumer: Consumer,
+        message_handler: Callable[[Message], None],
+        on_success: Callable[[Message], None],
+        on_failure: Callable[[Message, Exception], None],
+        return_on_empty: bool,
+        timeout: float,
+        worker_count: int,
+        batch_size: int):
+    """
+    Run the event loop on batches of up to `batch_size` messages.
+
+    Redundant indexing events for the same object within a batch are collapsed
+    into one (see coalesce_groups). The resulting events are handled by
+    `worker_count` threads, in order per workspace, and the offsets for the
+    whole batch are committed once every event in it has been handled.
+    on_success is called for every original message of a collapsed event.
+    """
+    pool = KeyedWorkerPool(worker_count)
+    try:
+        while True:
+            msgs = consumer.consume(num_messages=batch_size, timeout=timeout)
+            if not msgs:
+                if return_on_empty:
+                    return
+                continue
+            events = []  # type: List[Tuple[Message, TopicPart]]
+            for msg in msgs:
+                if msg.error():
+                    _log_msg_error(msg)
+                    continue
+                val_json = _decode(msg)
+                if val_json is not None:
+                    events.append((val_json, (msg.topic(), msg.partition())))
+            if events:
+                units = coalesce_groups([ev for (ev, _) in events])
+                logger.info(f'Coalesced {len(events)} events into {len(units)}')
+                # Events without a wsid fall back to the partition of the batch's first message
+                default_tp = events[0][1]
+                for (unit, originals) in units:
+                    pool.submit(_msg_key(unit, default_tp),
+                                functools.partial(_run_handler, unit, message_handler,
+                                                  _each(on_success, originals), on_failure))
+                pool.join()
+            # Commit the consumed positions of every partition in the batch
+            _flush_sink()
+            kafka.flush_producer()
+            consumer.commit(asynchronous=False)
+    finally:
+        pool.shutdown()
+
+
+def _run_handler(
+        val_json: Message,
+        message_handler: Callable[[Message], None],
+        on_success: Callable[[Message], None],
+        on_failure: Callable[[Message, Exception], None]) -> None:
+    """Handle a single message in a worker thread, retrying on failure."""
+    with config().snapshot():
+        _run_handler_attempts(val_json, message_handler, on_success, on_failure)
+
+
+def _run_handler_attempts(
+        val_json: Message,
+        message_handler: Callable[[Message], None],
+        on_success: Callable[[Message], None],
+        on_failure: Callable[[Message, Exception], None]) -> None:
+    max_failures = config()['max_handler_failures']
+    for fail_count in range(1, max_failures + 1):
         start = time.time()
         try:
             message_handler(val_json)
         except Exception as err:
             logger.error(f'Error processing message: {err.__class__.__name__} {err}')
             logger.error(traceback.format_exc())
-            # Save this error and message to a topic in Elasticsearch
             on_failure(val_json, err)
-            fail_count += 1
             logger.info(f"We've had {fail_count} failures so far")
-            if fail_count >= config()['max_handler_failures']:
-                logger.info(f"Reached max failure count of {fail_count}. Moving on.")
-                consumer.commit(msg)
-                fail_count = 0
             continue
-        # Move the offset for our partition
-        consumer.commit(msg)
         on_success(val_json)
-        fail_count = 0
         logger.info(f"Handled {val_json['evtype']} message in {time.time() - start}s")
+        return
+    logger.info(f"Reached max failure count of {max_failures}. Moving on.")
+
+
+def _each(on_success: Callable[[Message], None], originals: List[Message]) -> Callable[[Message], None]:
+    """Call on_success for each original message when the event that replaced them succeeds."""
+    def fn(val_json: Message) -> None:
+        for original in originals:
+            on_success(original)
+    return fn
+
+
+def _decode(msg) -> Optional[Message]:
+    """Parse the JSON value of a Kafka message, returning None if it is invalid."""
+    val = msg.value().decode('utf-8')
+    try:
+        val_json = json.loads(val)
+    except ValueError as err:
+        logger.error(f'JSON parsing error: {err}')
+        logger.error(f'Message content: {val}')
+        return None
+    logger.info(f'Received event: {val_json}')
+    return val_json
+
+
+def _log_msg_error(msg) -> None:
+    if msg.error().code() == KafkaError._PARTITION_EOF:
+        logger.info('End of stream.')
+    else:
+        logger.error(f"Kafka message error: {msg.error()}")
+
+
+def _msg_key(val_json: Message, tp: TopicPart) -> Hashable:
+    """Messages with the same key are handled sequentially."""
+    if isinstance(val_json, dict) and val_json.get('wsid') is not None:
+        return ('wsid', val_json['wsid'])
+    return tp
+
+
+def _commit(consumer: Consumer, msg) -> None:
+    """
+    Commit a message's offset once any documents and events produced while
+    handling it, or earlier messages, are delivered.
+    """
+    _flush_sink()
+    kafka.flush_producer()
+    consumer.commit(msg)
+
+
+def _commit_finished(
+        consumer: Consumer,
+        tracker: OffsetTracker,
+        force: bool = False,
+        tps: Optional[List[TopicPart]] = None) -> None:
+    """
+    Commit the offsets of all partitions (or those in `tps`) that have made
+    progress, if buffered documents are due to be sent (or `force` is set).
+    """
+    if not force and not es_bulk.sink_due():
+        return
+    finished = tracker.pop_committable(tps)
+    if not finished:
+        return
+    # Documents and events produced by the finished messages must be delivered first
+    _flush_sink()
+    kafka.flush_producer()
+    consumer.commit(
+        offsets=[TopicPartition(topic, partition, offset + 1) for ((topic, partition), offset) in finished],
+        asynchronous=False
+    )
+
+
+def _flush_sink() -> None:
+    """
+    Send the documents buffered for handled messages, retrying with backoff up
+    to `max_handler_failures` times. If that still fails, they are saved to the
+    error index and dropped, so that documents Elasticsearch keeps rejecting
+    cannot stop the consumer from committing.
+    """
+    max_failures = max(1, config()['max_handler_failures'])
+    for fail_count in range(1, max_failures + 1):
+        try:
+            es_bulk.flush_sink()
+            return
+        except Exception as err:
+            logger.error(f'Error sending buffered documents: {err.__class__.__name__} {err}')
+            logger.error(traceback.format_exc())
+            error = err
+        if fail_count < max_failures:
+            time.sleep(_FLUSH_RETRY_DELAY * 2 ** (fail_count - 1))
+    logger.info(f"Reached max failure count of {max_failures} sending buffered documents. Moving on.")
+    try:
+        es_bulk.discard_sink(error)
+    except Exception as err:
+        logger.error(f'Unable to save the unsent documents to the error index: {err}')
@@ -1,10 +1,12 @@
 """
 Main entrypoint for the app and the Kafka topic consumer.
 Sends work to the es_indexer or the releng_importer.
-Generally handles every message synchronously. Duplicate the service to get more parallelism.
+Handles every message synchronously by default. Set WORKER_COUNT to handle messages from
+different workspaces concurrently, or duplicate the service to get more parallelism.
 """
 from kbase_workspace_client.exceptions import WorkspaceResponseError
 import atexit
+import functools
 import hashlib
 import json
 import os
@@ -14,22 +16,35 @@ import time
 from src.index_runner import event_loop
 from src.utils.config import config
 from src.utils.logger import logger
+from src.utils.request_context import RequestContext, cache_stats, invalidate_workspace
 from src.utils.service_utils import wait_for_dependencies
 from src.utils.ws_utils import get_obj_type, log_error
+import src.index_runner.bulk_mode as bulk_mode
+import src.index_runner.es_bulk as es_bulk
 import src.index_runner.es_indexer as es_indexer
+import src.index_runner.es_tasks as es_tasks
 import src.index_runner.releng_importer as releng_importer
 import src.utils.es_utils as es_utils
 import src.utils.kafka as kafka
 import src.utils.re_client as re_client
 
 
+# Events that change a workspace's info or permissions
+_WS_CHANGE_EVENTS = {'SET_PERMISSION', 'SET_GLOBAL_PERMISSION', 'WORKSPACE_DELETE_STATE_CHANGE'}
+
+
 def _handle_msg(msg):
     event_type = msg.get('evtype')
     if not event_type:
         msg = f"Missing 'evtype' in event: {msg}"
         logger.error(msg)
         raise RuntimeError(msg)
-    objtype = get_obj_type(msg)
+    if event_type in _WS_CHANGE_EVENTS and msg.get('wsid') is not None:
+        # Anything we have cached about this workspace may now be wrong
+        invalidate_workspace(msg['wsid'])
+    # Workspace lookups are memoized for the duration of this event
+    ctx = RequestContext()
+    objtype = get_obj_type(msg, ctx)
     if objtype is not None and isinstance(objtype, str) and len(objtype) > 0:
         # Check the type against the configured whitelist or blacklist, if present
         whitelist = config()['allow_types']
@@ -47,14 +62,14 @@ def _handle_msg(msg):
             logger.warning(f"Workspace {wsid} in skip list, skipping")
             return
         # Index a single workspace object
-        obj = _fetch_obj_data(msg)
-        ws_info = _fetch_ws_info(msg)
+        obj = _fetch_obj_data(msg, ctx)
+        ws_info = _fetch_ws_info(msg, ctx)
         if not config()['skip_narrative_reindex']:
             _reindex_narrative(obj, ws_info)
         if not config()['skip_releng']:
-            releng_importer.run_importer(obj, ws_info, msg)
+            releng_importer.run_importer(obj, ws_info, msg, ctx)
         if not config()['skip_es']:
-            es_indexer.run_indexer(obj, ws_info, msg)
+            es_indexer.run_indexer(obj, ws_info, msg, ctx)
     elif event_type == 'REINDEX_WS' or event_type == 'CLONE_WORKSPACE':
         # Reindex all objects in a workspace, overwriting existing data
         for objinfo in config()['ws_client'].generate_obj_infos(msg['wsid'], admin=True):
@@ -63,25 +78,28 @@ def _handle_msg(msg):
                           callback=_delivery_report)
     elif event_type == 'INDEX_NONEXISTENT_WS':
         # Reindex all objects in a workspace without overwriting any existing data
-        for objinfo in config()['ws_client'].generate_obj_infos(msg['wsid'], admin=True):
-            objid = objinfo[0]
+        objids = [objinfo[0] for objinfo in config()['ws_client'].generate_obj_infos(msg['wsid'], admin=True)]
+        missing = _find_nonexistent(msg['wsid'], objids)
+        logger.info(f"{len(missing)} of {len(objids)} objects in workspace {msg['wsid']} need indexing")
+        for objid in missing:
             kafka.produce({'evtype': 'INDEX_NONEXISTENT', 'wsid': msg['wsid'], 'objid': objid},
                           callback=_delivery_report)
     elif event_type == 'INDEX_NONEXISTENT':
         # Import to RE if we are not skipping RE and also it does not exist in the db
         re_required = not config()['skip_releng'] and not re_client.check_doc_existence(msg['wsid'], msg['objid'])
-        # Index in elasticsearch if it does not exist there by ID
-        es_required = not es_utils.check_doc_existence(msg['wsid'], msg['objid'])
+        # Documents that already exist in elasticsearch are not overwritten (see below)
+        es_required = not config()['skip_es']
         if not re_required and not es_required:
             # Skip any indexing/importing of this object
             return
         # We need to either index or import the object
-        obj = _fetch_obj_data(msg)
-        ws_info = _fetch_ws_info(msg)
+        obj = _fetch_obj_data(msg, ctx)
+        ws_info = _fetch_ws_info(msg, ctx)
         if re_required:
-            releng_importer.run_importer(obj, ws_info, msg)
-        if es_required and not config()['skip_es']:
-            es_indexer.run_indexer(obj, ws_info, msg)
+            releng_importer.run_importer(obj, ws_info, msg, ctx)
+        if es_required:
+            # Create-only writes, so there is no need to check for the documents first
+            es_indexer.run_indexer(obj, ws_info, msg, ctx, create_only=True)
     elif event_type == 'OBJECT_DELETE_STATE_CHANGE':
         # Delete the object on RE and ES. Synchronous for now.
         if not config()['skip_es']:
@@ -108,14 +126,38 @@ def _handle_msg(msg):
         # Reload aliases on ES from the global config file
         if not config()['skip_es']:
             es_indexer.reload_aliases()
+    elif event_type == 'START_BULK_MODE':
+        # Tune indexes for a mass reindex
+        if not config()['skip_es']:
+            bulk_mode.start_bulk_mode(msg.get('indexes'))
+    elif event_type == 'END_BULK_MODE':
+        # Restore indexes tuned by START_BULK_MODE
+        if not config()['skip_es']:
+            # After the documents written in bulk mode
+            es_bulk.after_flush('end_bulk_mode', functools.partial(bulk_mode.end_bulk_mode, msg.get('indexes')))
     else:
         logger.warning(f"Unrecognized event {event_type}.")
 
 
+def _find_nonexistent(wsid, objids):
+    """
+    Find the objects of a workspace that are missing from elasticsearch or RE,
+    skipping any store we do not write to, in workspace order.
+    """
+    objids = list(objids)
+    missing = set()  # type: set
+    if not config()['skip_es']:
+        missing.update(set(objids) - es_utils.get_existing_objids(wsid, objids))
+    if not config()['skip_releng']:
+        missing.update(set(objids) - re_client.get_existing_objids(wsid, objids))
+    return [objid for objid in objids if objid in missing]
+
+
 def _log_msg_to_elastic(msg):
     """
     Save every message consumed from Kafka to an Elasticsearch index for logging purposes.
     """
+    logger.debug(f'Workspace cache stats: {cache_stats()}')
     # The key is a hash of the message data body
     # The index document is the error string plus the message data itself
     ts = msg.get('time', int(time.time() * 1000))
@@ -123,19 +165,17 @@ def _log_msg_to_elastic(msg):
         'index': config()['msg_log_index_name'],
         'id': ts,
         'doc': msg
-    }])
+    }], defer=True)
 
 
-def _fetch_obj_data(msg):
+def _fetch_obj_data(msg, ctx):
     if not msg.get('wsid') or not msg.get('objid'):
         raise RuntimeError(f'Cannot get object ref from msg: {msg}')
     obj_ref = f"{msg['wsid']}/{msg['objid']}"
     if msg.get('ver'):
         obj_ref += f"/{msg['ver']}"
     try:
-        obj_data = config()['ws_client'].admin_req('getObjects', {
-            'objects': [{'ref': obj_ref}]
-        })
+        obj_data = ctx.get_object(obj_ref)
     except WorkspaceResponseError as err:
         log_error(err)
         # Workspace is deleted; ignore the error
@@ -152,13 +192,11 @@ def _fetch_obj_data(msg):
     return result
 
 
-def _fetch_ws_info(msg):
+def _fetch_ws_info(msg, ctx):
     if not msg.get('wsid'):
         raise RuntimeError(f'Cannot get workspace info from msg: {msg}')
     try:
-        ws_info = config()['ws_client'].admin_req('getWorkspaceInfo', {
-            'id': msg['wsid']
-        })
+        ws_info = ctx.get_ws_info(msg['wsid'])
     except WorkspaceResponseError as err:
         logger.error(f'Workspace response error: {err.resp_data}')
         raise err
@@ -209,9 +247,11 @@ def _delivery_report(err, msg):
 
 def _exit_handler(consumer):
     def handler(signum, stack_frame):
+        kafka.flush_producer()
         kafka.close_consumer(consumer)
 
     def handler_noargs():
+        kafka.flush_producer()
         kafka.close_consumer(consumer)
 
     return (handler, handler_noargs)
@@ -228,6 +268,11 @@ def main():
     atexit.register(handler_noargs)
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
+    # Keep the configuration up to date without blocking message handling
+    config().start_refresher(config()['config_refresh_interval'])
+    if not config()['skip_es']:
+        # Follow background deletes, including any left from a previous run
+        es_tasks.start_poller(config()['es_task_poll_interval'])
 
     # Run the main thread
     event_loop.start_loop(
@@ -235,7 +280,8 @@ def main():
         _handle_msg,
         on_success=_log_msg_to_elastic,
         on_failure=_log_err_to_es,
-        on_config_update=es_indexer.reload_aliases)
+        on_config_update=es_indexer.reload_aliases,
+        topics=topics)
 
 
 if __name__ == '__main__':
@@ -248,6 +294,7 @@ if __name__ == '__main__':
         # Database initialization
         es_indexer.init_indexes()
         es_indexer.reload_aliases()
+        es_indexer.load_generic_indexes()
     # Touch a temp file indicating the daemon is ready
     with open(config()['proc_ready_path'], 'w') as fd:
         fd.write('')
@@ -5,8 +5,8 @@ from src.index_runner.releng import genome
 from src.index_runner.releng import samples
 from src.utils.ws_utils import get_type_pieces
 from src.utils.re_client import save
-from src.utils.config import config
 from src.utils.logger import logger
+from src.utils.request_context import RequestContext
 from src.utils.formatting import (
     ts_to_epoch,
     get_method_key_from_prov,
@@ -22,9 +22,10 @@ _TYPE_PROCESSOR_MAP = {
 }
 
 
-def import_object(obj, ws_info):
+def import_object(obj, ws_info, ctx=None):
     """
     Import all the edges and vertices for a workspace object into RE.
+    ctx is the RequestContext for the current event, if any.
     """
     # TODO handle the ws_latest_version_of edge -- some tricky considerations here
     # Save the ws_object document
@@ -54,11 +55,8 @@ def import_object(obj, ws_info):
         # dealing with this situation, but that'd have to be ported to Python and it's pretty
         # complex, so YAGNI for now.
         logger.debug(f'Using releng indexer for "{type_}" workspace type for ws_object with key {obj_key}')
-        resp = config()['ws_client'].admin_req('getObjects', {
-            'objects': [{
-                'ref': obj_ver_key.replace(':', '/'),
-            }]
-        })
+        ctx = ctx or RequestContext()
+        resp = ctx.get_object(obj_ver_key.replace(':', '/'))
         _TYPE_PROCESSOR_MAP[type_](obj_ver_key, resp['data'][0])
 
 
@@ -11,13 +11,13 @@ from src.index_runner.releng.import_obj import import_object
 from src.index_runner.releng.del_obj import delete_object
 
 
-def run_importer(obj, ws_info, msg):
+def run_importer(obj, ws_info, msg, ctx=None):
     start = time.time()
     type_, _ = obj['info'][2].split('-')  # 2nd var is version
     if type_ in config()['global']['ws_type_blacklist']:
         logger.info(f'Skipped RE import of blacklisted type {type_}')
     else:
-        import_object(obj, ws_info)
+        import_object(obj, ws_info, ctx)
         logger.info(f"Imported an object into RE in {time.time() - start}s.")
 
 
@@ -0,0 +1,147 @@
+"""
+Concurrent message handling for the event loop.
+
+Messages are run on a thread pool, serialized per key (such as a workspace ID),
+while the offsets for each Kafka partition are tracked so that we only ever
+commit the highest offset below which every message has finished.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+import collections
+import threading
+import traceback
+
+from src.utils.logger import logger
+
+# (topic, partition)
+TopicPart = Tuple[str, int]
+
+
+class OffsetTracker:
+    """
+    Track in-flight offsets for each topic partition and compute the next
+    offset that is safe to commit.
+
+    Offsets within a partition are started in increasing order, which is how
+    Kafka delivers them. An offset at or below one already started means the
+    partition is being delivered again (eg. after a rebalance), so its
+    unfinished offsets are forgotten, as they are when the partition is reset.
+    Offsets started before a reset are ignored when they finish. Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Ordered mapping of offset -> finished flag for each partition
+        self._pending = {}  # type: Dict[TopicPart, collections.OrderedDict]
+        # Highest contiguous finished offset per partition that is not yet committed
+        self._committable = {}  # type: Dict[TopicPart, int]
+        # Count of resets per partition, to ignore offsets started before one
+        self._generations = {}  # type: Dict[TopicPart, int]
+
+    def start(self, tp: TopicPart, offset: int) -> int:
+        """Register an offset as in-flight. Returns the generation to pass to finish."""
+        with self._lock:
+            pending = self._pending.get(tp)
+            if pending and offset <= next(reversed(pending)):
+                logger.warning(f"Offset {offset} of {tp} was delivered again; forgetting its unfinished offsets")
+                self._reset(tp)
+            self._pending.setdefault(tp, collections.OrderedDict())[offset] = False
+            return self._generations.get(tp, 0)
+
+    def finish(self, tp: TopicPart, offset: int, generation: int = 0) -> None:
+        """Mark an offset as finished and advance the committable offset."""
+        with self._lock:
+            pending = self._pending.get(tp)
+            if generation != self._generations.get(tp, 0) or pending is None or offset not in pending:
+                # Started before the partition was reset
+                return
+            pending[offset] = True
+            while pending:
+                (first, done) = next(iter(pending.items()))
+                if not done:
+                    break
+                pending.popitem(last=False)
+                self._committable[tp] = first
+
+    def pop_committable(self, tps: Optional[List[TopicPart]] = None) -> List[Tuple[TopicPart, int]]:
+        """
+        Return and clear the (topic_partition, offset) pairs that can be committed,
+        for all partitions or only those in `tps`.
+        Offsets are the last finished offset, so add one when committing to Kafka.
+        """
+        with self._lock:
+            ret = [(tp, offset) for (tp, offset) in self._committable.items() if tps is None or tp in tps]
+            for (tp, _) in ret:
+                del self._committable[tp]
+            return ret
+
+    def reset(self, tps: List[TopicPart]) -> None:
+        """Forget the offsets of partitions, eg. once they are revoked from this consumer."""
+        with self._lock:
+            for tp in tps:
+                self._reset(tp)
+
+    def in_flight(self) -> int:
+        """Count of offsets that have started but not finished."""
+        with self._lock:
+            return sum(len(p) for p in self._pending.values())
+
+    def _reset(self, tp: TopicPart) -> None:
+        self._pending.pop(tp, None)
+        self._committable.pop(tp, None)
+        self._generations[tp] = self._generations.get(tp, 0) + 1
+
+
+class KeyedWorkerPool:
+    """
+    Run jobs on a pool of threads. Jobs that share a key run one at a time in
+    submission order; jobs with different keys run concurrently.
+    """
+
+    def __init__(self, worker_count: int):
+        self._executor = ThreadPoolExecutor(max_workers=worker_count)
+        self._lock = threading.Lock()
+        # Queued jobs for each key that currently has a job running
+        self._queues = {}  # type: Dict[Hashable, collections.deque]
+        # Count of submitted jobs that have not finished, for join()
+        self._unfinished = 0
+        self._all_done = threading.Condition(self._lock)
+
+    def submit(self, key: Hashable, job: Callable[[], None]) -> None:
+        """Schedule a job, queueing it behind any running job with the same key."""
+        with self._lock:
+            self._unfinished += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(job)
+                return
+            self._queues[key] = collections.deque()
+        self._executor.submit(self._run, key, job)
+
+    def join(self) -> None:
+        """Block until every submitted job has finished."""
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def shutdown(self) -> None:
+        """Wait for all running jobs to finish and release the threads."""
+        self._executor.shutdown(wait=True)
+
+    def _run(self, key: Hashable, job: Callable[[], None]) -> None:
+        while True:
+            try:
+                job()
+            except Exception as err:
+                # Jobs should handle their own errors; never leave the key's queue stuck
+                logger.error(f'Unhandled error in worker job: {err.__class__.__name__} {err}')
+                logger.error(traceback.format_exc())
+            with self._lock:
+                self._unfinished -= 1
+                if not self._unfinished:
+                    self._all_done.notify_all()
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                job = queue.popleft()
@@ -1,12 +1,16 @@
 from kbase_workspace_client import WorkspaceClient
 from typing import Optional
+import contextlib
+import hashlib
 import json
 import os
-import requests
+import threading
 import time
+import urllib.error
 import urllib.request
 import yaml
 
+from src.utils.http_session import new_session
 from src.utils.logger import logger
 
 _FETCH_CONFIG_RETRIES = 5
@@ -15,6 +19,14 @@ _FETCH_CONFIG_RETRIES = 5
 # Alternative is passing the configuration through the entire stack, which is feasible,
 # but we consider that YAGNI for now.
 _CONFIG_SINGLETON = None
+_CONFIG_SINGLETON_LOCK = threading.Lock()
+
+# Per-thread configuration snapshot pinned by Config.snapshot()
+_LOCAL = threading.local()
+
+# Cache of fetched YAML files by URL, for conditional fetching:
+# {url: {'etag': str, 'last_modified': str, 'digest': str, 'data': parsed yaml}}
+_FETCH_CACHE = {}  # type: dict
 
 
 def _get_sample_service_url(sw_url, ss_release):
@@ -26,7 +38,9 @@ def _get_sample_service_url(sw_url, ss_release):
         "version": "1.1"
     }
     headers = {'Content-Type': 'application/json'}
-    sw_resp = requests.post(url=sw_url, headers=headers, data=json.dumps(payload))
+    # The config cannot use get_session, as its settings come from the config
+    with new_session(pool_maxsize=1, timeout=(5, 60)) as session:
+        sw_resp = session.post(url=sw_url, headers=headers, data=json.dumps(payload))
     if not sw_resp.ok:
         raise RuntimeError(f"ServiceWizard error, with code {sw_resp.status_code}. \n{sw_resp.text}")
     wiz_resp = sw_resp.json()
@@ -37,12 +51,21 @@ def _get_sample_service_url(sw_url, ss_release):
 
 
 def config(force_reload=False):
-    """Wrapper for fetching the config with an optional reload."""
+    """
+    Wrapper for fetching the config with an optional reload.
+
+    Once the background refresher is running, expired configuration is only
+    reloaded by the refresher, so this never blocks on the network unless
+    force_reload is set.
+    """
     global _CONFIG_SINGLETON
     if not _CONFIG_SINGLETON:
-        # could do this on module load, but let's delay until actually requested
-        _CONFIG_SINGLETON = Config()
-    _CONFIG_SINGLETON.reload(force_reload=force_reload)
+        with _CONFIG_SINGLETON_LOCK:
+            if not _CONFIG_SINGLETON:
+                # could do this on module load, but let's delay until actually requested
+                _CONFIG_SINGLETON = Config()
+    if force_reload or not _CONFIG_SINGLETON.refresher_running():
+        _CONFIG_SINGLETON.reload(force_reload=force_reload)
     return _CONFIG_SINGLETON
 
 
@@ -51,12 +74,16 @@ class Config:
     A class containing the configuration for the for the search indexer. Supports dict like
     configuration item access, e.g. config['ws-token'].
 
-    Not thread-safe.
+    Each reload builds a complete new configuration dict and swaps it in at
+    once; published dicts are never mutated. Use snapshot() to read a single
+    consistent version across many lookups in one thread.
     """
 
     def __init__(self):
         """Initialize configuration data from the environment."""
         self._cfg = {}
+        self._reload_lock = threading.Lock()
+        self._refresher = None  # type: Optional[threading.Thread]
         self.reload()
 
     def reload(self, force_reload=False):
@@ -65,12 +92,53 @@ class Config:
 
         Only reloads if the configuration has expired or force_reload is true.
         """
-        if self._cfg:
-            expired = (time.time() - self._cfg['last_config_reload']) > self._cfg['config_timeout']
-            if not expired and not force_reload:
-                # can remove force_reload once all reload logic is handled here
+        if self._cfg and not force_reload and not self._expired():
+            return
+        with self._reload_lock:
+            # Another thread may have reloaded while we waited
+            if self._cfg and not force_reload and not self._expired():
                 return
+            self._cfg = self._build(self._cfg)
+
+    def start_refresher(self, interval: float) -> None:
+        """
+        Reload the configuration every `interval` seconds in a daemon thread.
+        Errors are logged and the previous configuration is kept.
+        """
+        if self.refresher_running():
+            return
 
+        def refresh():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload(force_reload=True)
+                except Exception as err:
+                    logger.error(f'Unable to refresh the configuration, keeping the previous one: {err}')
+        self._refresher = threading.Thread(target=refresh, name='config-refresher', daemon=True)
+        self._refresher.start()
+
+    def refresher_running(self) -> bool:
+        return self._refresher is not None and self._refresher.is_alive()
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Pin the current configuration for this thread, so that every lookup
+        inside the block sees the same version even if a reload happens.
+        """
+        prev = getattr(_LOCAL, 'cfg', None)
+        _LOCAL.cfg = prev if prev is not None else self._cfg
+        try:
+            yield self
+        finally:
+            _LOCAL.cfg = prev
+
+    def _expired(self):
+        return (time.time() - self._cfg['last_config_reload']) > self._cfg['config_timeout']
+
+    def _build(self, prev):
+        """Build a new configuration dict. `prev` is the current one, possibly empty."""
         reqs = ['WORKSPACE_TOKEN', 'RE_API_TOKEN']
         for req in reqs:
             if not os.environ.get(req):
@@ -88,8 +156,8 @@ class Config:
         skip_narrative_reindex = False
         if os.environ.get("SKIP_NARRATIVE_REINDEX"):
             skip_narrative_reindex = True
+        service_wizard_url = os.environ.get('SW_URL', kbase_endpoint + '/service_wizard').strip('/')
         if sample_service_url is None:
-            service_wizard_url = os.environ.get('SW_URL', kbase_endpoint + '/service_wizard').strip('/')
             sample_service_release = os.environ.get('SAMPLE_SERVICE_RELEASE', 'dev')
             sample_service_url = _get_sample_service_url(service_wizard_url, sample_service_release)
         config_url = os.environ.get('GLOBAL_CONFIG_URL', f"file://{os.getcwd()}/spec/config.yaml")
@@ -108,13 +176,23 @@ class Config:
         allow_indices = _get_comma_delimited_env('ALLOW_INDICES')
         # Use a tempfile to indicate that the service is done booting up
         proc_ready_path = '/tmp/IR_READY'  # nosec
+        # Directory for local caches that should survive restarts
+        cache_dir = os.environ.get('CACHE_DIR', '/tmp/index_runner_cache')  # nosec
         # Set the indexer log messages index name from a configured index name or alias
         msg_log_index_name = os.environ.get('MSG_LOG_INDEX_NAME', 'indexer_messages')
         if msg_log_index_name in global_config['latest_versions']:
             msg_log_index_name = global_config['latest_versions'][msg_log_index_name]
         with open('VERSION') as fd:
             app_version = fd.read().strip()
-        self._cfg = {
+        worker_count = int(os.environ.get('WORKER_COUNT', 1))
+        es_bulk_in_flight = int(os.environ.get('ES_BULK_IN_FLIGHT', 2))
+        # Enough connections for every worker's in-flight bulk requests
+        pool_maxsize = max(10, worker_count * max(1, es_bulk_in_flight))
+        if prev and prev['kbase_endpoint'] == kbase_endpoint and prev['ws_token'] == ws_token:
+            ws_client = prev['ws_client']
+        else:
+            ws_client = WorkspaceClient(url=kbase_endpoint, token=ws_token)
+        return {
             'service_wizard_url': service_wizard_url,
             'skip_releng': os.environ.get('SKIP_RELENG'),
             'skip_es': os.environ.get('SKIP_ES'),
@@ -141,8 +219,17 @@ class Config:
             'elasticsearch_port': es_port,
             'elasticsearch_url': f"http://{es_host}:{es_port}",
             'es_batch_writes': int(os.environ.get('ES_BATCH_WRITES', 10000)),
+            'es_batch_bytes': int(os.environ.get('ES_BATCH_BYTES', 10 * 1024 * 1024)),
+            'es_bulk_retries': int(os.environ.get('ES_BULK_RETRIES', 5)),
+            'es_bulk_in_flight': es_bulk_in_flight,
+            'es_flush_interval': float(os.environ.get('ES_FLUSH_INTERVAL', 1)),
+            'es_skip_unchanged': os.environ.get('ES_SKIP_UNCHANGED'),
+            'es_hash_exclude': _get_comma_delimited_env('ES_HASH_EXCLUDE') or {'index_runner_ver'},
+            'es_external_versions': os.environ.get('ES_EXTERNAL_VERSIONS'),
             'kafka_server': os.environ.get('KAFKA_SERVER', 'kafka'),
             'kafka_clientgroup': os.environ.get('KAFKA_CLIENTGROUP', 'search_indexer'),
+            'kafka_linger_ms': int(os.environ.get('KAFKA_LINGER_MS', 50)),
+            'kafka_batch_messages': int(os.environ.get('KAFKA_BATCH_MESSAGES', 10000)),
             'error_index_name': os.environ.get('ERROR_INDEX_NAME', 'indexing_errors'),
             'msg_log_index_name': msg_log_index_name,
             'elasticsearch_index_prefix': os.environ.get('ELASTICSEARCH_INDEX_PREFIX', 'search2'),
@@ -151,19 +238,40 @@ class Config:
                 'admin_events': os.environ.get('KAFKA_ADMIN_TOPIC', 'indexeradminevents')
             },
             'config_timeout': 600,  # 10 minutes in seconds.
+            'config_refresh_interval': int(os.environ.get('CONFIG_REFRESH_INTERVAL', 60)),
             'last_config_reload': time.time(),
             'proc_ready_path': proc_ready_path,  # File indicating the daemon is booted and ready
+            'cache_dir': cache_dir,
+            'obj_v1_cache_path': os.environ.get('OBJ_V1_CACHE_PATH', os.path.join(cache_dir, 'obj_v1.sqlite')),
+            'es_task_registry_path': os.environ.get('ES_TASK_REGISTRY_PATH',
+                                                    os.path.join(cache_dir, 'es_tasks.sqlite')),
+            'es_task_poll_interval': float(os.environ.get('ES_TASK_POLL_INTERVAL', 10)),
+            'es_task_max_attempts': int(os.environ.get('ES_TASK_MAX_ATTEMPTS', 5)),
             'generic_shard_count': os.environ.get('GENERIC_SHARD_COUNT', 2),
             'generic_replica_count': os.environ.get('GENERIC_REPLICA_COUNT', 1),
             'skip_types': _get_comma_delimited_env('SKIP_TYPES'),
             'allow_types': _get_comma_delimited_env('ALLOW_TYPES'),
             'max_handler_failures': int(os.environ.get('MAX_HANDLER_FAILURES', 3)),
-            'ws_client': WorkspaceClient(url=kbase_endpoint, token=ws_token),
+            'worker_count': worker_count,
+            'http_pool_maxsize': int(os.environ.get('HTTP_POOL_MAXSIZE', pool_maxsize)),
+            'http_connect_timeout': float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5)),
+            'http_read_timeout': float(os.environ.get('HTTP_READ_TIMEOUT', 300)),
+            'http_retries': int(os.environ.get('HTTP_RETRIES', 3)),
+            'shock_prefetch_bytes': int(os.environ.get('SHOCK_PREFETCH_BYTES', 64 * 1024 * 1024)),
+            'shock_cache_dir': os.environ.get('SHOCK_CACHE_DIR', os.path.join(cache_dir, 'shock')),
+            'shock_cache_max_bytes': int(os.environ.get('SHOCK_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024)),
+            'ws_cache_size': int(os.environ.get('WS_CACHE_SIZE', 1000)),
+            'ws_cache_ttl': int(os.environ.get('WS_CACHE_TTL', 60)),
+            'batch_size': int(os.environ.get('BATCH_SIZE', 1)),
+            'ws_client': ws_client,
             'app_version': app_version,
         }
 
     def __getitem__(self, key):
-        return self._cfg[key]
+        cfg = getattr(_LOCAL, 'cfg', None)
+        if cfg is None:
+            cfg = self._cfg
+        return cfg[key]
 
     def __str__(self):
         return json.dumps(self._cfg, indent=2)
@@ -172,11 +280,40 @@ class Config:
 def _fetch_global_config(config_url):
     """
     Fetch the index_runner_spec configuration file from a URL to a yaml file.
+
+    Repeated fetches of the same URL are conditional (ETag / Last-Modified), and
+    unchanged content is not re-parsed. The parsed data is shared between
+    configuration versions, so it must not be mutated.
     """
     logger.info(f'Fetching config from url: {config_url}')
-    # Fetch the config directly from config_url
-    with urllib.request.urlopen(config_url) as res:  # nosec
-        return yaml.safe_load(res.read())
+    cached = _FETCH_CACHE.get(config_url)
+    req = urllib.request.Request(config_url)
+    if cached is not None:
+        if cached['etag']:
+            req.add_header('If-None-Match', cached['etag'])
+        if cached['last_modified']:
+            req.add_header('If-Modified-Since', cached['last_modified'])
+    try:
+        with urllib.request.urlopen(req) as res:  # nosec
+            body = res.read()
+            headers = res.headers
+    except urllib.error.HTTPError as err:
+        if err.code == 304 and cached is not None:
+            logger.debug(f'Config at {config_url} is not modified')
+            return cached['data']
+        raise err
+    digest = hashlib.sha256(body).hexdigest()
+    if cached is not None and cached['digest'] == digest:
+        data = cached['data']
+    else:
+        data = yaml.safe_load(body)
+    _FETCH_CACHE[config_url] = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'digest': digest,
+        'data': data,
+    }
+    return data
 
 
 def _get_comma_delimited_env(key: str) -> Optional[set]:
@@ -1,18 +1,20 @@
 """Elasticsearch API client utilities."""
 import json
-import requests
 
 from src.utils.config import config
+from src.utils.http_session import get_session
 
 # Initialize configuration data
 _PREFIX = config()['elasticsearch_index_prefix']
 _ES_URL = "http://" + config()['elasticsearch_host'] + ":" + str(config()['elasticsearch_port'])
+# Number of document IDs to look up per request
+_EXISTENCE_CHUNK = 1000
 
 
 def check_doc_existence(wsid, objid):
     """Check if a document exists on elasticsearch based on workspace and object id."""
     _id = f"WS::{wsid}:{objid}"
-    resp = requests.post(
+    resp = get_session('elasticsearch').post(
         _ES_URL + f"/{_PREFIX}.*/_search",
         data=json.dumps({'query': {'term': {'_id': _id}}}),
         params={'size': 0},
@@ -25,6 +27,32 @@ def check_doc_existence(wsid, objid):
     return total > 0
 
 
+def get_existing_objids(wsid, objids):
+    """
+    Find which of the objects in a workspace have a document on elasticsearch,
+    with one request per thousand objects. Returns a set of object IDs.
+    """
+    objids = list(objids)
+    existing = set()
+    for start in range(0, len(objids), _EXISTENCE_CHUNK):
+        chunk = objids[start:start + _EXISTENCE_CHUNK]
+        resp = get_session('elasticsearch').post(
+            _ES_URL + f"/{_PREFIX}.*/_search",
+            data=json.dumps({
+                'query': {'ids': {'values': [f"WS::{wsid}:{objid}" for objid in chunk]}},
+                '_source': False,
+                # A document may be in more than one index
+                'size': 2 * len(chunk),
+            }),
+            headers={'Content-Type': 'application/json'}
+        )
+        if not resp.ok:
+            raise RuntimeError(f"Unexpected elasticsearch server error:\n{resp.text}")
+        for hit in resp.json()['hits']['hits']:
+            existing.add(int(hit['_id'].split(':')[-1]))
+    return existing
+
+
 def _get_document(index_name, document_id):
     """ Get document (if it exists) in index from Elasticsearch, otherwise return None
     document - document id often in following form:
@@ -32,7 +60,7 @@ def _get_document(index_name, document_id):
         for further reference look at individual object type indexers.
     """
     es_url = f"{_ES_URL}/{_PREFIX}.{index_name}/_doc/{document_id}"
-    resp = requests.get(url=es_url)
+    resp = get_session('elasticsearch').get(url=es_url)
     # don't check status, will error if Document not found.
     respj = resp.json()
     if respj.get('error'):
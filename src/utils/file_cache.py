@@ -0,0 +1,100 @@
+"""
+Local on-disk cache of downloaded files, such as Shock nodes, which never change.
+
+Each file is stored under its key (eg. the Shock node ID) in the
+`shock_cache_dir` directory, which can be shared by every worker process on a
+host. Files are written to a temporary name and renamed into place once
+complete, so readers only see whole files. When the directory grows past
+`shock_cache_max_bytes`, the least recently used files are removed; a file
+that is already open stays readable after it is removed.
+"""
+from typing import Iterator, Optional
+import contextlib
+import os
+import re
+import tempfile
+import time
+
+from src.utils.config import config
+from src.utils.logger import logger
+
+_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+_TMP_SUFFIX = '.tmp'
+# Temporary files this old were left by a process that stopped mid-download
+_STALE_TMP_SECONDS = 24 * 60 * 60
+
+
+def enabled() -> bool:
+    """Whether the cache is configured."""
+    return bool(config()['shock_cache_dir']) and config()['shock_cache_max_bytes'] > 0
+
+
+def get(key: str) -> Optional[str]:
+    """Path of the cached file for a key, marking it as recently used, or None if it is not cached."""
+    if not enabled():
+        return None
+    path = _path(key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+@contextlib.contextmanager
+def new_file(key: str) -> Iterator:
+    """
+    Open a binary file to write the contents for a key. The file is added to
+    the cache when the block exits normally, and discarded if it raises.
+    """
+    directory = config()['shock_cache_dir']
+    _path(key)
+    os.makedirs(directory, exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(prefix=f'.{key}.', suffix=_TMP_SUFFIX, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as fwrite:
+            yield fwrite
+        if os.path.getsize(tmp_path) > config()['shock_cache_max_bytes']:
+            logger.info(f'Not caching {key}, as it is larger than the cache')
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, _path(key))
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    _evict()
+
+
+def _path(key: str) -> str:
+    if not _KEY_PATTERN.match(key) or key.startswith('.'):
+        raise ValueError(f"Invalid file cache key: {key}")
+    return os.path.join(config()['shock_cache_dir'], key)
+
+
+def _evict() -> None:
+    """Remove the least recently used files until the cache is within its size limit."""
+    directory = config()['shock_cache_dir']
+    entries = []
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.startswith('.'):
+            if entry.name.endswith(_TMP_SUFFIX) and stat.st_mtime < time.time() - _STALE_TMP_SECONDS:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for (_, size, _) in entries)
+    # Other processes may be evicting at the same time, so files can already be gone
+    for (_, size, path) in sorted(entries):
+        if total <= config()['shock_cache_max_bytes']:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+            logger.debug(f'Evicted {path} from the file cache')
+        total -= size
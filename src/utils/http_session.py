@@ -0,0 +1,86 @@
+"""
+Shared HTTP transport for the services we depend on.
+
+Each dependency (Elasticsearch, the RE API, etc.) gets one pooled
+`requests.Session` for the life of the process, so connections are kept
+alive between calls. Sessions apply a default timeout and retry connection
+errors and 502/503/504 responses with jittered exponential backoff.
+"""
+from requests.adapters import HTTPAdapter
+from typing import Dict, Tuple, Union
+from urllib3.util.retry import Retry
+import random
+import requests
+import threading
+
+_SESSIONS = {}  # type: Dict[str, requests.Session]
+_LOCK = threading.Lock()
+
+# Responses worth retrying. A proxy may answer with these after the request was
+# processed, so they are only retried for idempotent methods (urllib3's default
+# allowed_methods); POSTs such as bulk writes are not replayed.
+_RETRY_STATUSES = (502, 503, 504)
+
+
+class _JitterRetry(Retry):
+    """Retry with exponential backoff, randomized so that workers do not retry in lockstep."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff)  # nosec
+
+
+class _TimeoutSession(requests.Session):
+    """Session that applies a default timeout to every request."""
+
+    def __init__(self, timeout: Union[float, Tuple[float, float]]):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_session(name: str) -> requests.Session:
+    """
+    Get the process-wide session for a dependency, such as 'elasticsearch' or
+    're_api', creating it from the configuration on first use.
+    """
+    # Imported here as the config module itself uses new_session
+    from src.utils.config import config
+    with _LOCK:
+        if name not in _SESSIONS:
+            _SESSIONS[name] = new_session(
+                pool_maxsize=config()['http_pool_maxsize'],
+                timeout=(config()['http_connect_timeout'], config()['http_read_timeout']),
+                retries=config()['http_retries'],
+            )
+        return _SESSIONS[name]
+
+
+def new_session(
+        pool_maxsize: int = 10,
+        timeout: Union[float, Tuple[float, float]] = (5, 300),
+        retries: int = 3,
+        backoff_factor: float = 0.5) -> requests.Session:
+    """
+    Create a pooled session with a default timeout (a single number, or a
+    (connect, read) pair in seconds) and retries.
+    """
+    retry = _JitterRetry(
+        total=retries,
+        # A request that failed to connect was never sent, whatever its method
+        connect=retries,
+        # A read timeout may mean the server is still working on the request
+        read=0,
+        status=retries,
+        status_forcelist=_RETRY_STATUSES,
+        backoff_factor=backoff_factor,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = _TimeoutSession(timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
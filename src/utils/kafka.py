@@ -2,14 +2,19 @@
 Helper methods for recieving and sending messages from and to Kafka.
 """
 from confluent_kafka import Consumer, Producer
-from typing import List, Any, Callable
+from typing import List, Any, Callable, Optional
 import json
+import threading
 
 from src.utils.logger import logger
 from src.utils.config import config
 
 _KAFKA_PRODUCE_RETRIES = 5
 
+# Process-wide producer, created on first use. Producers are thread-safe.
+_PRODUCER = None  # type: Optional[Producer]
+_PRODUCER_LOCK = threading.Lock()
+
 
 def init_consumer(topics: List[str]) -> Consumer:
     """
@@ -47,25 +52,62 @@ def produce(
         topic: str = config()['topics']['admin_events'],
         callback: Callable = None) -> None:
     """
-    Produce a new event message on a Kafka topic and block for it to get published.
+    Produce a new event message on a Kafka topic without waiting for it to get published.
+
+    Messages are batched by a long-lived producer and delivered in the
+    background. Call flush_producer() before doing anything that depends on
+    the message having been delivered, such as committing the offset of the
+    message that caused it to be produced.
 
-    If the produce fails, it will be retried at most _KAFKA_PRODUCE_RETRIES
-    tries (defaults to 5).
+    If the producer queue is full, we wait for deliveries and retry at most
+    _KAFKA_PRODUCE_RETRIES times (defaults to 5).
 
     Args:
         data: the data to send to Kafka. Must be JSONable.
         topic: the topic where the data will be sent.
         callback: a callable provided to the confluent Kafka Producer class.
     """
-    producer = Producer({'bootstrap.servers': config()['kafka_server']})
+    producer = _get_producer()
     tries = 0
     while True:
         try:
             producer.produce(topic, json.dumps(data), callback=callback)
-            producer.flush()
             break
         except BufferError:
             if tries == _KAFKA_PRODUCE_RETRIES:
                 raise RuntimeError("Unable to produce a Kafka message due to BufferError")
             logger.error("Received a BufferError trying to produce a message on Kafka. Retrying..")
+            # Wait for some queued messages to be delivered
+            producer.poll(1)
             tries += 1
+    # Serve delivery callbacks for earlier messages
+    producer.poll(0)
+
+
+def flush_producer(timeout: Optional[float] = None) -> None:
+    """
+    Block until every message produced so far has been delivered (or has
+    failed, which is reported through its callback). A no-op if nothing has
+    been produced in this process.
+
+    Raises RuntimeError if messages remain undelivered after `timeout` seconds.
+    """
+    if _PRODUCER is None:
+        return
+    remaining = _PRODUCER.flush() if timeout is None else _PRODUCER.flush(timeout)
+    if remaining:
+        raise RuntimeError(f"{remaining} Kafka messages were not delivered in time")
+
+
+def _get_producer() -> Producer:
+    """Get the process-wide producer, creating it if needed."""
+    global _PRODUCER
+    with _PRODUCER_LOCK:
+        if _PRODUCER is None:
+            conf = config()
+            _PRODUCER = Producer({
+                'bootstrap.servers': conf['kafka_server'],
+                'linger.ms': conf['kafka_linger_ms'],
+                'batch.num.messages': conf['kafka_batch_messages'],
+            })
+        return _PRODUCER
@@ -0,0 +1,62 @@
+"""
+Persistent local cache of the first version of workspace objects.
+
+Version 1 of an object never changes, so its info (used for the creation date
+of index documents) can be kept forever. Only the object info tuple is kept, so
+each entry stays small. Stored in SQLite so that it survives restarts and can
+be shared by every worker process on a host.
+"""
+from typing import List, Optional
+import json
+import os
+import sqlite3
+import threading
+
+from src.utils.config import config
+from src.utils.logger import logger
+
+_LOCK = threading.Lock()
+_CONN = None  # type: Optional[sqlite3.Connection]
+
+
+def get(upa: str) -> Optional[list]:
+    """Get the cached object info for "wsid/objid" version 1."""
+    conn = _get_conn()
+    if conn is None:
+        return None
+    with _LOCK:
+        row = conn.execute('SELECT info FROM obj_v1_info WHERE upa = ?', (upa,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def put(upa: str, info: List) -> None:
+    """Save the object info for "wsid/objid" version 1."""
+    conn = _get_conn()
+    if conn is None:
+        return
+    with _LOCK:
+        conn.execute('INSERT OR REPLACE INTO obj_v1_info (upa, info) VALUES (?, ?)', (upa, json.dumps(info)))
+        conn.commit()
+
+
+def _get_conn() -> Optional[sqlite3.Connection]:
+    """Open the database on first use. Returns None if the cache is disabled."""
+    global _CONN
+    with _LOCK:
+        if _CONN is None:
+            path = config()['obj_v1_cache_path']
+            if not path:
+                return None
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            logger.info(f'Using object version 1 cache at {path}')
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            # Allow readers in other processes while one process writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS obj_v1_info (upa TEXT PRIMARY KEY, info TEXT NOT NULL)')
+            # Full responses saved by earlier versions
+            conn.execute('DROP TABLE IF EXISTS obj_v1')
+            conn.commit()
+            _CONN = conn
+        return _CONN
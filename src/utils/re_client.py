@@ -3,9 +3,9 @@ Relation engine API client functions.
 """
 import json
 import re
-import requests
 
 from src.utils.config import config
+from src.utils.http_session import get_session
 
 # see https://www.arangodb.com/2018/07/time-traveling-with-graph-databases/
 # in unix epoch ms this is 2255/6/5
@@ -25,7 +25,7 @@ def clean_key(key):
 
 def stored_query(name, params):
     """Run a stored query."""
-    resp = requests.post(
+    resp = get_session('re_api').post(
         config()['re_api_url'] + '/api/v1/query_results',
         params={'stored_query': name},
         data=json.dumps(params),
@@ -41,7 +41,7 @@ def clear_collection(collection_name):
 
     collection_name - the collection to clear.
     """
-    resp = requests.post(
+    resp = get_session('re_api').post(
         config()['re_api_url'] + '/api/v1/query_results',
         data=json.dumps({
             'query': 'FOR d in @@col REMOVE(d) IN @@col',
@@ -59,7 +59,7 @@ def get_all_documents(collection_name):
 
     collection_name - the collection from which documents will be returned.
     """
-    resp = requests.post(
+    resp = get_session('re_api').post(
         config()['re_api_url'] + '/api/v1/query_results',
         data=json.dumps({
             'query': 'FOR d in @@col RETURN d',
@@ -74,7 +74,7 @@ def get_all_documents(collection_name):
 
 def get_doc(coll, key):
     """Fetch a doc in a collection by key."""
-    resp = requests.post(
+    resp = get_session('re_api').post(
         config()['re_api_url'] + '/api/v1/query_results',
         data=json.dumps({
             'query': "for v in @@coll filter v._key == @key limit 1 return v",
@@ -95,7 +95,7 @@ def check_doc_existence(wsid, objid):
     query = """
     for d in @@coll filter d._key == @key limit 1 return 1
     """
-    resp = requests.post(
+    resp = get_session('re_api').post(
         config()['re_api_url'] + '/api/v1/query_results',
         data=json.dumps({
             'query': query,
@@ -109,6 +109,33 @@ def check_doc_existence(wsid, objid):
     return resp.json()['count'] > 0
 
 
+def get_existing_objids(wsid, objids):
+    """
+    Find which of the objects in a workspace are in RE already, with one
+    query per thousand objects. Returns a set of object IDs.
+    """
+    query = """
+    for d in @@coll filter d._key in @keys return d._key
+    """
+    objids = list(objids)
+    existing = set()
+    # Keep each result within a single batch
+    for start in range(0, len(objids), 1000):
+        resp = get_session('re_api').post(
+            config()['re_api_url'] + '/api/v1/query_results',
+            data=json.dumps({
+                'query': query,
+                '@coll': 'ws_object',
+                'keys': [f"{wsid}:{objid}" for objid in objids[start:start + 1000]]
+            }),
+            headers={'Authorization': config()['re_api_token']}
+        )
+        if not resp.ok:
+            raise RuntimeError(resp.text)
+        existing.update(int(key.split(':')[1]) for key in resp.json()['results'])
+    return existing
+
+
 def get_edge(coll, from_key, to_key):
     """Fetch an edge by from and to keys."""
     query = """
@@ -117,7 +144,7 @@ def get_edge(coll, from_key, to_key):
         limit 1
         return v
     """
-    resp = requests.post(
+    resp = get_session('re_api').post(
         config()['re_api_url'] + '/api/v1/query_results',
         data=json.dumps({
             'query': query,
@@ -149,7 +176,7 @@ def save(coll_name, docs, on_duplicate='update'):
     payload = '\n'.join([json.dumps(d) for d in docs])
     params = {'collection': coll_name, 'on_duplicate': on_duplicate}
     params['display_errors'] = '1'
-    resp = requests.put(
+    resp = get_session('re_api').put(
         url,
         data=payload,
         params=params,
@@ -169,7 +196,7 @@ def execute_query(query, params=None):
         params = {}
     params['query'] = query
     url = config()['re_api_url'] + '/api/v1/query_results'
-    resp = requests.post(
+    resp = get_session('re_api').post(
         url,
         data=json.dumps(params),
         headers={'Authorization': config()['re_api_token']}
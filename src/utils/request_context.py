@@ -0,0 +1,121 @@
+"""
+Request-scoped memoization of Workspace lookups, backed by process-wide
+caches of workspace info and permissions.
+"""
+from typing import Dict
+import json
+import threading
+
+from src.utils.config import config
+from src.utils.ttl_cache import TTLCache
+import src.utils.obj_v1_cache as obj_v1_cache
+
+# Workspace info and permissions by workspace ID, shared by every event. Entries
+# are invalidated when we consume an event that changes them (see
+# invalidate_workspace), and otherwise expire after `ws_cache_ttl` seconds.
+# Created on first use (see _ws_cache).
+_WS_CACHES = {}  # type: Dict[str, TTLCache]
+_WS_CACHES_LOCK = threading.Lock()
+
+
+class RequestContext:
+    """
+    Cache of Workspace responses made while handling a single event, so that
+    each distinct lookup is made at most once. Create a new context for every
+    event; nothing in it is ever invalidated.
+
+    Cached responses are shared between callers and must not be mutated.
+    Errors are not cached.
+    """
+
+    def __init__(self):
+        self._cache = {}  # type: dict
+
+    def admin_req(self, method: str, params: dict):
+        """Memoized version of the workspace client's admin_req."""
+        key = _cache_key(method, params)
+        if key not in self._cache:
+            self._cache[key] = config()['ws_client'].admin_req(method, params)
+        return self._cache[key]
+
+    def get_object(self, ref: str) -> dict:
+        """
+        Fetch the full `getObjects` response for an object reference. The
+        response is also cached under the resolved "wsid/objid/ver" reference,
+        so fetching the latest version and then that exact version costs a
+        single call.
+        """
+        resp = self.admin_req('getObjects', {'objects': [{'ref': ref}]})
+        if resp and resp.get('data') and resp['data'][0]:
+            info = resp['data'][0]['info']
+            versioned_ref = f"{info[6]}/{info[0]}/{info[4]}"
+            self._cache.setdefault(_cache_key('getObjects', {'objects': [{'ref': versioned_ref}]}), resp)
+        return resp
+
+    def get_obj_v1(self, upa: str) -> dict:
+        """
+        Fetch the object info for the first version of the object at
+        "wsid/objid", as `{'info': info}`. Served from the persistent
+        obj_v1_cache when possible.
+        """
+        info = obj_v1_cache.get(upa)
+        if info is None:
+            resp = self.admin_req('getObjects', {'objects': [{'ref': upa + '/1'}], 'no_data': 1})
+            info = resp['data'][0]['info']
+            obj_v1_cache.put(upa, info)
+        return {'info': info}
+
+    def get_obj_info(self, ref: str) -> list:
+        """Fetch the object info tuple for an object reference."""
+        return self.admin_req('getObjectInfo', {'objects': [{'ref': ref}]})['infos'][0]
+
+    def get_ws_info(self, wsid: int) -> list:
+        """Fetch the workspace info tuple."""
+        return self._shared_req(_ws_cache('ws_info'), wsid, 'getWorkspaceInfo', {'id': wsid})
+
+    def get_permissions(self, wsid: int) -> dict:
+        """Fetch the mapping of username to permission for a workspace."""
+        resp = self._shared_req(_ws_cache('ws_perms'), wsid, 'getPermissionsMass', {'workspaces': [{'id': wsid}]})
+        return resp['perms'][0]
+
+    def _shared_req(self, cache: TTLCache, wsid: int, method: str, params: dict):
+        """Like admin_req, but also checks and fills a process-wide cache keyed by wsid."""
+        key = _cache_key(method, params)
+        if key not in self._cache:
+            resp = cache.get(int(wsid))
+            if resp is None:
+                resp = config()['ws_client'].admin_req(method, params)
+                cache.set(int(wsid), resp)
+            self._cache[key] = resp
+        return self._cache[key]
+
+
+def invalidate_workspace(wsid: int) -> None:
+    """Drop the cached info and permissions for a workspace."""
+    _ws_cache('ws_info').invalidate(int(wsid))
+    _ws_cache('ws_perms').invalidate(int(wsid))
+
+
+def cache_stats() -> dict:
+    """Hit and miss counts for the process-wide workspace caches."""
+    return {name: _ws_cache(name).stats() for name in ('ws_info', 'ws_perms')}
+
+
+def _ws_cache(name: str) -> TTLCache:
+    """
+    Get a process-wide workspace cache, creating it on first use. Its size and
+    TTL follow the current configuration, so a refresh applies to later entries.
+    """
+    maxsize = config()['ws_cache_size']
+    ttl = config()['ws_cache_ttl']
+    cache = _WS_CACHES.get(name)
+    if cache is None:
+        with _WS_CACHES_LOCK:
+            cache = _WS_CACHES.setdefault(name, TTLCache(maxsize, ttl))
+    cache.maxsize = maxsize
+    cache.ttl = ttl
+    return cache
+
+
+def _cache_key(method: str, params: dict) -> tuple:
+    return (method, json.dumps(params, sort_keys=True))
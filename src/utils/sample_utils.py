@@ -1,6 +1,6 @@
 import json
-import requests
 from src.utils.config import config
+from src.utils.http_session import get_session
 
 
 def get_sample(sample_info):
@@ -20,7 +20,11 @@ def get_sample(sample_info):
         "params": [params],
         "version": "1.1"
     }
-    resp = requests.post(url=config()['sample_service_url'], headers=headers, data=json.dumps(payload))
+    resp = get_session('sample_service').post(
+        url=config()['sample_service_url'],
+        headers=headers,
+        data=json.dumps(payload)
+    )
     if not resp.ok:
         raise RuntimeError(f"Returned from sample service with status {resp.status_code} - {resp.text}")
     resp_json = resp.json()
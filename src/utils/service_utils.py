@@ -29,7 +29,7 @@ def _wait_for_service(url, name, start_time, timeout, params=None):
     while True:
         try:
             logger.info(f'Waiting for {name} service...')
-            requests.get(url, params=params).raise_for_status()
+            requests.get(url, params=params, timeout=(5, 90)).raise_for_status()
             logger.info(f'{name} is up!')
             break
         except Exception as err:
@@ -0,0 +1,154 @@
+"""
+Streaming downloads of Shock files.
+
+A file is read from the HTTP response by a background thread into a bounded
+queue of chunks, so the download keeps going while the caller decompresses,
+parses and indexes what it has already read. At most `shock_prefetch_bytes`
+are held ahead of the reader.
+
+Completed downloads are kept in the local file cache (see file_cache), so a
+retry, reindex or copy of the same object reads the file from disk instead.
+"""
+from kbase_workspace_client.exceptions import MissingShockFile, UnauthorizedShockDownload
+from typing import Iterator, Optional
+import contextlib
+import io
+import queue
+import threading
+
+from src.utils import file_cache
+from src.utils.config import config
+from src.utils.http_session import get_session
+from src.utils.logger import logger
+
+_CHUNK_SIZE = 1024 * 1024
+# Marks the end of the download in the chunk queue
+_END = object()
+
+
+@contextlib.contextmanager
+def open_handle_stream(handle_id: str) -> Iterator[io.RawIOBase]:
+    """
+    Open the Shock file for a handle ID as a binary file object, which is
+    filled in the background as the caller reads from it. Raises
+    UnauthorizedShockDownload or MissingShockFile, as the workspace client does.
+    """
+    shock_id = config()['ws_client'].handle_to_shock(handle_id)
+    cached = _open_cached(shock_id)
+    if cached is not None:
+        with cached:
+            yield cached
+        return
+    node_url = f"{config()['kbase_endpoint']}/shock-api/node/{shock_id}"
+    headers = {'Authorization': 'OAuth ' + config()['ws_token']}
+    session = get_session('shock')
+    resp = session.get(node_url, headers=headers)
+    if not resp.ok:
+        raise RuntimeError(f"Error from shock: {resp.text}")
+    status = resp.json().get('status')
+    if status == 401:
+        raise UnauthorizedShockDownload(shock_id)
+    if status == 404:
+        raise MissingShockFile(shock_id)
+    with session.get(node_url + '?download_raw', headers=headers, stream=True) as resp:
+        if not resp.ok:
+            raise RuntimeError(f"Error downloading shock node {shock_id}: {resp.text}")
+        max_chunks = max(1, config()['shock_prefetch_bytes'] // _CHUNK_SIZE)
+        chunks = resp.iter_content(_CHUNK_SIZE)
+        if file_cache.enabled():
+            chunks = _cache_chunks(shock_id, chunks)
+        reader = PrefetchReader(chunks, max_chunks)
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+
+def _open_cached(shock_id: str):
+    """Open the cached file for a Shock node, or return None."""
+    path = file_cache.get(shock_id)
+    if path is None:
+        return None
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        # Evicted by another process
+        return None
+
+
+def _cache_chunks(shock_id: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Pass the chunks through, adding the file to the cache if every chunk is read."""
+    with file_cache.new_file(shock_id) as fwrite:
+        for chunk in chunks:
+            fwrite.write(chunk)
+            yield chunk
+    logger.debug(f'Cached shock node {shock_id}')
+
+
+class PrefetchReader(io.RawIOBase):
+    """
+    Read-only binary file over an iterator of byte chunks, which is consumed
+    by a background thread up to `max_chunks` ahead of the reader. Errors from
+    the iterator are raised by read.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], max_chunks: int):
+        super().__init__()
+        self._queue = queue.Queue(max_chunks)  # type: queue.Queue
+        self._stop = threading.Event()
+        self._buf = memoryview(b'')
+        self._done = False
+        self._error = None  # type: Optional[BaseException]
+        self._thread = threading.Thread(target=self._fill, args=(chunks,), name='shock-prefetch', daemon=True)
+        self._thread.start()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buf:
+            if self._done:
+                if self._error is not None:
+                    raise self._error
+                return 0
+            item = self._queue.get()
+            if item is _END:
+                self._done = True
+            else:
+                self._buf = memoryview(item)
+        size = min(len(b), len(self._buf))
+        b[:size] = self._buf[:size]
+        self._buf = self._buf[size:]
+        return size
+
+    def close(self) -> None:
+        """Stop the background reads and drop any prefetched chunks."""
+        self._stop.set()
+        # Unblock the thread if it is waiting for room in the queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        super().close()
+
+    def _fill(self, chunks: Iterator[bytes]) -> None:
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as err:
+            self._error = err
+        finally:
+            # Let a generator clean up when the reader stopped early
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        self._put(_END)
+
+    def _put(self, item) -> bool:
+        """Wait for room in the queue, giving up once the reader is closed."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
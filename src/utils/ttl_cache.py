@@ -0,0 +1,59 @@
+"""
+A small, thread-safe LRU cache whose entries also expire after a fixed time.
+"""
+from typing import Any, Hashable
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Bounded cache evicting the least recently used entry when full. Entries
+    older than `ttl` seconds are treated as missing. A `maxsize` or `ttl` of
+    zero disables caching. Tracks hit and miss counts.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (expiration time, value), in least to most recently used order
+        self._data = collections.OrderedDict()  # type: collections.OrderedDict
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value, or `default` if it is missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Hit and miss counts and the current size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
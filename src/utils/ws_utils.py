@@ -2,8 +2,8 @@ from kbase_workspace_client.exceptions import WorkspaceResponseError
 from typing import Optional
 import logging
 
-from src.utils.config import config
 from src.utils.logger import logger
+from src.utils.request_context import RequestContext
 
 
 def get_type_pieces(type_str):
@@ -17,7 +17,7 @@ def get_type_pieces(type_str):
     return (type_module, type_name, type_version)
 
 
-def get_obj_type(msg: dict) -> Optional[str]:
+def get_obj_type(msg: dict, ctx: Optional[RequestContext] = None) -> Optional[str]:
     """
     Get the versioned workspace type from a kafka message.
     """
@@ -27,10 +27,8 @@ def get_obj_type(msg: dict) -> Optional[str]:
     objid = msg.get('objid')
     wsid = msg.get('wsid')
     if objid is not None and wsid is not None:
-        info = config()['ws_client'].admin_req('getObjectInfo', {
-            'objects': [{'ref': f"{wsid}/{objid}"}]
-        })
-        return info['infos'][0][2]
+        ctx = ctx or RequestContext()
+        return ctx.get_obj_info(f"{wsid}/{objid}")[2]
     return None
 
 
@@ -36,7 +36,6 @@ def test_annotated_metagenome_assembly_indexer():
             data['obj']['data'],
             ama_index,
             ver_ama_index,
-            tmp_dir,
             conf
         )
         for (idx, msg_data) in enumerate(results):
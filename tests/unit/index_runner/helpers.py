@@ -6,8 +6,11 @@ import time
 class MockMessage:
     """Mock Kafka message returned in the mock consumer"""
 
-    def __init__(self, msg: str = '{}'):
+    def __init__(self, msg: str = '{}', topic: str = 'test', partition: int = 0, offset: int = 0):
         self.msg = msg
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
 
     def error(self):
         return None
@@ -15,6 +18,15 @@ class MockMessage:
     def value(self):
         return self.msg.encode()
 
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
 
 class MockConsumer:
     """Mock Kafka consumer for testing the event loop without needing Kafka itself."""
@@ -46,3 +58,47 @@ class MockConsumer:
         """Push a message to the queue for testing purposes. Most likely you
         want to call this before starting the event loop"""
         self.msg_queue.put(MockMessage())
+
+
+class MockPartitionConsumer:
+    """
+    Mock Kafka consumer that behaves like a real consumer for a single
+    partition: messages are delivered once, in order, and commits are recorded.
+    """
+
+    def __init__(self, topics: List[str]):
+        self.msg_queue = queue.Queue()
+        self.next_offset = 0
+        # Offset after the last message returned by consume()
+        self.position = 0
+        # Offsets passed to commit(), in call order
+        self.committed = []  # type: list
+
+    def poll(self, timeout: float):
+        if self.msg_queue.empty():
+            time.sleep(timeout)
+            return None
+        return self.msg_queue.get()
+
+    def consume(self, num_messages: int = 1, timeout: float = -1):
+        msgs = []
+        while len(msgs) < num_messages and not self.msg_queue.empty():
+            msgs.append(self.msg_queue.get())
+        if msgs:
+            self.position = msgs[-1].offset() + 1
+        else:
+            time.sleep(max(timeout, 0))
+        return msgs
+
+    def commit(self, message=None, offsets=None, asynchronous=True):
+        if message is not None:
+            self.committed.append(message.offset() + 1)
+        for tp in offsets or []:
+            self.committed.append(tp.offset)
+        if message is None and offsets is None:
+            # Commit the current consumed position
+            self.committed.append(self.position)
+
+    def produce_test(self, msg: str):
+        self.msg_queue.put(MockMessage(msg, offset=self.next_offset))
+        self.next_offset += 1
@@ -0,0 +1,87 @@
+"""
+Test functions found in src/index_runner/bulk_mode.py
+"""
+import json
+import responses
+
+from src.index_runner.bulk_mode import end_bulk_mode, start_bulk_mode, type_indexes
+from src.utils.config import config
+
+
+@responses.activate
+def test_start_bulk_mode():
+    """Settings are saved in the mapping metadata, except for indexes already in bulk mode."""
+    base_url = config()['elasticsearch_url']
+    prefix = config()['elasticsearch_index_prefix']
+    (idx1, idx2) = (f"{prefix}.genome_2", f"{prefix}.taxon_1")
+    responses.add(responses.GET, f"{base_url}/{idx1},{idx2}/_mapping", json={
+        idx1: {'mappings': {'_meta': {'other': 1}}},
+        idx2: {'mappings': {'_meta': {'bulk_mode_saved': {}}}},
+    })
+    responses.add(responses.GET, f"{base_url}/{idx1},{idx2}/_settings?flat_settings=true", json={
+        idx1: {'settings': {'index.number_of_replicas': '2'}},
+        idx2: {'settings': {'index.number_of_replicas': '0', 'index.refresh_interval': '-1'}},
+    })
+    responses.add(responses.PUT, f"{base_url}/{idx1}/_mapping", json={})
+    responses.add(responses.PUT, f"{base_url}/{idx1}/_settings", json={})
+    start_bulk_mode(['genome_2', 'taxon_1'])
+    puts = {call.request.url: json.loads(call.request.body) for call in responses.calls
+            if call.request.method == 'PUT'}
+    assert puts == {
+        f"{base_url}/{idx1}/_mapping": {'_meta': {
+            'other': 1,
+            'bulk_mode_saved': {'index.refresh_interval': None, 'index.number_of_replicas': '2'},
+        }},
+        f"{base_url}/{idx1}/_settings": {'index.refresh_interval': '-1', 'index.number_of_replicas': 0},
+    }
+
+
+@responses.activate
+def test_start_bulk_mode_skips_logs():
+    """The error and message log indexes stay searchable."""
+    base_url = config()['elasticsearch_url']
+    prefix = config()['elasticsearch_index_prefix']
+    idx = f"{prefix}.genome_2"
+    err_idx = f"{prefix}.{config()['error_index_name']}"
+    msg_idx = f"{prefix}.{config()['msg_log_index_name']}"
+    responses.add(responses.GET, f"{base_url}/{prefix}.*/_mapping", json={
+        idx: {'mappings': {}},
+        err_idx: {'mappings': {}},
+        msg_idx: {'mappings': {}},
+    })
+    responses.add(responses.GET, f"{base_url}/{prefix}.*/_settings?flat_settings=true", json={
+        name: {'settings': {}} for name in (idx, err_idx, msg_idx)
+    })
+    responses.add(responses.PUT, f"{base_url}/{idx}/_mapping", json={})
+    responses.add(responses.PUT, f"{base_url}/{idx}/_settings", json={})
+    start_bulk_mode()
+    assert {call.request.url for call in responses.calls if call.request.method == 'PUT'} == {
+        f"{base_url}/{idx}/_mapping", f"{base_url}/{idx}/_settings"
+    }
+
+
+def test_type_indexes():
+    latest = config()['global']['latest_versions']
+    assert type_indexes('KBaseGenomes.Genome-17.0') == sorted([latest['genome'], latest['genome_features']])
+    assert latest['attribute_mapping'] in type_indexes('KBaseMatrices.ExpressionMatrix-1.0')
+    assert type_indexes('KBaseUnknown.Type-1.0') == []
+
+
+@responses.activate
+def test_end_bulk_mode():
+    """Saved settings are restored and removed, then the indexes refreshed."""
+    base_url = config()['elasticsearch_url']
+    prefix = config()['elasticsearch_index_prefix']
+    (idx1, idx2) = (f"{prefix}.genome_2", f"{prefix}.taxon_1")
+    saved = {'index.refresh_interval': None, 'index.number_of_replicas': '2'}
+    responses.add(responses.GET, f"{base_url}/{prefix}.*/_mapping", json={
+        idx1: {'mappings': {'_meta': {'other': 1, 'bulk_mode_saved': saved}}},
+        idx2: {'mappings': {}},
+    })
+    responses.add(responses.PUT, f"{base_url}/{idx1}/_settings", json={})
+    responses.add(responses.PUT, f"{base_url}/{idx1}/_mapping", json={})
+    responses.add(responses.POST, f"{base_url}/{idx1}/_refresh", json={})
+    end_bulk_mode()
+    bodies = [json.loads(call.request.body) for call in responses.calls if call.request.method == 'PUT']
+    assert bodies == [saved, {'_meta': {'other': 1}}]
+    assert responses.calls[-1].request.url == f"{base_url}/{idx1}/_refresh"
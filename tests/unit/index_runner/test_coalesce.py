@@ -0,0 +1,51 @@
+"""
+Test functions found in src/index_runner/coalesce.py
+"""
+from src.index_runner.coalesce import coalesce_events, coalesce_groups
+
+
+def test_coalesce_new_versions():
+    """Several new versions of an object become one event for the highest version."""
+    events = [{'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': ver} for ver in (1, 3, 2)]
+    assert coalesce_events(events) == [{'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': 3, 'coalesced': 3}]
+
+
+def test_coalesce_reindex_wins():
+    """A REINDEX is kept over an INDEX_NONEXISTENT, and indexes the latest version."""
+    events = [
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 2},
+        {'evtype': 'INDEX_NONEXISTENT', 'wsid': 1, 'objid': 2},
+        {'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': 4},
+    ]
+    assert coalesce_events(events) == [{'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'coalesced': 3}]
+    assert coalesce_events(events[:2]) == [{'evtype': 'REINDEX', 'wsid': 1, 'objid': 2, 'coalesced': 2}]
+
+
+def test_coalesce_barrier():
+    """Events are not merged across another event for the same workspace."""
+    events = [
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 2},
+        {'evtype': 'REINDEX', 'wsid': 5, 'objid': 2},
+        {'evtype': 'OBJECT_DELETE_STATE_CHANGE', 'wsid': 1, 'objid': 2},
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 2},
+        {'evtype': 'REINDEX', 'wsid': 5, 'objid': 2},
+    ]
+    assert coalesce_events(events) == [
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 2},
+        {'evtype': 'REINDEX', 'wsid': 5, 'objid': 2, 'coalesced': 2},
+        {'evtype': 'OBJECT_DELETE_STATE_CHANGE', 'wsid': 1, 'objid': 2},
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 2},
+    ]
+
+
+def test_coalesce_groups():
+    """Each resulting event is paired with the original events it replaces."""
+    events = [
+        {'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': 1},
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 3},
+        {'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': 2},
+    ]
+    assert coalesce_groups(events) == [
+        ({'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': 2, 'coalesced': 2}, [events[0], events[2]]),
+        ({'evtype': 'REINDEX', 'wsid': 1, 'objid': 3}, [events[1]]),
+    ]
@@ -0,0 +1,366 @@
+"""
+Test functions found in src/index_runner/es_bulk.py
+"""
+import json
+import pytest
+import responses
+import threading
+import time
+from unittest.mock import patch
+
+from src.index_runner.es_bulk import BulkBuffer, BulkSink, doc_hash, encode_action, external_version
+from src.utils.config import config
+
+
+def _decode_ids(body):
+    """Get the document IDs, in order, from a bulk request body."""
+    lines = body.decode('utf-8').splitlines()
+    return [json.loads(line)['index']['_id'] for line in lines[::2]]
+
+
+def _recorder(bodies, statuses=None):
+    """
+    A `send` function that records request bodies. `statuses` maps a document
+    ID to the per-item statuses returned for it on successive requests.
+    """
+    statuses = statuses or {}
+
+    def send(body):
+        bodies.append(body)
+        items = []
+        for _id in _decode_ids(body):
+            status = statuses[_id].pop(0) if statuses.get(_id) else 201
+            result = {'_id': _id, 'status': status}
+            if status >= 300:
+                result['error'] = {'type': 'some_exception'}
+            items.append({'index': result})
+        return {'errors': any(item['index']['status'] >= 300 for item in items), 'items': items}
+    return send
+
+
+def test_encode_action():
+    action = encode_action({'index': 'genome_2', 'id': 'WS::1:2', 'doc': {'x': 1}})
+    (meta, doc) = action.decode('utf-8').splitlines()
+    prefix = config()['elasticsearch_index_prefix']
+    assert json.loads(meta) == {'index': {'_index': f'{prefix}.genome_2', '_id': 'WS::1:2'}}
+    assert json.loads(doc) == {'x': 1, 'index_runner_ver': config()['app_version']}
+
+
+def test_encode_action_version():
+    """Index actions use the datum's version as an external version; create actions cannot."""
+    datum = {'index': 'genome_2', 'id': 'WS::1:2', 'doc': {'x': 1}, 'version': 1600000000000}
+    meta = json.loads(encode_action(datum).decode('utf-8').splitlines()[0])['index']
+    assert meta['version'] == 1600000000000
+    assert meta['version_type'] == 'external_gte'
+    meta = json.loads(encode_action(datum, 'create').decode('utf-8').splitlines()[0])['create']
+    assert 'version' not in meta and 'version_type' not in meta
+
+
+def test_flush_on_doc_count():
+    """Batches are sent at the doc count limit and keep their order."""
+    bodies = []
+    bulk = BulkBuffer(max_docs=2, max_bytes=10**6, send=_recorder(bodies), max_in_flight=1)
+    for idx in range(5):
+        bulk.add({'index': 'test', 'id': idx, 'doc': {}})
+    bulk.flush()
+    assert [_decode_ids(body) for body in bodies] == [[0, 1], [2, 3], [4]]
+
+
+def test_flush_on_bytes():
+    """Batches stay under the byte budget, except for a single oversized doc."""
+    bodies = []
+    bulk = BulkBuffer(max_docs=100, max_bytes=300, send=_recorder(bodies), max_in_flight=1)
+    bulk.add({'index': 'test', 'id': 0, 'doc': {'seq': 'A' * 100}})
+    bulk.add({'index': 'test', 'id': 1, 'doc': {'seq': 'A' * 100}})
+    bulk.add({'index': 'test', 'id': 2, 'doc': {'seq': 'A' * 1000}})
+    bulk.add({'index': 'test', 'id': 3, 'doc': {}})
+    bulk.flush()
+    assert [_decode_ids(body) for body in bodies] == [[0], [1], [2], [3]]
+    assert all(len(body) <= 300 for (idx, body) in enumerate(bodies) if idx != 2)
+
+
+@patch('src.index_runner.es_bulk.time.sleep')
+def test_retry_rejected(sleep):
+    """Only documents rejected with a 429 are resent."""
+    bodies = []
+    bulk = BulkBuffer(max_docs=100, send=_recorder(bodies, {1: [429, 429]}), max_retries=3)
+    for idx in range(3):
+        bulk.add({'index': 'test', 'id': idx, 'doc': {}})
+    bulk.flush()
+    assert [_decode_ids(body) for body in bodies] == [[0, 1, 2], [1], [1]]
+    assert sleep.call_count == 2
+
+
+@patch('src.index_runner.es_bulk.time.sleep')
+def test_retry_exhausted(sleep):
+    bulk = BulkBuffer(max_docs=100, send=_recorder([], {0: [429] * 3}), max_retries=2)
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}})
+    with pytest.raises(RuntimeError):
+        bulk.flush()
+
+
+@responses.activate
+@patch('src.index_runner.es_bulk.time.sleep')
+def test_retry_overloaded_request(sleep):
+    """A whole request rejected with a 429 or 503 is sent again."""
+    url = f"{config()['elasticsearch_url']}/_bulk"
+    responses.add(responses.POST, url, status=429, body='too many requests')
+    responses.add(responses.POST, url, status=503, body='unavailable')
+    responses.add(responses.POST, url, json={'errors': False, 'items': []})
+    bulk = BulkBuffer(max_docs=100, max_retries=2, max_in_flight=1)
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}})
+    bulk.flush()
+    assert len(responses.calls) == 3
+    assert sleep.call_count == 2
+    responses.reset()
+    responses.add(responses.POST, url, status=429, body='too many requests')
+    bulk = BulkBuffer(max_docs=100, max_retries=0, max_in_flight=1)
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}})
+    with pytest.raises(RuntimeError):
+        bulk.flush()
+
+
+@patch('src.index_runner.es_bulk.send_bulk')
+def test_permanent_failure(send_bulk):
+    """Documents that fail for other reasons are saved to the error index, not retried."""
+    send_bulk.return_value = {'errors': False, 'items': []}
+    bodies = []
+    bulk = BulkBuffer(max_docs=100, send=_recorder(bodies, {1: [400]}))
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}})
+    bulk.add({'index': 'test', 'id': 1, 'doc': {'access_group': 1, 'obj_id': 2}})
+    bulk.flush()
+    assert len(bodies) == 1
+    (meta, doc) = [json.loads(line) for line in send_bulk.call_args[0][0].decode('utf-8').splitlines()]
+    assert meta['index']['_index'].endswith('.' + config()['error_index_name'])
+    assert doc['evtype'] == 'BULK_ITEM_ERROR'
+    assert (doc['wsid'], doc['objid']) == (1, 2)
+    assert 'some_exception' in doc['error']
+
+
+def test_pipelined_sends():
+    """Batches are sent in the background, with at most max_in_flight pending."""
+    bodies = []
+    record = _recorder(bodies)
+    release = threading.Event()
+    lock = threading.Lock()
+    pending = [0]
+    max_pending = [0]
+
+    def send(body):
+        with lock:
+            pending[0] += 1
+            max_pending[0] = max(max_pending[0], pending[0])
+        release.wait(5)
+        with lock:
+            pending[0] -= 1
+        return record(body)
+    bulk = BulkBuffer(max_docs=1, send=send, max_in_flight=2)
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}})
+    bulk.add({'index': 'test', 'id': 1, 'doc': {}})
+    # Neither request has finished, but we can keep adding documents
+    assert not bodies
+    release.set()
+    for idx in range(2, 6):
+        bulk.add({'index': 'test', 'id': idx, 'doc': {}})
+    bulk.flush()
+    assert sorted(_decode_ids(body)[0] for body in bodies) == list(range(6))
+    assert max_pending[0] <= 2
+
+
+def test_pipelined_error():
+    """An error in a background request is raised by flush."""
+    def send(body):
+        if _decode_ids(body) == [0]:
+            raise RuntimeError('Error saving to elasticsearch')
+        return _recorder([])(body)
+    bulk = BulkBuffer(max_docs=1, send=send, max_in_flight=3)
+    for idx in range(3):
+        bulk.add({'index': 'test', 'id': idx, 'doc': {}})
+    with pytest.raises(RuntimeError):
+        bulk.flush()
+    assert bulk._executor is None
+
+
+def test_discard():
+    """Discarding waits for the requests in flight and drops unsent documents, without raising."""
+    release = threading.Event()
+    bodies = []
+
+    def send(body):
+        release.wait(5)
+        if 0 in _decode_ids(body):
+            raise RuntimeError('Error saving to elasticsearch')
+        return _recorder(bodies)(body)
+    bulk = BulkBuffer(max_docs=2, send=send, max_in_flight=2)
+    for idx in range(5):
+        bulk.add({'index': 'test', 'id': idx, 'doc': {}})
+    threading.Timer(0.1, release.set).start()
+    bulk.discard()
+    assert bulk._executor is None and not bulk._in_flight and not bulk._entries
+    # The batch that failed is not raised, and the document after the last full batch is never sent
+    assert [_decode_ids(body) for body in bodies] == [[2, 3]]
+
+
+def test_sink_due():
+    sink = BulkSink(max_wait=60, max_docs=3, send=_recorder([]))
+    assert sink.due()
+    sink.add({'index': 'test', 'id': 0, 'doc': {}})
+    sink.add({'index': 'test', 'id': 1, 'doc': {}})
+    assert not sink.due()
+    sink.add({'index': 'test', 'id': 2, 'doc': {}})
+    assert sink.due()
+    sink = BulkSink(max_wait=0.01, send=_recorder([]))
+    sink.add({'index': 'test', 'id': 0, 'doc': {}})
+    time.sleep(0.02)
+    assert sink.due()
+
+
+def test_sink_flush():
+    """Documents from BulkBuffers are collected and sent in batches by the sink."""
+    bodies = []
+    sink = BulkSink(max_wait=60, max_docs=2, send=_recorder(bodies))
+    for idx in range(3):
+        bulk = BulkBuffer(max_docs=100, send=_recorder(bodies))
+        bulk.add({'index': 'test', 'id': idx, 'doc': {}})
+        bulk.flush(sink)
+    assert not bodies
+    sink.flush()
+    assert [_decode_ids(body) for body in bodies] == [[0, 1], [2]]
+    assert sink.due()
+
+
+def test_sink_flush_error():
+    """Documents that could not be sent are kept for the next flush."""
+    bodies = []
+    record = _recorder(bodies)
+    fail = [True]
+
+    def send(body):
+        if fail[0] and _decode_ids(body) == [2]:
+            raise RuntimeError('Error saving to elasticsearch')
+        return record(body)
+    sink = BulkSink(max_wait=60, max_docs=2, send=send)
+    for idx in range(3):
+        sink.add({'index': 'test', 'id': idx, 'doc': {}})
+    with pytest.raises(RuntimeError):
+        sink.flush()
+    sink.add({'index': 'test', 'id': 3, 'doc': {}})
+    fail[0] = False
+    sink.flush()
+    assert [_decode_ids(body) for body in bodies] == [[0, 1], [2, 3]]
+
+
+@patch('src.index_runner.es_bulk.send_bulk')
+def test_sink_discard(send_bulk):
+    """Discarded documents are saved to the error index, and deferred calls are dropped."""
+    send_bulk.return_value = {'errors': False, 'items': []}
+    calls = []
+    sink = BulkSink(max_wait=60, send=_recorder([]))
+    sink.add({'index': 'test', 'id': 0, 'doc': {'access_group': 1, 'obj_id': 2}})
+    sink.defer('key', lambda: calls.append(1))
+    sink.discard(RuntimeError('Error saving to elasticsearch'))
+    (meta, doc) = [json.loads(line) for line in send_bulk.call_args[0][0].decode('utf-8').splitlines()]
+    assert meta['index']['_index'].endswith('.' + config()['error_index_name'])
+    assert (doc['wsid'], doc['objid']) == (1, 2)
+    assert 'Error saving to elasticsearch' in doc['error']
+    assert sink.due()
+    sink.flush()
+    assert not calls
+
+
+def test_doc_hash():
+    """The hash ignores key order, excluded fields and any previous hash."""
+    assert doc_hash({'a': 1, 'b': 2}) == doc_hash({'b': 2, 'a': 1})
+    assert doc_hash({'a': 1}) == doc_hash({'a': 1, 'index_runner_ver': 'x', 'doc_hash': 'y'})
+    assert doc_hash({'a': 1}) != doc_hash({'a': 2})
+
+
+@responses.activate
+def test_skip_unchanged():
+    """Documents whose stored hash matches are not sent."""
+    unchanged = {'name': 'same'}
+    responses.add(responses.POST, f"{config()['elasticsearch_url']}/_mget", json={'docs': [
+        {'_id': 0, 'found': True, '_source': {'doc_hash': doc_hash(dict(unchanged))}},
+        {'_id': 1, 'found': True, '_source': {'doc_hash': 'outdated'}},
+        {'_id': 2, 'found': False},
+    ]})
+    bodies = []
+    bulk = BulkBuffer(max_docs=100, send=_recorder(bodies), skip_unchanged=True)
+    bulk.add({'index': 'test', 'id': 0, 'doc': dict(unchanged)})
+    bulk.add({'index': 'test', 'id': 1, 'doc': {'name': 'changed'}})
+    bulk.add({'index': 'test', 'id': 2, 'doc': {'name': 'new'}})
+    bulk.flush()
+    assert [_decode_ids(body) for body in bodies] == [[1, 2]]
+    sources = [json.loads(line) for line in bodies[0].decode('utf-8').splitlines()[1::2]]
+    assert all(src['doc_hash'] == doc_hash(src) for src in sources)
+    mget = json.loads(responses.calls[0].request.body)
+    assert [doc['_source'] for doc in mget['docs']] == [['doc_hash']] * 3
+
+
+def test_sink_defer():
+    """Deferred calls run once per key, after the documents are sent."""
+    bodies = []
+    calls = []
+    sink = BulkSink(max_wait=60, send=_recorder(bodies))
+    sink.defer('a', lambda: calls.append(('a1', len(bodies))))
+    assert not sink.due()
+    sink.add({'index': 'test', 'id': 0, 'doc': {}})
+    sink.defer('b', lambda: calls.append(('b', len(bodies))))
+    sink.defer('a', lambda: calls.append(('a2', len(bodies))))
+    sink.flush()
+    assert calls == [('b', 1), ('a2', 1)]
+    assert sink.due()
+
+
+@patch('src.index_runner.es_bulk.send_bulk')
+def test_create_conflicts(send_bulk):
+    """Create actions for documents that already exist are not errors."""
+    bodies = []
+
+    def send(body):
+        bodies.append(body)
+        return {'errors': True, 'items': [
+            {'create': {'_id': 0, 'status': 201}},
+            {'create': {'_id': 1, 'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}},
+        ]}
+    bulk = BulkBuffer(max_docs=100, send=send, op_type='create')
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}})
+    bulk.add({'index': 'test', 'id': 1, 'doc': {}})
+    bulk.flush()
+    actions = [json.loads(line) for line in bodies[0].decode('utf-8').splitlines()[::2]]
+    assert [list(action) for action in actions] == [['create'], ['create']]
+    # Nothing is retried or saved to the error index
+    assert len(bodies) == 1
+    assert not send_bulk.called
+
+
+@responses.activate
+@patch('src.index_runner.es_bulk.time.sleep')
+def test_rewrite_after_update_by_query(sleep):
+    """
+    A rewrite rejected because updates by query raised the stored version is sent
+    again with that version; one rejected for a newer object version is dropped.
+    """
+    version = external_version(1600000000000)
+    bodies = []
+
+    def send(body):
+        bodies.append(body)
+        metas = [json.loads(line)['index'] for line in body.decode('utf-8').splitlines()[::2]]
+        if len(bodies) > 1:
+            return {'errors': False, 'items': [{'index': {'_id': m['_id'], 'status': 200}} for m in metas]}
+        conflict = {'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}
+        return {'errors': True, 'items': [{'index': {'_id': m['_id'], **conflict}} for m in metas]}
+    responses.add(responses.POST, f"{config()['elasticsearch_url']}/_mget", json={'docs': [
+        {'_id': 0, 'found': True, '_version': version + 2},
+        {'_id': 1, 'found': True, '_version': external_version(1600000000001)},
+    ]})
+    bulk = BulkBuffer(max_docs=100, send=send, max_in_flight=1)
+    bulk.add({'index': 'test', 'id': 0, 'doc': {}, 'version': version})
+    bulk.add({'index': 'test', 'id': 1, 'doc': {}, 'version': version})
+    bulk.flush()
+    assert len(bodies) == 2
+    meta = json.loads(bodies[1].decode('utf-8').splitlines()[0])['index']
+    assert (meta['_id'], meta['version']) == (0, version + 2)
+    assert len(bodies[1].decode('utf-8').splitlines()) == 2
+    assert not sleep.called
@@ -1,34 +1,54 @@
 """
 Test functions found in src/index_runner/es_indexer.py
 """
-import responses
+from unittest.mock import patch
 from uuid import uuid4
+import hashlib
+import json
+import pytest
+import responses
 
-from src.index_runner.es_indexer import set_user_perms
+from src.index_runner.es_bulk import BulkSink
+from src.index_runner.es_indexer import (
+    _PERMS_SCRIPT_ID,
+    _init_generic_index,
+    _ws_indexes,
+    delete_obj,
+    init_indexes,
+    reload_aliases,
+    run_indexer,
+    set_perms,
+    set_user_perms,
+)
 from src.utils.config import config
 
 
+def _mock_ws_perms(wsid, global_read, perms):
+    """Mock the workspace calls for a workspace's info and permissions."""
+    def callback(request):
+        command = json.loads(request.body)['params'][0]['command']
+        if command == 'getWorkspaceInfo':
+            result = [wsid, 'name', 'owner', 'date', 1, 'a', global_read, 'unlocked', {}]
+        else:
+            result = {'perms': [perms]}
+        return (200, {}, json.dumps({'version': '1.1', 'result': [result]}))
+    responses.add_callback(responses.POST, config()['workspace_url'], callback=callback)
+
+
 @responses.activate
 def test_set_user_perms():
     """
     Mostly we are just asserting that the correct ES api call gets made ("expected_req")
     """
     wsid = 44869
-    # Response for getPermissionsMass function from workspace
-    mock_resp = {
-        "version": "1.1",
-        "result": [{"perms": [{"user1": "a", "user2": "r"}]}]
-    }
-    # Mock the workspace call
-    responses.add(responses.POST, config()['workspace_url'], json=mock_resp)
-    # Mock the Elasticsearch update
+    _mock_ws_perms(wsid, 'r', {"user1": "a", "user2": "r", "*": "r"})
     base_url = config()['elasticsearch_url']
-    idx = config()['elasticsearch_index_prefix'] + ".*"
-    es_url = f"{base_url}/{idx}/_update_by_query?conflicts=proceed&wait_for_completion=true&refresh=true"
-    script = "ctx._source.shared_users=['user1', 'user2']"
+    responses.add(responses.PUT, f"{base_url}/_scripts/{_PERMS_SCRIPT_ID}", json={})
+    # Mock the Elasticsearch update
+    es_url = f"{base_url}/{','.join(_ws_indexes())}/_update_by_query"
     expected_req = {
         'query': {'term': {'access_group': wsid}},
-        'script': {'inline': script, 'lang': 'painless'},
+        'script': {'id': _PERMS_SCRIPT_ID, 'params': {'is_public': True, 'shared_users': ['user1', 'user2']}},
     }
     resp_body = str(uuid4())
     responses.add(
@@ -42,5 +62,126 @@ def test_set_user_perms():
     msg = {
         "wsid": wsid,
     }
-    resp = set_user_perms(msg)
-    assert resp.text == resp_body
+    sink = BulkSink(max_wait=60)
+    with patch('src.index_runner.es_bulk._SINK', sink):
+        set_user_perms(msg)
+        set_perms(msg)
+        # Nothing happens until the sink is flushed
+        assert not [call for call in responses.calls if call.request.url.startswith(es_url)]
+        sink.flush()
+    updates = [call for call in responses.calls if call.request.url.startswith(es_url)]
+    # Both events result in one update
+    assert len(updates) == 1
+    assert updates[0].response.text == resp_body
+    assert 'refresh' not in updates[0].request.url
+
+
+def test_ws_indexes():
+    """Deletes target versioned indexes and generic indexes, but not the log indexes."""
+    prefix = config()['elasticsearch_index_prefix']
+    indexes = _ws_indexes()
+    assert f"{prefix}.genome_2" in indexes
+    assert f"{prefix}.genome_features_2" in indexes
+    assert f"{prefix}.*_0" in indexes
+    assert f"{prefix}.indexing_errors_1" not in indexes
+    assert f"{prefix}.indexer_messages_1" not in indexes
+
+
+@responses.activate
+def test_init_indexes():
+    """Only missing indexes and indexes with changed mappings are written."""
+    base_url = config()['elasticsearch_url']
+    prefix = config()['elasticsearch_index_prefix']
+    mappings = {
+        'new_1': {'properties': {'a': {'type': 'keyword'}}},
+        'same_1': {'properties': {'b': {'type': 'keyword'}}},
+        'changed_1': {'properties': {'c': {'type': 'keyword'}}},
+    }
+    same_props = {'b': {'type': 'keyword'}, **config()['global']['global_mappings']['all']}
+    same_hash = hashlib.blake2b(json.dumps(same_props, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+    responses.add(responses.GET, f"{base_url}/{prefix}.*/_mapping", json={
+        f"{prefix}.same_1": {'mappings': {'_meta': {'mapping_hash': same_hash}}},
+        f"{prefix}.changed_1": {'mappings': {'_meta': {'mapping_hash': 'outdated', 'other': 1}}},
+    })
+    responses.add(responses.PUT, f"{base_url}/{prefix}.new_1", json={})
+    responses.add(responses.PUT, f"{base_url}/{prefix}.changed_1/_mapping", json={})
+    with patch('src.index_runner.es_indexer._MAPPINGS', mappings):
+        init_indexes()
+    writes = {call.request.url: json.loads(call.request.body) for call in responses.calls[1:]}
+    assert set(writes) == {f"{base_url}/{prefix}.new_1", f"{base_url}/{prefix}.changed_1/_mapping"}
+    assert writes[f"{base_url}/{prefix}.new_1"]['mappings']['properties']['a'] == {'type': 'keyword'}
+    changed = writes[f"{base_url}/{prefix}.changed_1/_mapping"]
+    assert changed['_meta']['other'] == 1
+    assert changed['_meta']['mapping_hash'] != 'outdated'
+
+
+@responses.activate
+def test_reload_aliases():
+    """Missing members are added and stale ones removed in one request, keeping generic indexes."""
+    base_url = config()['elasticsearch_url']
+    prefix = config()['elasticsearch_index_prefix']
+    aliases = {'default_search': ['genome_2', 'taxon_2'], 'genome': ['genome_2']}
+    responses.add(responses.GET, f"{base_url}/{prefix}.*/_alias", json={
+        f"{prefix}.genome_1": {'aliases': {f"{prefix}.genome": {}, f"{prefix}.default_search": {}}},
+        f"{prefix}.taxon_2": {'aliases': {f"{prefix}.default_search": {}}},
+        f"{prefix}.thing_0": {'aliases': {f"{prefix}.default_search": {}}},
+        f"{prefix}.genome_2": {'aliases': {}},
+    })
+    responses.add(responses.POST, f"{base_url}/_aliases", json={})
+    with patch.dict(config()['global'], {'aliases': aliases}):
+        reload_aliases()
+    assert len(responses.calls) == 2
+    actions = json.loads(responses.calls[1].request.body)['actions']
+    assert sorted(actions, key=json.dumps) == sorted([
+        {'add': {'index': f"{prefix}.genome_2", 'alias': f"{prefix}.default_search"}},
+        {'remove': {'index': f"{prefix}.genome_1", 'alias': f"{prefix}.default_search"}},
+        {'add': {'index': f"{prefix}.genome_2", 'alias': f"{prefix}.genome"}},
+        {'remove': {'index': f"{prefix}.genome_1", 'alias': f"{prefix}.genome"}},
+    ], key=json.dumps)
+
+
+@responses.activate
+def test_init_generic_index():
+    """Generic indexes are initialized at most once, and not at all if they already exist."""
+    base_url = config()['elasticsearch_url']
+    prefix = config()['elasticsearch_index_prefix']
+    responses.add(responses.GET, f"{base_url}/_cat/aliases/{prefix}.default_search", json=[
+        {'index': f"{prefix}.genome_2"},
+        {'index': f"{prefix}.existing_0"},
+    ])
+    responses.add(responses.PUT, f"{base_url}/{prefix}.newtype_0", json={})
+    responses.add(responses.PUT, f"{base_url}/{prefix}.newtype_0/_mapping", json={})
+    responses.add(responses.POST, f"{base_url}/_aliases", json={})
+    with patch('src.index_runner.es_indexer._GENERIC_INDEXES', None):
+        _init_generic_index({'full_type_name': 'Module.Existing-1.0'})
+        assert len(responses.calls) == 1
+        _init_generic_index({'full_type_name': 'Module.NewType-1.0'})
+        _init_generic_index({'full_type_name': 'Module.NewType-2.0'})
+    assert [call.request.method for call in responses.calls] == ['GET', 'PUT', 'PUT', 'POST']
+
+
+def test_run_indexer_error():
+    """Documents sent before an indexer fails are waited for, and the rest are dropped."""
+    def index_obj(obj, ws_info, msg, ctx):
+        yield {'_action': 'index', 'index': 'test', 'id': 1, 'doc': {}}
+        raise RuntimeError('indexer failed')
+    with patch('src.index_runner.es_indexer.index_obj', index_obj), \
+            patch('src.index_runner.es_indexer.BulkBuffer') as bulk_cls:
+        with pytest.raises(RuntimeError):
+            run_indexer({'epoch': 1}, [], {})
+    bulk = bulk_cls.return_value
+    bulk.discard.assert_called_once_with()
+    bulk.flush.assert_not_called()
+
+
+def test_delete_obj_after_flush():
+    """An object is deleted once the buffered documents are sent, if it is still deleted then."""
+    sink = BulkSink(max_wait=60)
+    with patch('src.index_runner.es_bulk._SINK', sink), \
+            patch('src.index_runner.es_indexer.check_object_deleted', return_value=True) as check, \
+            patch('src.index_runner.es_indexer.es_tasks.delete_by_query') as delete_by_query:
+        delete_obj({'wsid': 1, 'objid': 2})
+        assert not check.called and not delete_by_query.called
+        sink.flush()
+    check.assert_called_once_with(1, 2)
+    assert delete_by_query.call_args[0][3:] == (1, 2)
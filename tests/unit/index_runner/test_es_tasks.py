@@ -0,0 +1,116 @@
+"""
+Test functions found in src/index_runner/es_tasks.py
+"""
+from unittest.mock import patch
+from uuid import uuid4
+import json
+import pytest
+import responses
+
+from src.index_runner import es_tasks
+from src.utils.config import config
+
+_ES_URL = config()['elasticsearch_url']
+
+
+@pytest.fixture(autouse=True)
+def registry(tmp_path):
+    """Use a new registry for each test."""
+    _close()
+    with patch.dict(config()._cfg, {'es_task_registry_path': str(tmp_path / 'es_tasks.sqlite')}):
+        yield
+        _close()
+
+
+def _close():
+    if es_tasks._CONN is not None:
+        es_tasks._CONN.close()
+    es_tasks._CONN = None
+
+
+def _task_ids():
+    return [row[0] for row in es_tasks.pending_tasks()]
+
+
+def _add_submit(task_id):
+    responses.add(responses.POST, f"{_ES_URL}/idx1,idx2/_delete_by_query", json={'task': task_id})
+
+
+@responses.activate
+def test_delete_by_query():
+    """The request is submitted without waiting and saved in the registry."""
+    task_id = f'node:{uuid4()}'
+    _add_submit(task_id)
+    query = {'term': {'access_group': 1}}
+    assert es_tasks.delete_by_query(['idx1', 'idx2'], query, 'test', 1) == task_id
+    req = responses.calls[0].request
+    assert 'wait_for_completion=false' in req.url
+    assert json.loads(req.body) == {'query': query}
+    assert task_id in _task_ids()
+    # Finished without failures
+    responses.add(responses.GET, f"{_ES_URL}/_tasks/{task_id}",
+                  json={'completed': True, 'response': {'deleted': 3, 'failures': []}})
+    es_tasks.poll()
+    assert task_id not in _task_ids()
+
+
+@responses.activate
+def test_poll_resubmits():
+    """Failed and lost tasks are submitted again; running ones are left alone."""
+    (failed, lost, running) = [f'node:{uuid4()}' for _ in range(3)]
+    for task_id in (failed, lost, running):
+        _add_submit(task_id)
+        es_tasks.delete_by_query(['idx1', 'idx2'], {'match_all': {}}, 'test', 1, 2)
+    responses.reset()
+    responses.add(responses.GET, f"{_ES_URL}/_tasks/{failed}",
+                  json={'completed': True, 'response': {'failures': [{'cause': 'x'}]}})
+    responses.add(responses.GET, f"{_ES_URL}/_tasks/{lost}", status=404, json={})
+    responses.add(responses.GET, f"{_ES_URL}/_tasks/{running}", json={'completed': False})
+    resubmitted = []
+
+    def submit(request):
+        resubmitted.append(f'node:{uuid4()}')
+        return (200, {}, json.dumps({'task': resubmitted[-1]}))
+    responses.add_callback(responses.POST, f"{_ES_URL}/idx1,idx2/_delete_by_query", callback=submit)
+    with patch('src.index_runner.es_tasks.check_object_deleted', return_value=True) as check:
+        es_tasks.poll()
+    check.assert_called_with(1, 2)
+    rows = {row[0]: row for row in es_tasks.pending_tasks()}
+    assert failed not in rows and lost not in rows
+    assert running in rows
+    assert len(resubmitted) == 2
+    assert all(rows[task_id][4:] == (2, 1, 2) for task_id in resubmitted)
+
+
+def _add_failed_task(wsid, objid=None):
+    task_id = f'node:{uuid4()}'
+    _add_submit(task_id)
+    es_tasks.delete_by_query(['idx1', 'idx2'], {'match_all': {}}, 'test', wsid, objid)
+    responses.add(responses.GET, f"{_ES_URL}/_tasks/{task_id}", status=404, json={})
+    return task_id
+
+
+@responses.activate
+def test_poll_undeleted():
+    """A failed delete is dropped if the workspace was undeleted since."""
+    task_id = _add_failed_task(1)
+    with patch('src.index_runner.es_tasks.check_workspace_deleted', return_value=False) as check:
+        es_tasks.poll()
+    check.assert_called_with(1)
+    assert task_id not in _task_ids()
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_poll_max_attempts():
+    """A delete that keeps failing is saved to the error index instead of resubmitted."""
+    task_id = _add_failed_task(1, 2)
+    responses.add(responses.POST, f"{_ES_URL}/_bulk", json={'errors': False, 'items': []})
+    with patch.dict(config()._cfg, {'es_task_max_attempts': 1}):
+        es_tasks.poll()
+    assert task_id not in _task_ids()
+    assert len(responses.calls) == 3
+    (action, doc) = [json.loads(line) for line in responses.calls[2].request.body.splitlines()]
+    assert action['index']['_index'].endswith(config()['error_index_name'])
+    assert doc['evtype'] == 'DELETE_TASK_ERROR'
+    assert (doc['wsid'], doc['objid']) == (1, 2)
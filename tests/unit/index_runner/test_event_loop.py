@@ -1,6 +1,13 @@
+from confluent_kafka import TopicPartition
+from unittest.mock import patch
+import json
+import threading
+import time
+
 from src.utils.config import config
+from src.index_runner.es_bulk import BulkSink
 from src.index_runner.event_loop import start_loop
-from tests.unit.index_runner.helpers import MockConsumer
+from tests.unit.index_runner.helpers import MockConsumer, MockPartitionConsumer
 
 
 def test_retry_count():
@@ -16,3 +23,147 @@ def test_retry_count():
     consumer.produce_test('{}')
     start_loop(consumer, handler_raise, return_on_empty=True, timeout=0)
     assert call_count == config()['max_handler_failures']
+
+
+def test_concurrent_loop_commits_contiguous_offsets():
+    """Test that the concurrent loop handles every message once, in order per
+    workspace, and commits past the final offset."""
+    consumer = MockPartitionConsumer([])
+    handled = []
+    lock = threading.Lock()
+
+    def handler(message):
+        # Make earlier messages slower so they finish out of order
+        time.sleep(0.01 * (5 - message['objid'] % 5))
+        with lock:
+            handled.append((message['wsid'], message['objid']))
+    for objid in range(10):
+        consumer.produce_test(json.dumps({'evtype': 'REINDEX', 'wsid': objid % 2, 'objid': objid}))
+    start_loop(consumer, handler, return_on_empty=True, timeout=0, worker_count=4)
+    assert sorted(handled) == sorted((objid % 2, objid) for objid in range(10))
+    for wsid in (0, 1):
+        objids = [objid for (ws, objid) in handled if ws == wsid]
+        assert objids == sorted(objids)
+    assert consumer.committed == sorted(consumer.committed)
+    assert consumer.committed[-1] == 10
+
+
+def test_concurrent_loop_revoke():
+    """Revoked partitions commit their finished offsets and then nothing else."""
+    handled = []
+    release = threading.Event()
+
+    class RevokingConsumer(MockPartitionConsumer):
+        def subscribe(self, topics, on_revoke=None):
+            self.on_revoke = on_revoke
+
+        def poll(self, timeout):
+            if self.msg_queue.empty() and not release.is_set():
+                # Revoke once messages 0 and 2 are done while 1 is still running
+                for _ in range(500):
+                    if len(handled) == 2:
+                        break
+                    time.sleep(0.01)
+                self.on_revoke(self, [TopicPartition('test', 0)])
+                release.set()
+            return super().poll(timeout)
+
+    def handler(message):
+        if message['objid'] == 1:
+            release.wait(5)
+        handled.append(message['objid'])
+    consumer = RevokingConsumer([])
+    for objid in range(3):
+        consumer.produce_test(json.dumps({'evtype': 'REINDEX', 'wsid': objid, 'objid': objid}))
+    start_loop(consumer, handler, return_on_empty=True, timeout=0, worker_count=3, topics=['test'])
+    assert sorted(handled) == [0, 1, 2]
+    assert consumer.committed == [1]
+
+
+def test_concurrent_retry_count():
+    """Test that a failing handler is retried in its worker before moving on."""
+    consumer = MockPartitionConsumer([])
+    call_count = 0
+    failures = []
+
+    def handler_raise(message):
+        nonlocal call_count
+        call_count += 1
+        raise RuntimeError('Test error')
+    consumer.produce_test('{"wsid": 1}')
+    start_loop(consumer, handler_raise, on_failure=lambda msg, err: failures.append(err),
+               return_on_empty=True, timeout=0, worker_count=2)
+    assert call_count == config()['max_handler_failures']
+    assert len(failures) == call_count
+    assert consumer.committed == [1]
+
+
+def test_batch_loop_coalesces():
+    """Test that redundant events in a batch are handled once, and the batch committed."""
+    consumer = MockPartitionConsumer([])
+    handled = []
+    for ver in range(1, 6):
+        consumer.produce_test(json.dumps({'evtype': 'NEW_VERSION', 'wsid': 1, 'objid': 2, 'ver': ver}))
+    consumer.produce_test(json.dumps({'evtype': 'REINDEX', 'wsid': 1, 'objid': 2}))
+    consumer.produce_test(json.dumps({'evtype': 'REINDEX', 'wsid': 1, 'objid': 3}))
+    succeeded = []
+    start_loop(consumer, handled.append, on_success=succeeded.append,
+               return_on_empty=True, timeout=0, worker_count=1, batch_size=10)
+    assert handled == [
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 2, 'coalesced': 6},
+        {'evtype': 'REINDEX', 'wsid': 1, 'objid': 3},
+    ]
+    # Every consumed message is reported, including the collapsed ones
+    assert [(msg['objid'], msg.get('ver')) for msg in succeeded] == [
+        (2, 1), (2, 2), (2, 3), (2, 4), (2, 5), (2, None), (3, None)
+    ]
+    assert consumer.committed == [7]
+
+
+def test_commit_after_sink_flush():
+    """Test that offsets are committed only once the documents buffered for them are sent."""
+    consumer = MockPartitionConsumer([])
+    sent = []
+
+    def send(body):
+        # Nothing may be committed before the documents are saved
+        sent.append((body.count(b'\n') // 2, list(consumer.committed)))
+        return {'errors': False, 'items': []}
+    sink = BulkSink(max_wait=60, max_docs=100, send=send)
+
+    def handler(message):
+        sink.add({'index': 'test', 'id': message['objid'], 'doc': {}})
+    for objid in range(5):
+        consumer.produce_test(json.dumps({'evtype': 'REINDEX', 'wsid': 1, 'objid': objid}))
+    with patch('src.index_runner.es_bulk._SINK', sink):
+        start_loop(consumer, handler, return_on_empty=True, timeout=0, worker_count=1, batch_size=1)
+    assert sent == [(5, [])]
+    assert consumer.committed == [5]
+
+
+def test_sink_flush_failure():
+    """Documents that cannot be sent are saved to the error index, and the offsets committed, in every mode."""
+    for (worker_count, batch_size) in ((1, 1), (2, 1), (1, 10)):
+        consumer = MockPartitionConsumer([])
+        attempts = []
+
+        def send(body):
+            attempts.append(body)
+            raise RuntimeError('Error saving to elasticsearch')
+        sink = BulkSink(max_wait=0, max_docs=100, send=send)
+
+        def handler(message):
+            sink.add({'index': 'test', 'id': message['objid'], 'doc': {'access_group': 1, 'obj_id': 2}})
+        for objid in range(3):
+            consumer.produce_test(json.dumps({'evtype': 'REINDEX', 'wsid': 1, 'objid': objid}))
+        with patch('src.index_runner.es_bulk._SINK', sink), \
+                patch('src.index_runner.event_loop._FLUSH_RETRY_DELAY', 0), \
+                patch('src.index_runner.es_bulk.send_bulk') as send_bulk:
+            send_bulk.return_value = {'errors': False, 'items': []}
+            start_loop(consumer, handler, return_on_empty=True, timeout=0,
+                       worker_count=worker_count, batch_size=batch_size)
+        assert consumer.committed[-1] == 3
+        assert len(attempts) >= config()['max_handler_failures']
+        # Every document ends up in the error index
+        logged = b''.join(call[0][0] for call in send_bulk.call_args_list).decode('utf-8').splitlines()
+        assert len(logged) == 6
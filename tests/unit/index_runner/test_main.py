@@ -1,8 +1,9 @@
+import json
 import pytest
 import responses
 
 from tests.helpers import set_env
-from src.index_runner.main import _handle_msg, _reindex_narrative
+from src.index_runner.main import _find_nonexistent, _handle_msg, _reindex_narrative
 from src.utils.config import config
 
 # Allow requests to the service wizard (which happens in config)
@@ -104,3 +105,21 @@ def test_handle_msg_no_objtype():
         config(force_reload=True)
         res = _handle_msg({'objid': 1, 'wsid': 3000, 'evtype': 'x'})
     assert res is None
+
+
+@responses.activate
+def test_find_nonexistent():
+    """Objects missing from either ES or RE are found with one query to each."""
+    es_url = f"http://{config()['elasticsearch_host']}:{config()['elasticsearch_port']}"
+    prefix = config()['elasticsearch_index_prefix']
+    responses.add(responses.POST, f"{es_url}/{prefix}.*/_search", json={
+        'hits': {'hits': [{'_id': 'WS::7:1'}, {'_id': 'WS::7:2'}, {'_id': 'WS::7:2'}]}
+    })
+    responses.add(responses.POST, config()['re_api_url'] + '/api/v1/query_results', json={
+        'results': ['7:1', '7:3']
+    })
+    assert _find_nonexistent(7, [1, 2, 3, 4]) == [2, 3, 4]
+    assert len(responses.calls) == 2
+    es_query = json.loads(responses.calls[0].request.body)['query']
+    assert es_query == {'ids': {'values': ['WS::7:1', 'WS::7:2', 'WS::7:3', 'WS::7:4']}}
+    assert json.loads(responses.calls[1].request.body)['keys'] == ['7:1', '7:2', '7:3', '7:4']
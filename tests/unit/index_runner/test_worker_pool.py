@@ -0,0 +1,96 @@
+"""
+Test functions found in src/index_runner/worker_pool.py
+"""
+import threading
+import time
+
+from src.index_runner.worker_pool import KeyedWorkerPool, OffsetTracker
+
+
+def test_offset_tracker_contiguous():
+    """Only offsets below the lowest unfinished one are committable."""
+    tracker = OffsetTracker()
+    tp = ('topic', 0)
+    for offset in range(3):
+        tracker.start(tp, offset)
+    tracker.finish(tp, 1)
+    assert tracker.pop_committable() == []
+    tracker.finish(tp, 0)
+    assert tracker.pop_committable() == [(tp, 1)]
+    assert tracker.in_flight() == 1
+    tracker.finish(tp, 2)
+    assert tracker.pop_committable() == [(tp, 2)]
+    assert tracker.pop_committable() == []
+    assert tracker.in_flight() == 0
+
+
+def test_offset_tracker_redelivered():
+    """An offset delivered again forgets the unfinished offsets, and later ones, of its partition."""
+    tracker = OffsetTracker()
+    tp = ('topic', 0)
+    old = tracker.start(tp, 5)
+    tracker.start(tp, 6)
+    tracker.finish(tp, 6, old)
+    new = tracker.start(tp, 5)
+    # The first delivery of 5 finishing must not let 6 be committed
+    tracker.finish(tp, 5, old)
+    assert tracker.pop_committable() == []
+    tracker.finish(tp, 5, new)
+    assert tracker.pop_committable() == [(tp, 5)]
+
+
+def test_offset_tracker_reset():
+    """Reset partitions have nothing to commit, and their in-flight offsets are ignored."""
+    tracker = OffsetTracker()
+    (tp1, tp2) = (('topic', 0), ('topic', 1))
+    gen1 = tracker.start(tp1, 0)
+    tracker.start(tp1, 1)
+    gen2 = tracker.start(tp2, 0)
+    tracker.finish(tp1, 0, gen1)
+    tracker.finish(tp2, 0, gen2)
+    assert tracker.pop_committable([tp1]) == [(tp1, 0)]
+    tracker.reset([tp1])
+    tracker.finish(tp1, 1, gen1)
+    assert tracker.in_flight() == 0
+    assert tracker.pop_committable() == [(tp2, 0)]
+
+
+def test_keyed_worker_pool_ordering():
+    """Jobs with the same key run in order; jobs for other keys run alongside."""
+    pool = KeyedWorkerPool(4)
+    results = {'a': [], 'b': []}  # type: dict
+    running = set()
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def make_job(key, idx):
+        def job():
+            with lock:
+                running.add(key)
+                if len(running) > 1:
+                    overlapped.set()
+            time.sleep(0.01)
+            results[key].append(idx)
+            with lock:
+                running.discard(key)
+        return job
+    for idx in range(5):
+        pool.submit('a', make_job('a', idx))
+        pool.submit('b', make_job('b', idx))
+    pool.shutdown()
+    assert results['a'] == list(range(5))
+    assert results['b'] == list(range(5))
+    assert overlapped.is_set()
+
+
+def test_keyed_worker_pool_error():
+    """A job that raises does not block later jobs with the same key."""
+    pool = KeyedWorkerPool(1)
+    results = []
+
+    def bad_job():
+        raise RuntimeError('Test error')
+    pool.submit('a', bad_job)
+    pool.submit('a', lambda: results.append(1))
+    pool.shutdown()
+    assert results == [1]
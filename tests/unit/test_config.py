@@ -1,4 +1,4 @@
-from src.utils.config import config
+from src.utils.config import config, _fetch_global_config
 from tests.helpers import set_env
 import os
 
@@ -33,3 +33,20 @@ def test_skip_es():
         config()._cfg['last_config_reload'] = 0
         config().reload()
     assert config()["skip_es"] == "1"
+
+
+def test_snapshot_pins_config():
+    """A reload inside a snapshot block is not seen until the block exits."""
+    with config().snapshot():
+        with set_env(MAX_OBJECT_REINDEX="42"):
+            config(force_reload=True)
+        assert config()["max_object_reindex"] != 42
+    assert config()["max_object_reindex"] == 42
+    config(force_reload=True)
+
+
+def test_fetch_unchanged_config():
+    """Fetching an unchanged config file reuses the parsed data."""
+    url = config()['global_config_url']
+    first = _fetch_global_config(url)
+    assert _fetch_global_config(url) is first
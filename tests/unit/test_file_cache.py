@@ -0,0 +1,70 @@
+"""
+Test functions found in src/utils/file_cache.py
+"""
+from unittest.mock import patch
+import os
+import pytest
+import tempfile
+import time
+
+from src.utils import file_cache
+from src.utils.config import config
+
+
+@pytest.fixture
+def cache_dir():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with patch.dict(config()._cfg, {'shock_cache_dir': tmp_dir, 'shock_cache_max_bytes': 100}):
+            yield tmp_dir
+
+
+def _add(key, size):
+    with file_cache.new_file(key) as fwrite:
+        fwrite.write(b'x' * size)
+
+
+def test_new_file_get(cache_dir):
+    assert file_cache.get('node1') is None
+    _add('node1', 10)
+    path = file_cache.get('node1')
+    with open(path, 'rb') as fread:
+        assert fread.read() == b'x' * 10
+    # No temporary files are left behind
+    assert os.listdir(cache_dir) == ['node1']
+
+
+def test_new_file_error(cache_dir):
+    """A file is not cached if writing it fails."""
+    with pytest.raises(RuntimeError):
+        with file_cache.new_file('node1') as fwrite:
+            fwrite.write(b'partial')
+            raise RuntimeError('download failed')
+    assert file_cache.get('node1') is None
+    assert os.listdir(cache_dir) == []
+
+
+def test_evict_least_recently_used(cache_dir):
+    for (idx, key) in enumerate(('node1', 'node2', 'node3')):
+        _add(key, 30)
+        # Set distinct last-use times
+        os.utime(os.path.join(cache_dir, key), (time.time() - 100 + idx, time.time() - 100 + idx))
+    # node4 takes the cache over 100 bytes, and node2 is the least recently used
+    assert file_cache.get('node1')
+    _add('node4', 30)
+    assert sorted(os.listdir(cache_dir)) == ['node1', 'node3', 'node4']
+
+
+def test_too_large(cache_dir):
+    _add('node1', 101)
+    assert file_cache.get('node1') is None
+
+
+def test_disabled(cache_dir):
+    with patch.dict(config()._cfg, {'shock_cache_dir': ''}):
+        assert not file_cache.enabled()
+        assert file_cache.get('node1') is None
+
+
+def test_invalid_key(cache_dir):
+    with pytest.raises(ValueError):
+        file_cache.get('../node1')
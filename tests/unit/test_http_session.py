@@ -0,0 +1,31 @@
+"""
+Test functions found in src/utils/http_session.py
+"""
+import responses
+
+from src.utils.config import config
+from src.utils.http_session import get_session, new_session
+
+
+def test_get_session_reused():
+    """Each dependency gets a single session for the process."""
+    assert get_session('elasticsearch') is get_session('elasticsearch')
+    assert get_session('elasticsearch') is not get_session('re_api')
+    assert get_session('re_api').timeout == (config()['http_connect_timeout'], config()['http_read_timeout'])
+
+
+@responses.activate
+def test_new_session_request():
+    responses.add(responses.GET, 'http://example.test/', body='ok')
+    session = new_session(timeout=7)
+    assert session.get('http://example.test/').text == 'ok'
+    adapter = session.get_adapter('http://example.test/')
+    assert adapter.max_retries.status_forcelist == (502, 503, 504)
+
+
+def test_new_session_retries_idempotent_only():
+    """Gateway errors are retried for reads, but writes such as bulk POSTs are not replayed."""
+    retry = new_session().get_adapter('http://example.test/').max_retries
+    assert retry.is_retry('GET', 503)
+    assert retry.is_retry('PUT', 502)
+    assert not retry.is_retry('POST', 504)
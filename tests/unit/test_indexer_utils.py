@@ -1,4 +1,7 @@
 from src.index_runner.es_indexers import indexer_utils
+import io
+import json
+import pytest
 
 
 def lists_are_same(L1, L2):
@@ -94,3 +97,35 @@ def test_merge_no_doc_error():
         _ = indexer_utils.merge_default_fields(indexer_doc, defaults)
     except ValueError as err:
         assert str(err) == "indexer return data should have 'doc' dictionary {}"
+
+
+def test_iter_json_array():
+    """Elements are parsed across chunk boundaries, including numbers split between chunks."""
+    items = [{'id': 'a', 'dna_sequence': 'ACGT' * 50}, 12345, "x, ]", [1, [2]], None, {},
+             -25000000000.05, 1e5, -2.5E-7, 3e+21, {'x': 0.125}, -7]
+    text = ' [ ' + ' ,\n'.join(json.dumps(item) for item in items) + ' ] \n'
+    # Exponents in the forms json.dumps does not write
+    text = text.replace('100000.0', '1e5').replace('2.5e-07', '2.5E-7')
+    for chunk_size in list(range(1, 17)) + [1024]:
+        assert list(indexer_utils.iter_json_array(io.StringIO(text), chunk_size)) == items
+    assert list(indexer_utils.iter_json_array(io.StringIO('[]'), 1)) == []
+
+
+def test_iter_json_array_invalid():
+    with pytest.raises(ValueError):
+        list(indexer_utils.iter_json_array(io.StringIO('{"a": 1}')))
+    with pytest.raises(ValueError):
+        list(indexer_utils.iter_json_array(io.StringIO('[1, 2'), 2))
+    with pytest.raises(ValueError):
+        list(indexer_utils.iter_json_array(io.StringIO('[{"a": 1} {"b": 2}]'), 4))
+
+
+def test_prune_fields():
+    doc = {'id': 'x', 'dna_sequence': 'ACGT' * 10, 'functions': ['abcdefgh', 'ab'], 'genome_size': 5}
+    saved = indexer_utils.prune_fields(doc, {'exclude': ['genome_size'], 'max_string_length': 4})
+    assert doc == {'id': 'x', 'dna_sequence': 'ACGT', 'functions': ['abcd', 'ab']}
+    assert saved > 36 + 4
+    doc = {'id': 'x', 'dna_sequence': 'ACGT', 'type': 'gene'}
+    indexer_utils.prune_fields(doc, {'include': ['id', 'type']})
+    assert doc == {'id': 'x', 'type': 'gene'}
+    assert indexer_utils.prune_fields(doc, {}) == 0
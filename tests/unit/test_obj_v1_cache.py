@@ -0,0 +1,45 @@
+"""
+Test functions found in src/utils/obj_v1_cache.py
+"""
+from unittest.mock import patch
+import pytest
+import responses
+
+from src.utils.config import config
+from src.utils.request_context import RequestContext
+import src.utils.obj_v1_cache as obj_v1_cache
+
+_INFO_V1 = [2, "objname", "TypeModule.TypeName-1.2", "2020-08-11T23:12:28+0000", 1,
+            "creator_username", 33194, "workspace_name", "checksum", 24500, {}]
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path):
+    """Use a new cache for each test."""
+    _close()
+    with patch.dict(config()._cfg, {'obj_v1_cache_path': str(tmp_path / 'obj_v1.sqlite')}):
+        yield
+        _close()
+
+
+def _close():
+    if obj_v1_cache._CONN is not None:
+        obj_v1_cache._CONN.close()
+    obj_v1_cache._CONN = None
+
+
+def test_put_get():
+    assert obj_v1_cache.get('33194/2') is None
+    obj_v1_cache.put('33194/2', _INFO_V1)
+    assert obj_v1_cache.get('33194/2') == _INFO_V1
+
+
+@responses.activate
+def test_get_obj_v1_fetches_once():
+    """Only the first lookup of an object's first version goes to the workspace, and only the info is kept."""
+    obj_v1 = {"info": _INFO_V1, "creator": "creator_username", "provenance": [{"description": "x" * 1000}]}
+    mock_resp = {"version": "1.1", "result": [{"data": [obj_v1]}]}
+    responses.add(responses.POST, config()['workspace_url'], json=mock_resp)
+    assert RequestContext().get_obj_v1('33194/2') == {"info": _INFO_V1}
+    assert RequestContext().get_obj_v1('33194/2') == {"info": _INFO_V1}
+    assert len(responses.calls) == 1
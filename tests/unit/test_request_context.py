@@ -0,0 +1,64 @@
+"""
+Test functions found in src/utils/request_context.py
+"""
+from unittest.mock import patch
+import responses
+
+from src.utils.config import config
+from src.utils.request_context import RequestContext, cache_stats, invalidate_workspace
+
+_OBJ_INFO = [1, "objname", "TypeModule.TypeName-1.2", "2020-08-11T23:12:28+0000", 57,
+             "creator_username", 33192, "workspace_name", "checksum", 24500, {}]
+
+
+@responses.activate
+def test_permissions_memoized():
+    """Repeated permission lookups make a single workspace request."""
+    mock_resp = {"version": "1.1", "result": [{"perms": [{"user1": "a"}]}]}
+    responses.add(responses.POST, config()['workspace_url'], json=mock_resp)
+    invalidate_workspace(33192)
+    ctx = RequestContext()
+    assert ctx.get_permissions(33192) == {"user1": "a"}
+    assert ctx.get_permissions(33192) == {"user1": "a"}
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_permissions_shared_and_invalidated():
+    """Permissions are shared across events until the workspace is invalidated."""
+    mock_resp = {"version": "1.1", "result": [{"perms": [{"user1": "a"}]}]}
+    responses.add(responses.POST, config()['workspace_url'], json=mock_resp)
+    invalidate_workspace(33193)
+    RequestContext().get_permissions(33193)
+    RequestContext().get_permissions(33193)
+    assert len(responses.calls) == 1
+    invalidate_workspace(33193)
+    RequestContext().get_permissions(33193)
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_get_object_versioned_ref():
+    """Fetching the latest version also caches the object under its versioned ref."""
+    mock_resp = {"version": "1.1", "result": [{"data": [{"info": _OBJ_INFO, "data": {}}]}]}
+    responses.add(responses.POST, config()['workspace_url'], json=mock_resp)
+    ctx = RequestContext()
+    latest = ctx.get_object("33192/1")
+    assert ctx.get_object("33192/1/57") is latest
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_ws_cache_follows_config():
+    """The cache settings are read from the current configuration, not at import."""
+    mock_resp = {"version": "1.1", "result": [{"perms": [{"user1": "a"}]}]}
+    responses.add(responses.POST, config()['workspace_url'], json=mock_resp)
+    invalidate_workspace(33194)
+    with patch.dict(config()._cfg, {'ws_cache_ttl': 0}):
+        RequestContext().get_permissions(33194)
+        RequestContext().get_permissions(33194)
+        assert len(responses.calls) == 2
+    RequestContext().get_permissions(33194)
+    RequestContext().get_permissions(33194)
+    assert len(responses.calls) == 3
+    assert set(cache_stats()) == {'ws_info', 'ws_perms'}
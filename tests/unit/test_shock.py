@@ -0,0 +1,82 @@
+"""
+Test functions found in src/utils/shock.py
+"""
+from kbase_workspace_client.exceptions import MissingShockFile
+from unittest.mock import patch
+import gzip
+import json
+import pytest
+import responses
+import tempfile
+
+from src.utils.config import config
+from src.utils.shock import PrefetchReader, open_handle_stream
+
+_NODE_URL = f"{config()['kbase_endpoint']}/shock-api/node/node1"
+
+
+@pytest.fixture
+def cache_dir():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with patch.dict(config()._cfg, {'shock_cache_dir': tmp_dir}):
+            yield tmp_dir
+
+
+def test_prefetch_reader():
+    data = gzip.compress(json.dumps([{'id': i} for i in range(1000)]).encode('utf-8'))
+    chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+    with PrefetchReader(iter(chunks), 2) as reader:
+        with gzip.open(reader, 'rt') as fd:
+            assert json.load(fd) == [{'id': i} for i in range(1000)]
+
+
+def test_prefetch_reader_error():
+    """Errors from the download are raised once the data before them is read."""
+    def chunks():
+        yield b'abc'
+        raise RuntimeError('connection reset')
+    with PrefetchReader(chunks(), 2) as reader:
+        assert reader.read(3) == b'abc'
+        with pytest.raises(RuntimeError):
+            reader.read(3)
+
+
+def test_prefetch_reader_close():
+    """Closing a reader stops the download, even when the queue is full."""
+    pulled = []
+
+    def chunks():
+        while True:
+            pulled.append(1)
+            yield b'x' * 10
+    reader = PrefetchReader(chunks(), 2)
+    assert reader.read(5) == b'xxxxx'
+    reader.close()
+    reader._thread.join(timeout=5)
+    assert not reader._thread.is_alive()
+    assert len(pulled) < 10
+
+
+@responses.activate
+def test_open_handle_stream(cache_dir):
+    """The file is downloaded once and then read from the file cache."""
+    responses.add(responses.GET, _NODE_URL, json={'status': 200, 'data': {}})
+    responses.add(responses.GET, _NODE_URL + '?download_raw', body=b'file contents')
+    with patch.object(config()['ws_client'], 'handle_to_shock', return_value='node1'):
+        with open_handle_stream('KBH_1') as fd:
+            assert fd.read() == b'file contents'
+        assert responses.calls[1].request.headers['Authorization'] == 'OAuth ' + config()['ws_token']
+        # The prefetch thread adds the file to the cache once it is complete
+        fd._thread.join(timeout=5)
+        with open_handle_stream('KBH_1') as fd:
+            assert fd.read() == b'file contents'
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_open_handle_stream_missing(cache_dir):
+    responses.add(responses.GET, _NODE_URL, json={'status': 404, 'data': None})
+    with patch.object(config()['ws_client'], 'handle_to_shock', return_value='node1'):
+        with pytest.raises(MissingShockFile):
+            with open_handle_stream('KBH_1'):
+                pass
@@ -45,6 +45,15 @@ def test_mappings():
         assert 'properties' in val
 
 
+def test_field_pruning():
+    for (index_name, rules) in spec.get('field_pruning', {}).items():
+        assert index_name in spec['mappings']
+        assert set(rules) <= {'include', 'exclude', 'max_string_length'}
+        properties = spec['mappings'][index_name]['properties']
+        for field in rules.get('include', []) + rules.get('exclude', []):
+            assert field in properties
+
+
 def test_elasticsearch_module_schema():
     """
     Validate the schema for elasticsearch indexer module config.
@@ -0,0 +1,35 @@
+"""
+Test functions found in src/utils/ttl_cache.py
+"""
+import time
+
+from src.utils.ttl_cache import TTLCache
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats() == {'hits': 3, 'misses': 1, 'size': 2}
+
+
+def test_expiry_and_invalidate():
+    cache = TTLCache(maxsize=10, ttl=0.01)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.invalidate('b')
+    assert cache.get('b') is None
+    time.sleep(0.02)
+    assert cache.get('a', 'missing') == 'missing'
+
+
+def test_disabled():
+    cache = TTLCache(maxsize=10, ttl=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None